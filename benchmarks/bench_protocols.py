@@ -0,0 +1,468 @@
+"""
+状態管理（db-unit）とセッション照会（identify-unit）のプロトコルの負荷試験です。
+
+db-unit と identify-unit のセッション照会の処理をこのプロセス内で起動し、多数の利用者を模した
+リクエスト（get / set / all_get / delete / clear / session）を指定した割合・同時実行数で送り続けて、
+スループット、操作ごとの応答時間（p50 / p99 / p999）、CPU 時間とメモリ使用量を JSON で出力します。
+保存した結果を --compare に渡すと、同じ同時実行数どうしの変化率も出力します。
+
+例: 読み込み中心の割合で、同時 1・8・32 件をそれぞれ 10 秒ずつ計測して保存する
+> python benchmarks/bench_protocols.py --mix read-heavy --concurrency 1 8 32 --duration 10 --output baseline.json
+
+例: 割合を直接指定し、ローカルの Mosquitto を使って計測して保存済みの結果と比較する
+> python benchmarks/bench_protocols.py --mix get=50,set=30,session=20 --broker localhost:1883 --compare baseline.json
+
+--broker を省略すると、ユニットと負荷をかける側をプロセス内のブローカー（MODT_TRANSPORT=loopback）で接続します。
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_UNIT_DIR = os.path.join(ROOT, "db-unit")
+IDENTIFY_DIR = os.path.join(ROOT, "identify-unit", "src")
+sys.path.insert(0, ROOT)
+
+from common import modt
+
+OPERATIONS = ("get", "set", "all_get", "delete", "clear", "session")
+# よく使う割合（重み）の組み合わせ
+MIXES = {
+    "read-heavy": {"get": 70, "all_get": 5, "set": 10, "session": 15},
+    "write-heavy": {"get": 20, "set": 60, "delete": 15, "clear": 1, "session": 4},
+    "mixed": {"get": 40, "set": 25, "all_get": 5, "delete": 10, "clear": 1, "session": 19},
+    "session": {"session": 100},
+}
+# p999 まで比較できるよう、誤差 2% 以内のバケットで応答時間（マイクロ秒）を数える
+HISTOGRAM_GROWTH = 1.02
+HISTOGRAM_BUCKETS = 1024
+
+
+def parse_mix(text):
+    """"read-heavy" のような名前か、"get=60,set=30,session=10" 形式の割合を {操作: 重み} に変換します。"""
+    if text in MIXES:
+        return dict(MIXES[text])
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"unknown operation '{name}' (choose from {', '.join(OPERATIONS)})")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("mix must have at least one operation with a positive weight")
+    return mix
+
+
+def load_unit(name, directory):
+    """ユニットの main.py を name という名前のモジュールとして読み込みます（各ユニットの main.py は名前が重なるため）。"""
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(directory, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class DbUnit:
+    """db-unit の main() と同じ構成（ストア・ワーカー・購読）をこのプロセス内で起動します。"""
+
+    def __init__(self, workdir, workers):
+        db = load_unit("db_unit_main", DB_UNIT_DIR)
+        self.db_path = os.path.join(workdir, "state.db")
+        self.store = db.init_db(db_path=self.db_path, parallel_reads=workers > 1)
+        self.dispatcher = db.ShardedDispatcher(db.handle_request, workers=workers)
+        self.client = modt.get_mqtt_client(client_id="bench-db-unit")
+        self.client.on_message = db.on_message
+        self.client.on_connect = db.on_connect
+        self.client.user_data_set({
+            "store": self.store,
+            "dispatcher": self.dispatcher,
+            "shard_count": 1,
+            "shard_index": 0,
+        })
+        modt.connect_broker(self.client)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.dispatcher.stop()
+        self.store.close()
+
+
+class IdentifyUnit:
+    """identify-unit のセッション照会の処理（handle_session_query）を、専用のイベントループで起動します。"""
+
+    def __init__(self, workdir, session_backend, sessions):
+        os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'identify.db')}")
+        os.environ["IDENTIFY_SESSION_BACKEND"] = session_backend
+        self.identify = load_unit("identify_main", IDENTIFY_DIR)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="bench-identify", daemon=True).start()
+        self._call(self._start(sessions), timeout=120)
+
+    def _call(self, coro, timeout=30):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    async def _start(self, sessions):
+        identify = self.identify
+        await identify.active_sessions.setup()
+        for session_id, user_id in sessions:
+            await identify.active_sessions.put(session_id, {"user_id": user_id, "role": "user"})
+        await identify.mqtt_client.connect()
+        # 本番と同じ共有サブスクリプションで受ける
+        self.task = asyncio.create_task(
+            identify.consume(identify.SESSION_QUERY_SUBSCRIPTION, identify.handle_session_query, concurrent=True)
+        )
+
+    def stop(self):
+        async def shutdown():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            await self.identify.mqtt_client.disconnect()
+            await self.identify.engine.dispose()
+        self._call(shutdown())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class LoadClient:
+    """負荷をかける側の 1 接続です。複数のスレッドから同時に使えます。"""
+
+    def __init__(self, client_id, timeout):
+        self.timeout = timeout
+        self.client = modt.get_mqtt_client(client_id=client_id)
+        self.requester = modt.Requester(self.client, modt.get_reply_topic(client_id))
+        self.state = modt.StateClient(self.requester, timeout=timeout)
+        subscribed = threading.Event()
+        self.client.on_connect = lambda client, userdata, flags, rc: client.subscribe(self.requester.reply_topic)
+        self.client.on_subscribe = lambda client, userdata, mid, granted_qos: subscribed.set()
+        modt.connect_broker(self.client)
+        self.client.loop_start()
+        subscribed.wait(10)
+
+    def get(self, user_id, key):
+        reply = self.requester.request(
+            modt.get_state_topic(modt.TOPIC_STATE_GET, user_id),
+            modt.create_state_get_payload(user_id, key),
+            timeout=self.timeout,
+        )
+        return reply is not None
+
+    def all_get(self, user_id):
+        reply = self.requester.request(
+            modt.get_state_topic(modt.TOPIC_STATE_ALL_GET, user_id),
+            modt.create_state_all_get_payload(user_id),
+            timeout=self.timeout,
+        )
+        return reply is not None
+
+    def session(self, session_id):
+        reply = self.requester.request(
+            modt.TOPIC_SESSION_QUERY,
+            modt.create_session_query_payload(session_id),
+            timeout=self.timeout,
+        )
+        return reply is not None and reply.get("status") == "valid"
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class Workload:
+    """利用者・キー・セッションの名前と、1 回の操作の実行方法を決めます。"""
+
+    def __init__(self, users, keys_per_user, value_size, mix):
+        self.users = users
+        self.keys_per_user = keys_per_user
+        self.value = "x" * value_size
+        self.names = [name for name in OPERATIONS if mix.get(name, 0) > 0]
+        self.weights = [mix[name] for name in self.names]
+
+    @staticmethod
+    def user_id(n):
+        return f"bench-user-{n}"
+
+    @staticmethod
+    def session_id(n):
+        return f"bench-session-{n}"
+
+    def key(self, n):
+        return f"key-{n:04d}"
+
+    def sessions(self):
+        return [(self.session_id(n), self.user_id(n)) for n in range(self.users)]
+
+    def prefill(self, client, user):
+        """利用者 1 人分のキーをまとめて保存します。"""
+        items = {self.key(k): self.value for k in range(self.keys_per_user)}
+        ack = client.state.mset(self.user_id(user), items)
+        return ack is not None and ack.get("status") == "ok"
+
+    def run_one(self, client, rng):
+        """割合に従って 1 回の操作を選んで実行し、(操作名, 成功したか) を返します。"""
+        name = rng.choices(self.names, self.weights)[0]
+        user = rng.randrange(self.users)
+        user_id = self.user_id(user)
+        key = self.key(rng.randrange(self.keys_per_user))
+        if name == "get":
+            ok = client.get(user_id, key)
+        elif name == "set":
+            ok = self._acked(client.state.set(user_id, key, self.value))
+        elif name == "all_get":
+            ok = client.all_get(user_id)
+        elif name == "delete":
+            ok = self._acked(client.state.delete(user_id, key))
+        elif name == "clear":
+            ok = self._acked(client.state.clear(user_id))
+        else:
+            ok = client.session(self.session_id(user))
+        return name, ok
+
+    @staticmethod
+    def _acked(ack):
+        return ack is not None and ack.get("status") == "ok"
+
+
+def new_histogram():
+    return modt.LogHistogram(growth=HISTOGRAM_GROWTH, buckets=HISTOGRAM_BUCKETS)
+
+
+def drive(workload, clients, concurrency, duration, seed):
+    """
+    concurrency 個のスレッドから duration 秒間リクエストを送り続け、
+    {操作名: [応答時間の分布, 失敗数]} と経過秒を返します。スレッドごとに集計し、最後にまとめます。
+    """
+    deadline = time.perf_counter() + duration
+    results = [dict() for _ in range(concurrency)]
+
+    def worker(index):
+        rng = random.Random(seed * 100003 + index)
+        client = clients[index % len(clients)]
+        stats = results[index]
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            name, ok = workload.run_one(client, rng)
+            elapsed_us = (time.perf_counter() - start) * 1_000_000
+            entry = stats.get(name)
+            if entry is None:
+                entry = stats[name] = [new_histogram(), 0]
+            entry[0].add(elapsed_us)
+            if not ok:
+                entry[1] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    merged = {}
+    for stats in results:
+        for name, (histogram, errors) in stats.items():
+            entry = merged.setdefault(name, [new_histogram(), 0])
+            entry[0].merge(histogram)
+            entry[1] += errors
+    return merged, elapsed
+
+
+def summarize_latency(histogram, errors):
+    return {
+        "count": histogram.total,
+        "errors": errors,
+        "mean_ms": round(histogram.sum / histogram.total / 1000, 3) if histogram.total else 0.0,
+        "p50_ms": round(histogram.percentile(50) / 1000, 3),
+        "p99_ms": round(histogram.percentile(99) / 1000, 3),
+        "p999_ms": round(histogram.percentile(99.9) / 1000, 3),
+        "max_ms": round(histogram.max / 1000, 3),
+    }
+
+
+def resource_usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime, usage.ru_stime, usage.ru_maxrss
+
+
+def run_level(workload, clients, concurrency, args, db_unit):
+    """1 つの同時実行数で暖機と計測を行い、結果の辞書を返します。"""
+    if args.warmup > 0:
+        drive(workload, clients, concurrency, args.warmup, args.seed + 1)
+    user_before, system_before, _ = resource_usage()
+    merged, elapsed = drive(workload, clients, concurrency, args.duration, args.seed)
+    user_after, system_after, max_rss = resource_usage()
+
+    total = new_histogram()
+    errors = 0
+    for histogram, op_errors in merged.values():
+        total.merge(histogram)
+        errors += op_errors
+    cpu = (user_after - user_before) + (system_after - system_before)
+    return {
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 3),
+        "requests": total.total,
+        "errors": errors,
+        "throughput_rps": round(total.total / elapsed, 1) if elapsed > 0 else 0.0,
+        "latency": {
+            "all": summarize_latency(total, errors),
+            **{name: summarize_latency(*merged[name]) for name in OPERATIONS if name in merged},
+        },
+        "resources": {
+            "cpu_user_s": round(user_after - user_before, 3),
+            "cpu_system_s": round(system_after - system_before, 3),
+            # 1 コア分を 100% とする
+            "cpu_percent": round(cpu / elapsed * 100, 1) if elapsed > 0 else 0.0,
+            # Linux の ru_maxrss は KB 単位（プロセス開始からの最大値）
+            "max_rss_mb": round(max_rss / 1024, 1),
+            "threads": threading.active_count(),
+            "db_size_mb": round(sum(
+                os.path.getsize(path) for path in (db_unit.db_path, db_unit.db_path + "-wal")
+                if os.path.exists(path)
+            ) / 1024 / 1024, 2),
+        },
+    }
+
+
+def change_pct(current, baseline):
+    if not baseline:
+        return None
+    return round((current - baseline) / baseline * 100, 1)
+
+
+def compare(runs, baseline):
+    """同じ同時実行数の保存済みの結果と比べ、スループットと応答時間の変化率（%）を返します。"""
+    previous = {run["concurrency"]: run for run in baseline.get("runs", [])}
+    comparison = []
+    for run in runs:
+        base = previous.get(run["concurrency"])
+        if base is None:
+            continue
+        latency = {}
+        for name, stats in run["latency"].items():
+            base_stats = base["latency"].get(name)
+            if base_stats is None:
+                continue
+            latency[name] = {
+                field: change_pct(stats[field], base_stats[field]) for field in ("p50_ms", "p99_ms", "p999_ms")
+            }
+        comparison.append({
+            "concurrency": run["concurrency"],
+            "throughput_change_pct": change_pct(run["throughput_rps"], base["throughput_rps"]),
+            "cpu_percent_change_pct": change_pct(run["resources"]["cpu_percent"], base["resources"]["cpu_percent"]),
+            "latency_change_pct": latency,
+        })
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="db-unit と identify-unit のセッション照会の負荷試験を行い、結果を JSON で出力します。")
+    parser.add_argument("--mix", default="mixed", help=f"操作の割合（{' / '.join(MIXES)} または get=60,set=30,session=10 の形式）")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="同時実行数（複数指定すると順に計測）")
+    parser.add_argument("--duration", type=float, default=10.0, help="同時実行数ごとの計測秒数")
+    parser.add_argument("--warmup", type=float, default=2.0, help="計測前の暖機の秒数")
+    parser.add_argument("--users", type=int, default=1000, help="模擬する利用者数（セッションも同数作成）")
+    parser.add_argument("--keys-per-user", type=int, default=20, help="利用者ごとに事前に保存するキー数")
+    parser.add_argument("--value-size", type=int, default=64, help="保存する値の文字数")
+    parser.add_argument("--clients", type=int, default=4, help="負荷をかける MQTT 接続の数")
+    parser.add_argument("--timeout", type=float, default=5.0, help="1 リクエストの応答待ちの上限（秒）")
+    parser.add_argument("--db-workers", type=int, default=int(os.getenv("DB_WORKERS", "4")), help="db-unit のワーカースレッド数")
+    parser.add_argument("--session-backend", choices=("memory", "sql"), default="memory", help="identify-unit のセッションの保存先")
+    parser.add_argument("--broker", help="使用するブローカー（host:port）。省略するとプロセス内で起動")
+    parser.add_argument("--seed", type=int, default=1, help="乱数の種（同じ値なら同じ操作の列を生成）")
+    parser.add_argument("--output", help="結果の JSON を保存するファイル（省略すると標準出力）")
+    parser.add_argument("--compare", help="比較する保存済みの結果（JSON）")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+
+    # ユニットと負荷をかける側は、いずれも環境変数の通信方式とブローカーで接続する
+    if args.broker:
+        host, _, port = args.broker.rpartition(":")
+        os.environ["MODT_TRANSPORT"] = modt.TRANSPORT_MQTT
+        os.environ["MODT_BROKER_HOST"] = host or "localhost"
+        os.environ["MODT_BROKER_PORT"] = str(int(port))
+    else:
+        os.environ["MODT_TRANSPORT"] = modt.TRANSPORT_LOOPBACK
+    # db-unit は 1 シャードで起動するため、リクエストも従来のトピックへ送る
+    os.environ["MODT_STATE_SHARDS"] = "1"
+
+    workload = Workload(args.users, args.keys_per_user, args.value_size, mix)
+    workdir = tempfile.mkdtemp(prefix="modt-bench-")
+    db_unit = DbUnit(workdir, args.db_workers)
+    identify_unit = IdentifyUnit(workdir, args.session_backend, workload.sessions()) if "session" in mix else None
+    clients = [LoadClient(f"bench-client-{i}", args.timeout) for i in range(max(1, args.clients))]
+
+    try:
+        modt.logger.info(f"Prefilling {args.users} users x {args.keys_per_user} keys...")
+        with ThreadPoolExecutor(max(args.concurrency)) as pool:
+            prefilled = sum(pool.map(lambda n: workload.prefill(clients[n % len(clients)], n), range(args.users)))
+        if prefilled < args.users:
+            raise RuntimeError(f"prefill failed for {args.users - prefilled} users (is db-unit reachable?)")
+
+        runs = []
+        for concurrency in args.concurrency:
+            run = run_level(workload, clients, concurrency, args, db_unit)
+            runs.append(run)
+            overall = run["latency"]["all"]
+            modt.logger.info(
+                f"concurrency={concurrency}: {run['throughput_rps']} req/s p50={overall['p50_ms']}ms "
+                f"p99={overall['p99_ms']}ms p999={overall['p999_ms']}ms errors={run['errors']}"
+            )
+    finally:
+        for client in clients:
+            client.stop()
+        if identify_unit is not None:
+            identify_unit.stop()
+        db_unit.stop()
+
+    result = {
+        "benchmark": "modt-protocols",
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "mix": mix,
+            "users": args.users,
+            "keys_per_user": args.keys_per_user,
+            "value_size": args.value_size,
+            "clients": args.clients,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "db_workers": args.db_workers,
+            "session_backend": args.session_backend,
+            "broker": args.broker or modt.TRANSPORT_LOOPBACK,
+            "seed": args.seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "runs": runs,
+    }
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            result["comparison"] = compare(runs, json.load(f))
+
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        modt.logger.info(f"Results written to {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,16 @@
 # common/modt/__init__.py のイメージ
 from .topics import *
 from .core import *
+from .loopback import *
 from .payloads import *
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .rpc import *
+from .streams import *
+from .shards import *
+from .aio import *
+from .tokens import *
+from .singleflight import *
+from .sessions import *
+from .state import *
+from .metrics import *
+from .tracing import *
\ No newline at end of file
@@ -0,0 +1,255 @@
+import os
+import asyncio
+import paho.mqtt.client as mqtt
+from .core import get_mqtt_client, TRANSPORT_LOOPBACK
+from .loopback import LoopbackClient
+from .utils import logger, parse_payload
+from .rpc import get_reply_topic, new_correlation_id, attach_reply
+from .tracing import span
+
+# 再接続の待機時間（秒）の初期値と上限
+_RECONNECT_MIN_DELAY = 1.0
+_RECONNECT_MAX_DELAY = 30.0
+
+
+def _strip_shared_prefix(topic_filter):
+    """$share/<group>/ 付きの購読フィルタから、実際のトピックと照合するフィルタ部分を取り出します。"""
+    if topic_filter.startswith("$share/"):
+        return topic_filter.split("/", 2)[2]
+    return topic_filter
+
+
+class Subscription:
+    """
+    AsyncClient.subscribe() が返す非同期イテレーターです。
+    async for で受信したメッセージ（paho の MQTTMessage）を順に取り出せます。
+    """
+
+    def __init__(self, client, topic_filter, maxsize=0):
+        self._client = client
+        self.topic_filter = topic_filter
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """購読を解除します。同じフィルタの購読者がいなくなればブローカー側の購読も解除します。"""
+        self._client._remove_subscription(self)
+
+
+class AsyncClient:
+    """
+    イベントループ上で MQTT の送受信を行う modt クライアントです。
+    paho の外部ループ連携（ソケットを add_reader / add_writer で監視）を用いるため、
+    コールバックはすべてイベントループのスレッドで実行され、スレッド間の受け渡しやロックが不要です。
+
+    client = modt.AsyncClient("my-unit")
+    await client.connect()
+    async for msg in client.subscribe(modt.TOPIC_APP_READY): ...
+    reply = await client.request(modt.TOPIC_SESSION_QUERY, modt.create_session_query_payload(sid))
+    """
+
+    def __init__(self, client_id=""):
+        self.client_id = client_id
+        self.reply_topic = get_reply_topic(client_id)
+        self.client = get_mqtt_client(client_id)
+        self.loop = None
+
+        self._filters = {}   # 購読フィルタ -> {"qos": int, "subscriptions": set}
+        self._pending = {}   # 相関ID -> Future
+        self._published = {}  # QoS 1 以上の送信のメッセージID -> Future
+        self._connected = None
+        self._closing = False
+        self._misc_task = None
+        self._reconnect_task = None
+
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.on_publish = self._on_publish
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    # --- 接続管理 ---
+
+    async def connect(self, host=None, port=None, timeout=10.0):
+        """ブローカーに接続し、CONNACK を受信するまで待機します。"""
+        self.loop = asyncio.get_running_loop()
+        self._connected = asyncio.Event()
+        self._closing = False
+        host = host or os.getenv("MODT_BROKER_HOST", "broker")
+        port = int(port or os.getenv("MODT_BROKER_PORT", "1883"))
+        address = f"{host}:{port}"
+        if isinstance(self.client, LoopbackClient):
+            # プロセス内のブローカーにはソケットがないため、コールバックをこのイベントループへ直接届けさせる
+            self.client.attach_loop(self.loop)
+            address = TRANSPORT_LOOPBACK
+        try:
+            self.client.connect(host, port, 60)
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except Exception as e:
+            logger.error(f"MQTTブローカーへの接続に失敗しました: {e}")
+            raise
+        logger.info(f"MQTTブローカー（{address}）に非同期クライアントで接続しました。")
+
+    async def disconnect(self):
+        """再接続を止めて切断し、応答待ちのリクエストをすべて取り消します。"""
+        self._closing = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        self.client.disconnect()
+        for future in list(self._pending.values()) + list(self._published.values()):
+            future.cancel()
+        self._pending.clear()
+        self._published.clear()
+        logger.info("MQTTブローカーから切断されました。")
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.error(f"MQTT connection refused with code {rc}")
+            return
+        # 再接続時も含め、登録済みのフィルタと返信トピックをまとめて購読し直す
+        topics = [(self.reply_topic, 0)]
+        topics.extend((topic_filter, entry["qos"]) for topic_filter, entry in self._filters.items())
+        client.subscribe(topics)
+        self._connected.set()
+
+    def _on_disconnect(self, client, userdata, rc):
+        if self._connected:
+            self._connected.clear()
+        if rc != 0 and not self._closing and self._reconnect_task is None:
+            logger.warning(f"MQTT connection lost (rc={rc}); reconnecting...")
+            self._reconnect_task = self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = _RECONNECT_MIN_DELAY
+        try:
+            while not self._closing:
+                await asyncio.sleep(delay)
+                try:
+                    self.client.reconnect()
+                    return
+                except OSError as e:
+                    logger.warning(f"MQTT reconnect failed: {e}")
+                    delay = min(delay * 2, _RECONNECT_MAX_DELAY)
+        finally:
+            self._reconnect_task = None
+
+    # --- paho の外部ループ連携 ---
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self._misc_task = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self._misc_task:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        """キープアライブや再送などの定期処理を 1 秒ごとに実行します。"""
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+    # --- 送受信 ---
+
+    async def publish(self, topic, payload, qos=0):
+        """メッセージを送信します。QoS 1 以上の場合はブローカーへの送達完了まで待機します。"""
+        info = self.client.publish(topic, payload, qos)
+        if qos > 0 and info.rc == mqtt.MQTT_ERR_SUCCESS:
+            # PUBACK の処理もこのイベントループ上で行われるため、登録前に完了通知が届くことはない
+            future = self.loop.create_future()
+            self._published[info.mid] = future
+            try:
+                await future
+            finally:
+                self._published.pop(info.mid, None)
+        return info
+
+    def _on_publish(self, client, userdata, mid):
+        future = self._published.get(mid)
+        if future is not None and not future.done():
+            future.set_result(mid)
+
+    def publish_threadsafe(self, topic, payload, qos=0):
+        """イベントループ外のスレッド（同期ハンドラーなど）から送信する場合に使用します。"""
+        self.loop.call_soon_threadsafe(self.client.publish, topic, payload, qos)
+
+    def subscribe(self, topic_filter, qos=0, maxsize=0):
+        """topic_filter に一致するメッセージを受け取る Subscription を返します。"""
+        subscription = Subscription(self, topic_filter, maxsize)
+        entry = self._filters.get(topic_filter)
+        if entry is None:
+            entry = self._filters[topic_filter] = {"qos": qos, "subscriptions": set()}
+            if self._connected and self._connected.is_set():
+                self.client.subscribe(topic_filter, qos)
+        entry["subscriptions"].add(subscription)
+        return subscription
+
+    def _remove_subscription(self, subscription):
+        entry = self._filters.get(subscription.topic_filter)
+        if entry is None:
+            return
+        entry["subscriptions"].discard(subscription)
+        if not entry["subscriptions"]:
+            del self._filters[subscription.topic_filter]
+            self.client.unsubscribe(subscription.topic_filter)
+
+    async def request(self, topic, payload, timeout=5.0):
+        """
+        reply_to と correlation_id を付与してリクエストを送信し、対応する応答（解析済みの辞書）を返します。
+        timeout 秒以内に応答がなければ None を返します。
+        """
+        correlation_id = new_correlation_id()
+        future = self.loop.create_future()
+        self._pending[correlation_id] = future
+        try:
+            with span(f"request {topic}") as request_span:
+                await self.publish(topic, attach_reply(payload, self.reply_topic, correlation_id))
+                try:
+                    return await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    request_span.set(timeout=True)
+                    return None
+        finally:
+            self._pending.pop(correlation_id, None)
+
+    def _on_message(self, client, userdata, msg):
+        if msg.topic == self.reply_topic:
+            data, error = parse_payload(msg.payload.decode())
+            if error:
+                return
+            future = self._pending.get(data.get("correlation_id"))
+            if future is not None and not future.done():
+                future.set_result(data)
+            return
+
+        for topic_filter, entry in self._filters.items():
+            if mqtt.topic_matches_sub(_strip_shared_prefix(topic_filter), msg.topic):
+                for subscription in entry["subscriptions"]:
+                    try:
+                        subscription.queue.put_nowait(msg)
+                    except asyncio.QueueFull:
+                        logger.warning(f"Subscription queue for {topic_filter} is full; dropping message.")
@@ -1,12 +1,28 @@
 import os
 import paho.mqtt.client as mqtt
 from .utils import logger
+from .loopback import LoopbackClient
 
-def get_mqtt_client(client_id=""):
+# 通信方式: mqtt（TCP でブローカーへ接続）/ loopback（プロセス内のメモリ上のブローカー）
+TRANSPORT_MQTT = "mqtt"
+TRANSPORT_LOOPBACK = "loopback"
+
+def get_transport():
+    """環境変数 MODT_TRANSPORT から通信方式を返します（既定は mqtt）。"""
+    return os.getenv("MODT_TRANSPORT", TRANSPORT_MQTT)
+
+def get_mqtt_client(client_id="", transport=None):
     """
     MQTTクライアントを生成します。
     プロトコルをMQTTv311に固定し、接続の安定性を高めます。
+    transport（省略時は MODT_TRANSPORT）が loopback の場合は、同じプロセス内のユニットとだけ通信する
+    LoopbackClient を返します。呼び出し方とコールバックは paho のクライアントと同じです。
     """
+    transport = transport or get_transport()
+    if transport == TRANSPORT_LOOPBACK:
+        return LoopbackClient(client_id)
+    if transport != TRANSPORT_MQTT:
+        raise ValueError(f"Unknown MODT_TRANSPORT: {transport}")
     try:
         # paho-mqtt 2.x 用の記述
         client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id, protocol=mqtt.MQTTv311)
@@ -20,6 +36,11 @@ def connect_broker(client):
     環境変数からブローカー情報を取得して接続します。
     ループの開始（loop_start/loop_forever）は各ユニット側に委ねます。
     """
+    if isinstance(client, LoopbackClient):
+        client.connect()
+        logger.info("プロセス内のブローカー（loopback）に接続しました。")
+        return
+
     host = os.getenv("MODT_BROKER_HOST", "broker")
     port_str = os.getenv("MODT_BROKER_PORT", "1883")
     
@@ -1,4 +1,15 @@
 from .topics import *
 from .utils import *
 from .core import *
-from .payloads import *
\ No newline at end of file
+from .loopback import *
+from .payloads import *
+from .rpc import *
+from .streams import *
+from .shards import *
+from .aio import *
+from .tokens import *
+from .singleflight import *
+from .sessions import *
+from .state import *
+from .metrics import *
+from .tracing import *
\ No newline at end of file
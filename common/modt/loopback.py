@@ -0,0 +1,393 @@
+import os
+import queue
+import threading
+import paho.mqtt.client as mqtt
+from .utils import logger
+
+# QoS 0 のメッセージを受信側に溜めておける件数の上限（超えた分は破棄する）
+_DEFAULT_MAX_QUEUED = int(os.getenv("MODT_LOOPBACK_MAX_QUEUED", "10000"))
+# 受信処理のスレッドを止めるための目印
+_STOP = object()
+
+
+def topic_matches(topic_filter, topic):
+    """
+    購読フィルタ（+ と # のワイルドカードを含む）がトピックに一致するかを返します。
+    MQTT の仕様どおり、先頭のワイルドカードは $ で始まるトピック（$SYS など）には一致しません。
+    """
+    if topic_filter == topic:
+        return True
+    if topic.startswith("$") and topic_filter[:1] in ("+", "#"):
+        return False
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def _split_shared(topic_filter):
+    """$share/<group>/<filter> を (group, filter) に分けます。共有サブスクリプションでなければ (None, filter) です。"""
+    if topic_filter.startswith("$share/"):
+        _, group, real_filter = topic_filter.split("/", 2)
+        return group, real_filter
+    return None, topic_filter
+
+
+def _is_wildcard(topic_filter):
+    return "+" in topic_filter or "#" in topic_filter
+
+
+class LoopbackBroker:
+    """
+    同じプロセス内の LoopbackClient どうしでメッセージを受け渡すメモリ上のブローカーです。
+
+    - ワイルドカード（+ / #）と共有サブスクリプション（$share/<group>/...、グループ内で順番に 1 つへ配送）に対応します。
+    - retain 付きのメッセージはトピックごとに最新の 1 件を保持し、後から購読したクライアントに届けます
+      （空のペイロードで削除、共有サブスクリプションには届けません）。
+    - 配送の QoS は送信側と購読側の小さい方です（2 は 1 として扱います）。QoS 1 のメッセージは必ず受信側のキューに積み、
+      QoS 0 のメッセージは受信側に max_queued 件以上溜まっていれば破棄します。
+    - ペイロードはソケットを介さず、送信時のバイト列をそのまま全購読者へ渡します。
+    """
+
+    def __init__(self, max_queued=_DEFAULT_MAX_QUEUED):
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._exact = {}     # ワイルドカードを含まないフィルタ -> {クライアント: QoS}
+        self._wildcard = {}  # ワイルドカードを含むフィルタ -> {クライアント: QoS}
+        self._shared = {}    # (グループ, フィルタ) -> {"members": {クライアント: QoS}, "next": 次に配送する順番}
+        self._retained = {}  # トピック -> (ペイロード, QoS)
+
+    def subscribe(self, client, topic_filter, qos):
+        """購読を登録し、(許可した QoS, 届けるべき retain メッセージの一覧) を返します。"""
+        qos = min(qos, 1)
+        group, real_filter = _split_shared(topic_filter)
+        with self._lock:
+            if group is not None:
+                entry = self._shared.setdefault((group, real_filter), {"members": {}, "next": 0})
+                entry["members"][client] = qos
+                return qos, []
+            table = self._wildcard if _is_wildcard(real_filter) else self._exact
+            table.setdefault(real_filter, {})[client] = qos
+            retained = [
+                (topic, payload, min(retained_qos, qos))
+                for topic, (payload, retained_qos) in self._retained.items()
+                if topic_matches(real_filter, topic)
+            ]
+        return qos, retained
+
+    def unsubscribe(self, client, topic_filter):
+        group, real_filter = _split_shared(topic_filter)
+        with self._lock:
+            if group is not None:
+                entry = self._shared.get((group, real_filter))
+                if entry is not None:
+                    entry["members"].pop(client, None)
+                    if not entry["members"]:
+                        del self._shared[(group, real_filter)]
+                return
+            table = self._wildcard if _is_wildcard(real_filter) else self._exact
+            members = table.get(real_filter)
+            if members is not None:
+                members.pop(client, None)
+                if not members:
+                    del table[real_filter]
+
+    def remove_client(self, client):
+        """クライアントのすべての購読を解除します（clean_session での切断時）。"""
+        with self._lock:
+            for table in (self._exact, self._wildcard):
+                for topic_filter in [f for f, members in table.items() if client in members]:
+                    del table[topic_filter][client]
+                    if not table[topic_filter]:
+                        del table[topic_filter]
+            for key in [k for k, entry in self._shared.items() if client in entry["members"]]:
+                del self._shared[key]["members"][client]
+                if not self._shared[key]["members"]:
+                    del self._shared[key]
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """メッセージを一致する購読者の受信キューへ積み、配送先の数を返します。"""
+        qos = min(qos, 1)
+        targets = {}
+        with self._lock:
+            if retain:
+                if payload:
+                    self._retained[topic] = (payload, qos)
+                else:
+                    self._retained.pop(topic, None)
+            # 同じクライアントの重なる購読には、大きい方の QoS で 1 回だけ届ける
+            for client, sub_qos in self._exact.get(topic, {}).items():
+                targets[client] = max(targets.get(client, 0), sub_qos)
+            for topic_filter, members in self._wildcard.items():
+                if topic_matches(topic_filter, topic):
+                    for client, sub_qos in members.items():
+                        targets[client] = max(targets.get(client, 0), sub_qos)
+            shared = []
+            for (group, topic_filter), entry in self._shared.items():
+                if topic_matches(topic_filter, topic):
+                    members = list(entry["members"].items())
+                    # 接続中のメンバーを優先し、グループ内で順番に配送する
+                    connected = [m for m in members if m[0].is_connected()] or members
+                    shared.append(connected[entry["next"] % len(connected)])
+                    entry["next"] += 1
+        for client, sub_qos in targets.items():
+            client._receive(topic, payload, min(qos, sub_qos))
+        for client, sub_qos in shared:
+            client._receive(topic, payload, min(qos, sub_qos))
+        return len(targets) + len(shared)
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_loopback_broker(name="default"):
+    """プロセス内で共有する name のブローカーを返します（初回の呼び出しで生成します）。"""
+    with _brokers_lock:
+        broker = _brokers.get(name)
+        if broker is None:
+            broker = _brokers[name] = LoopbackBroker()
+        return broker
+
+
+class LoopbackClient:
+    """
+    paho の Client と同じ呼び出し方（VERSION1 のコールバック）で LoopbackBroker に接続するクライアントです。
+    get_mqtt_client は MODT_TRANSPORT=loopback の場合にこれを返すため、ユニットのコードを変えずに
+    同じプロセス内のユニットどうしをソケットなしで接続したり、ブローカーなしでテストを実行したりできます。
+
+    - コールバックは paho と同様に loop_start() のスレッドか loop_forever() を呼んだスレッドで、受信順に 1 つずつ実行します。
+      AsyncClient からは attach_loop(loop) により、イベントループのスレッドで実行させます。
+    - connect の host / port は使わず、生成時に指定したブローカー（既定はプロセス内で共有のもの）へ接続します。
+    - clean_session=False のクライアントは、切断中も購読を残し、QoS 1 のメッセージを再接続後に届けます。
+    """
+
+    def __init__(self, client_id="", clean_session=True, userdata=None, broker=None):
+        self._client_id = client_id
+        self._clean_session = clean_session
+        self._userdata = userdata
+        self.broker = broker or get_loopback_broker()
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_unsubscribe = None
+        self._callbacks = {}  # message_callback_add で登録したフィルタ -> コールバック
+        self._connected = False
+        self._mid = 0
+        self._lock = threading.Lock()
+        self._inbox = queue.SimpleQueue()
+        self._queued = 0      # 受信キューに積まれている QoS 0 のメッセージ数
+        self._event_loop = None
+        self._thread = None
+        self._stop_requested = False
+
+    def __repr__(self):
+        return f"<LoopbackClient {self._client_id!r}>"
+
+    # --- paho 互換の設定 ---
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def message_callback_add(self, sub, callback):
+        self._callbacks[sub] = callback
+
+    def message_callback_remove(self, sub):
+        self._callbacks.pop(sub, None)
+
+    def is_connected(self):
+        return self._connected
+
+    def _next_mid(self):
+        with self._lock:
+            self._mid = self._mid % 65535 + 1
+            return self._mid
+
+    # --- 接続 ---
+
+    def connect(self, host=None, port=None, keepalive=60, *args, **kwargs):
+        self._connected = True
+        self._deliver(("connect", 0))
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self, *args, **kwargs):
+        if self._connected:
+            self._connected = False
+            if self._clean_session:
+                self.broker.remove_client(self)
+        self._deliver(("disconnect", 0))
+        return mqtt.MQTT_ERR_SUCCESS
+
+    # --- 送受信 ---
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        mid = self._next_mid()
+        info = mqtt.MQTTMessageInfo(mid)
+        if not self._connected:
+            info.rc = mqtt.MQTT_ERR_NO_CONN
+            return info
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode("ascii")
+        elif isinstance(payload, bytearray):
+            payload = bytes(payload)
+        self.broker.publish(topic, payload, qos, retain)
+        # 受信側のキューへ積んだ時点で送達済み（QoS 1 の PUBACK に相当）とする
+        info._set_as_published()
+        self._deliver(("publish", mid))
+        return info
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        """paho と同じく、トピック 1 つ・(トピック, QoS) の組・その一覧のいずれかを受け付けます。"""
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+        if isinstance(topic, tuple):
+            topics = [topic]
+        elif isinstance(topic, list):
+            topics = topic
+        else:
+            topics = [(topic, qos)]
+        mid = self._next_mid()
+        granted = []
+        retained = []
+        for topic_filter, topic_qos in topics:
+            granted_qos, messages = self.broker.subscribe(self, topic_filter, topic_qos)
+            granted.append(granted_qos)
+            retained.extend(messages)
+        self._deliver(("subscribe", mid, tuple(granted)))
+        for retained_topic, payload, retained_qos in retained:
+            self._receive(retained_topic, payload, retained_qos, retain=True)
+        return mqtt.MQTT_ERR_SUCCESS, mid
+
+    def unsubscribe(self, topic, *args, **kwargs):
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+        for topic_filter in (topic if isinstance(topic, list) else [topic]):
+            self.broker.unsubscribe(self, topic_filter)
+        mid = self._next_mid()
+        self._deliver(("unsubscribe", mid))
+        return mqtt.MQTT_ERR_SUCCESS, mid
+
+    def _receive(self, topic, payload, qos, retain=False):
+        """ブローカーから呼ばれ、メッセージを受信キューへ積みます。"""
+        if qos == 0:
+            if not self._connected:
+                return
+            if self._queued >= self.broker.max_queued:
+                logger.warning(f"Loopback client {self._client_id} is {self._queued} messages behind; dropping QoS 0 message on {topic}")
+                return
+        msg = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+        msg.payload = payload
+        msg.qos = qos
+        msg.retain = retain
+        with self._lock:
+            if qos == 0:
+                self._queued += 1
+        self._deliver(("message", msg))
+
+    # --- コールバックの実行 ---
+
+    def _deliver(self, item):
+        with self._lock:
+            loop = self._event_loop
+            if loop is None:
+                self._inbox.put(item)
+                return
+        loop.call_soon_threadsafe(self._handle, item)
+
+    def attach_loop(self, loop):
+        """以後のコールバックを asyncio のイベントループ loop のスレッドで実行させます。"""
+        with self._lock:
+            self._event_loop = loop
+            pending = []
+            while True:
+                try:
+                    pending.append(self._inbox.get_nowait())
+                except queue.Empty:
+                    break
+        for item in pending:
+            loop.call_soon_threadsafe(self._handle, item)
+
+    def _handle(self, item):
+        kind = item[0]
+        try:
+            if kind == "message":
+                msg = item[1]
+                if msg.qos == 0:
+                    with self._lock:
+                        self._queued -= 1
+                callbacks = [cb for sub, cb in list(self._callbacks.items()) if topic_matches(_split_shared(sub)[1], msg.topic)]
+                if callbacks:
+                    for callback in callbacks:
+                        callback(self, self._userdata, msg)
+                elif self.on_message is not None:
+                    self.on_message(self, self._userdata, msg)
+            elif kind == "connect":
+                if self.on_connect is not None:
+                    self.on_connect(self, self._userdata, {"session present": 0}, item[1])
+            elif kind == "publish":
+                if self.on_publish is not None:
+                    self.on_publish(self, self._userdata, item[1])
+            elif kind == "subscribe":
+                if self.on_subscribe is not None:
+                    self.on_subscribe(self, self._userdata, item[1], item[2])
+            elif kind == "unsubscribe":
+                if self.on_unsubscribe is not None:
+                    self.on_unsubscribe(self, self._userdata, item[1])
+            elif kind == "disconnect":
+                if self.on_disconnect is not None:
+                    self.on_disconnect(self, self._userdata, item[1])
+        except Exception as e:
+            # 1 件のコールバックの失敗で受信処理全体を止めない
+            logger.exception(f"Loopback client {self._client_id} callback failed: {e}")
+
+    def _run(self):
+        """受信キューのコールバックを順に実行します。disconnect() の処理後か loop_stop() で終了します。"""
+        while True:
+            item = self._inbox.get()
+            if item is _STOP:
+                # 前回の loop_stop() の目印が残っていた場合は読み飛ばす
+                if self._stop_requested:
+                    return
+                continue
+            self._handle(item)
+            if item[0] == "disconnect" and not self._connected:
+                return
+
+    def loop_start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return mqtt.MQTT_ERR_INVAL
+        self._stop_requested = False
+        self._thread = threading.Thread(target=self._run, name=f"loopback-{self._client_id}", daemon=True)
+        self._thread.start()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_stop(self, *args, **kwargs):
+        thread = self._thread
+        if thread is None:
+            return mqtt.MQTT_ERR_INVAL
+        self._stop_requested = True
+        if thread.is_alive() and thread is not threading.current_thread():
+            self._inbox.put(_STOP)
+            thread.join()
+        self._thread = None
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_forever(self, *args, **kwargs):
+        self._stop_requested = False
+        self._run()
+        return mqtt.MQTT_ERR_SUCCESS
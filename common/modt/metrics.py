@@ -0,0 +1,343 @@
+import os
+import json
+import math
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .utils import logger
+from .shards import get_base_topic
+from .payloads import create_metrics_payload
+
+# 計測結果を定期的に発行するトピックの接頭辞（modt/metrics/<client_id>）
+_METRICS_PREFIX = "modt/metrics/"
+# 集計するトピック数の上限を超えた分をまとめる名前
+OTHER_TOPICS = "(other)"
+
+
+def get_metrics_topic(client_id):
+    """クライアントの計測結果を発行するトピックを返します。"""
+    return _METRICS_PREFIX + client_id
+
+
+def normalize_topic(topic):
+    """
+    集計用にトピック名を正規化します。
+    シャード用トピックは元の modt/state/... に、クライアントごとの返信トピックは modt/+/reply に、
+    計測結果のトピックは modt/metrics/+ にまとめ、トピックの種類がクライアント数に比例して増えないようにします。
+    """
+    topic = get_base_topic(topic)
+    parts = topic.split("/")
+    if len(parts) == 3 and parts[0] == "modt":
+        if parts[2] == "reply":
+            return "modt/+/reply"
+        if parts[1] == "metrics":
+            return "modt/metrics/+"
+    return topic
+
+
+class LogHistogram:
+    """
+    値を対数スケールのバケット（境界が growth 倍ずつ増える）で数える固定サイズのヒストグラムです。
+    パーセンタイルはバケットの上端で返すため、誤差は growth 倍以内に収まります。
+    """
+
+    __slots__ = ("growth", "counts", "total", "sum", "max")
+
+    def __init__(self, growth=1.25, buckets=128):
+        self.growth = growth
+        self.counts = [0] * buckets
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def _bucket(self, value):
+        if value < 1:
+            return 0
+        return min(int(math.log(value, self.growth)) + 1, len(self.counts) - 1)
+
+    def add(self, value):
+        self.counts[self._bucket(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """q（0〜100）パーセンタイルの近似値を返します。値がなければ 0 です。"""
+        if self.total == 0:
+            return 0
+        rank = math.ceil(self.total * q / 100.0)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # 最後のバケットは上端を持たないため、観測した最大値で代用する
+                upper = self.growth ** i if i < len(self.counts) - 1 else self.max
+                return min(upper, self.max)
+        return self.max
+
+
+class _TopicMetrics:
+    __slots__ = ("received", "errors", "published", "published_bytes", "handler", "queue", "worker")
+
+    def __init__(self):
+        self.received = 0
+        self.errors = 0
+        self.published = 0
+        self.published_bytes = 0
+        # いずれもマイクロ秒単位
+        self.handler = LogHistogram()  # 受信コールバックの実行時間
+        self.queue = LogHistogram()  # ユニット内のキューで待った時間
+        self.worker = LogHistogram()  # ワーカーでの処理時間
+
+
+class Metrics:
+    """
+    MQTT クライアントのトピックごとの受信数・送信数と、処理時間の分布を集計します。
+
+    - instrument(client) で受信コールバックと publish を包み、受信数・コールバックの実行時間・送信数を自動で数えます。
+    - ワーカーへ処理を渡すユニットは observe_queue / observe_worker でキューの待ち時間と処理時間を記録します。
+    - 時間の計測は sample_rate の割合（1.0 で全件）だけ行い、件数は常に全件数えます。
+    - 結果は snapshot()（辞書）、prometheus()（Prometheus のテキスト形式）、
+      start_publisher（modt/metrics/<client_id> へ定期発行）、serve_http（スクレイプ用の HTTP）で取り出せます。
+    """
+
+    def __init__(self, client_id, sample_rate=1.0, max_topics=200):
+        self.client_id = client_id
+        self.max_topics = max_topics
+        # 乱数を使わず、every 件に 1 件を計測する
+        self._every = max(1, round(1.0 / sample_rate)) if sample_rate > 0 else 0
+        self._seen = 0
+        self._topics = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def sampled(self):
+        """この呼び出しで時間を計測するかどうかを返します。"""
+        if not self._every:
+            return False
+        self._seen += 1
+        return self._seen % self._every == 0
+
+    def _get(self, topic):
+        name = normalize_topic(topic)
+        entry = self._topics.get(name)
+        if entry is None:
+            if len(self._topics) >= self.max_topics:
+                name = OTHER_TOPICS
+            entry = self._topics.get(name)
+            if entry is None:
+                entry = self._topics[name] = _TopicMetrics()
+        return entry
+
+    def count_received(self, topic, seconds=None, error=False):
+        with self._lock:
+            entry = self._get(topic)
+            entry.received += 1
+            if error:
+                entry.errors += 1
+            if seconds is not None:
+                entry.handler.add(seconds * 1_000_000)
+
+    def count_published(self, topic, size):
+        with self._lock:
+            entry = self._get(topic)
+            entry.published += 1
+            entry.published_bytes += size
+
+    def observe_queue(self, topic, seconds):
+        with self._lock:
+            self._get(topic).queue.add(seconds * 1_000_000)
+
+    def observe_worker(self, topic, seconds, error=False):
+        with self._lock:
+            entry = self._get(topic)
+            entry.worker.add(seconds * 1_000_000)
+            if error:
+                entry.errors += 1
+
+    def wrap(self, callback):
+        """受信コールバック (client, userdata, msg) を、受信数と実行時間を記録するように包みます。"""
+        def wrapped(client, userdata, msg):
+            start = time.perf_counter() if self.sampled() else None
+            error = False
+            try:
+                return callback(client, userdata, msg)
+            except Exception:
+                error = True
+                raise
+            finally:
+                self.count_received(msg.topic, None if start is None else time.perf_counter() - start, error)
+        wrapped.__wrapped__ = callback
+        return wrapped
+
+    def instrument(self, client):
+        """
+        paho のクライアントの on_message と publish を計測用に包みます。
+        on_message を設定した後、Requester や SessionCache などが message_callback_add で
+        コールバックを登録する前に呼び出してください（以後に登録されたコールバックも計測されます）。
+        """
+        if client.on_message is not None:
+            client.on_message = self.wrap(client.on_message)
+
+        callback_add = client.message_callback_add
+        publish = client.publish
+
+        def message_callback_add(sub, callback):
+            return callback_add(sub, self.wrap(callback))
+
+        def instrumented_publish(topic, payload=None, *args, **kwargs):
+            size = len(payload) if isinstance(payload, (bytes, bytearray, str)) else 0
+            self.count_published(topic, size)
+            return publish(topic, payload, *args, **kwargs)
+
+        client.message_callback_add = message_callback_add
+        client.publish = instrumented_publish
+        return client
+
+    def snapshot(self):
+        """トピックごとの計測結果を、JSON に変換できる辞書で返します（時間はミリ秒）。"""
+        def summarize(histogram):
+            return {
+                "count": histogram.total,
+                "p50_ms": round(histogram.percentile(50) / 1000, 3),
+                "p99_ms": round(histogram.percentile(99) / 1000, 3),
+                "max_ms": round(histogram.max / 1000, 3),
+            }
+
+        with self._lock:
+            topics = {}
+            for name, entry in self._topics.items():
+                stats = {
+                    "received": entry.received,
+                    "errors": entry.errors,
+                    "published": entry.published,
+                    "published_bytes": entry.published_bytes,
+                }
+                for field in ("handler", "queue", "worker"):
+                    histogram = getattr(entry, field)
+                    if histogram.total:
+                        stats[field] = summarize(histogram)
+                topics[name] = stats
+        return {
+            "client_id": self.client_id,
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "topics": topics,
+        }
+
+    def prometheus(self):
+        """計測結果を Prometheus のテキスト形式で返します。時間は summary（秒）として出力します。"""
+        lines = []
+        counters = (
+            ("modt_messages_received_total", "received", "Messages delivered to callbacks"),
+            ("modt_handler_errors_total", "errors", "Callbacks or workers that raised"),
+            ("modt_messages_published_total", "published", "Messages published"),
+            ("modt_published_bytes_total", "published_bytes", "Payload bytes published"),
+        )
+        summaries = (
+            ("modt_handler_seconds", "handler", "Time spent in receive callbacks"),
+            ("modt_queue_seconds", "queue", "Time spent waiting in the unit's work queue"),
+            ("modt_worker_seconds", "worker", "Time spent processing in worker threads"),
+        )
+        with self._lock:
+            items = list(self._topics.items())
+            for metric, field, help_text in counters:
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} counter")
+                for name, entry in items:
+                    lines.append(f'{metric}{{client_id="{self.client_id}",topic="{name}"}} {getattr(entry, field)}')
+            for metric, field, help_text in summaries:
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} summary")
+                for name, entry in items:
+                    histogram = getattr(entry, field)
+                    if not histogram.total:
+                        continue
+                    labels = f'client_id="{self.client_id}",topic="{name}"'
+                    for q in (0.5, 0.9, 0.99):
+                        lines.append(f'{metric}{{{labels},quantile="{q}"}} {histogram.percentile(q * 100) / 1_000_000:.6f}')
+                    lines.append(f"{metric}_sum{{{labels}}} {histogram.sum / 1_000_000:.6f}")
+                    lines.append(f"{metric}_count{{{labels}}} {histogram.total}")
+        return "\n".join(lines) + "\n"
+
+    def start_publisher(self, publish, interval=10.0):
+        """
+        interval 秒ごとに snapshot() を modt/metrics/<client_id> へ発行するデーモンスレッドを開始します。
+        publish には client.publish（asyncio のクライアントでは publish_threadsafe）を渡します。
+        """
+        topic = get_metrics_topic(self.client_id)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    publish(topic, create_metrics_payload(self.snapshot()))
+                except Exception as e:
+                    logger.warning(f"Failed to publish metrics: {e}")
+
+        thread = threading.Thread(target=run, name="modt-metrics-publisher", daemon=True)
+        thread.start()
+        return thread
+
+    def serve_http(self, port, host="0.0.0.0"):
+        """
+        GET /metrics（Prometheus のテキスト形式）と GET /metrics.json（snapshot()）を返す
+        HTTP サーバーをデーモンスレッドで開始します。
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics.snapshot()).encode("utf-8"), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # スクレイプのたびにアクセスログを出さない
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="modt-metrics-http", daemon=True).start()
+        logger.info(f"Metrics endpoint listening on {host}:{port}/metrics")
+        return server
+
+
+def setup_metrics(client, client_id, publish=None):
+    """
+    環境変数の設定に従ってクライアントを計測し、Metrics を返します。計測が無効な場合は何もせず None を返します。
+
+    - MODT_METRICS_INTERVAL_SECONDS: modt/metrics/<client_id> へ発行する間隔（既定 0 = 発行しない）
+    - MODT_METRICS_PORT: スクレイプ用の HTTP ポート（未設定なら起動しない）
+    - MODT_METRICS_SAMPLE_RATE: 処理時間を計測する割合（既定 1.0）
+
+    on_message の設定後、Requester などがコールバックを登録する前に呼び出してください。
+    別スレッドから client.publish を呼べないクライアント（AsyncClient の内部の client）では、publish に
+    スレッドセーフな送信関数を渡します。
+    """
+    interval = float(os.getenv("MODT_METRICS_INTERVAL_SECONDS", "0"))
+    port = os.getenv("MODT_METRICS_PORT")
+    if interval <= 0 and not port:
+        return None
+    metrics = Metrics(client_id, sample_rate=float(os.getenv("MODT_METRICS_SAMPLE_RATE", "1.0")))
+    metrics.instrument(client)
+    if interval > 0:
+        metrics.start_publisher(publish or client.publish, interval)
+    if port:
+        metrics.serve_http(int(port))
+    return metrics
@@ -1,10 +1,19 @@
 import json
 import time
+from .tracing import trace_fields
 
-def _create_base_payload(extra_data):
-    """共通のタイムスタンプを含むペイロードの基礎を生成します。"""
+def _create_base_payload(extra_data, reply_to=None, correlation_id=None):
+    """
+    共通のタイムスタンプとトレース用のフィールド（trace_id, span_id, sent_ns）を含むペイロードの基礎を生成します。
+    reply_to / correlation_id は指定された場合のみ付与し、従来のメッセージ形式との互換性を保ちます。
+    """
     payload = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    payload.update(trace_fields())
     payload.update(extra_data)
+    if reply_to is not None:
+        payload["reply_to"] = reply_to
+    if correlation_id is not None:
+        payload["correlation_id"] = correlation_id
     return json.dumps(payload)
 
 def create_auth_success_payload(user_id, session_id, role="user"):
@@ -13,38 +22,115 @@ def create_auth_success_payload(user_id, session_id, role="user"):
 def create_app_ready_payload(app_name, redirect_url, session_id):
     return _create_base_payload({"app_name": app_name, "redirect_url": redirect_url, "session_id": session_id})
 
-def create_session_query_payload(session_id):
-    return _create_base_payload({"session_id": session_id})
+def create_session_query_payload(session_id, reply_to=None, correlation_id=None):
+    return _create_base_payload({"session_id": session_id}, reply_to, correlation_id)
 
-def create_session_info_payload(session_id, user_id=None, role=None, status="invalid"):
-    return _create_base_payload({"session_id": session_id, "user_id": user_id, "role": role, "status": status})
+def create_session_info_payload(session_id, user_id=None, role=None, status="invalid", correlation_id=None):
+    return _create_base_payload(
+        {"session_id": session_id, "user_id": user_id, "role": role, "status": status},
+        correlation_id=correlation_id
+    )
 
-def create_state_get_payload(user_id, key):
-    return _create_base_payload({"user_id": user_id, "key": key, "action": "get"})
+def create_session_revoked_payload(session_id, reason="logout"):
+    """セッションの失効（ログアウト・期限切れ）を通知するペイロードを生成します。"""
+    return _create_base_payload({"session_id": session_id, "reason": reason})
 
-def create_state_set_payload(user_id, key, value):
-    return _create_base_payload({"user_id": user_id, "key": key, "value": value, "action": "set"})
+def create_state_get_payload(user_id, key, reply_to=None, correlation_id=None):
+    return _create_base_payload({"user_id": user_id, "key": key, "action": "get"}, reply_to, correlation_id)
 
-def create_state_keys_query_payload(user_id):
-    return _create_base_payload({"user_id": user_id, "action": "list_keys"})
+def create_state_set_payload(user_id, key, value, reply_to=None, correlation_id=None):
+    return _create_base_payload({"user_id": user_id, "key": key, "value": value, "action": "set"}, reply_to, correlation_id)
 
-def create_state_keys_list_payload(user_id, keys):
-    return _create_base_payload({"user_id": user_id, "keys": keys})
+def create_state_keys_query_payload(user_id, prefix=None, start=None, end=None, cursor=None, limit=100,
+                                    with_values=False, reply_to=None, correlation_id=None):
+    """
+    キーの一覧を key 順に 1 ページ分要求するリクエストを生成します。
+    prefix（接頭辞）、start 以上 end 未満（範囲）で絞り込み、続きは前の返信の next_cursor を cursor に指定して要求します。
+    with_values が真の場合は値も合わせて返信させます。
+    """
+    extra = {"user_id": user_id, "action": "list_keys", "limit": limit, "with_values": bool(with_values)}
+    for name, value in (("prefix", prefix), ("start", start), ("end", end), ("cursor", cursor)):
+        if value is not None:
+            extra[name] = value
+    return _create_base_payload(extra, reply_to, correlation_id)
 
-def create_state_value_payload(user_id, key, value, status="valid"):
-    return _create_base_payload({"user_id": user_id, "key": key, "value": value, "status": status})
+def create_state_keys_list_payload(user_id, keys, next_cursor=None, data=None, correlation_id=None):
+    """keys/query に対する返信です。続きがある場合は next_cursor に次のページのカーソルを含めます。"""
+    extra = {"user_id": user_id, "keys": keys, "next_cursor": next_cursor}
+    if data is not None:
+        extra["data"] = data
+    return _create_base_payload(extra, correlation_id=correlation_id)
 
-def create_state_all_get_payload(user_id):
-    return _create_base_payload({"user_id": user_id, "action": "get_all"})
+def create_state_value_payload(user_id, key, value, status="valid", correlation_id=None):
+    return _create_base_payload(
+        {"user_id": user_id, "key": key, "value": value, "status": status},
+        correlation_id=correlation_id
+    )
 
-def create_state_all_value_payload(user_id, data_dict):
-    return _create_base_payload({"user_id": user_id, "data": data_dict})
+def create_state_all_get_payload(user_id, reply_to=None, correlation_id=None):
+    return _create_base_payload({"user_id": user_id, "action": "get_all"}, reply_to, correlation_id)
+
+def create_state_all_value_payload(user_id, data_dict, correlation_id=None):
+    return _create_base_payload({"user_id": user_id, "data": data_dict}, correlation_id=correlation_id)
 
 # 新設された削除用ペイロード生成関数
-def create_state_delete_payload(user_id, key):
+def create_state_delete_payload(user_id, key, reply_to=None, correlation_id=None):
     """特定のキーを削除するためのリクエストを生成します。"""
-    return _create_base_payload({"user_id": user_id, "key": key, "action": "delete"})
+    return _create_base_payload({"user_id": user_id, "key": key, "action": "delete"}, reply_to, correlation_id)
 
-def create_state_clear_payload(user_id):
+def create_state_clear_payload(user_id, reply_to=None, correlation_id=None):
     """ユーザーの全データを一括削除するためのリクエストを生成します。"""
-    return _create_base_payload({"user_id": user_id, "action": "clear_all"})
\ No newline at end of file
+    return _create_base_payload({"user_id": user_id, "action": "clear_all"}, reply_to, correlation_id)
+
+# 複数キー一括操作用のペイロード生成関数
+def create_state_mget_payload(user_id, keys, reply_to=None, correlation_id=None):
+    """複数のキーを一度に取得するためのリクエストを生成します。"""
+    return _create_base_payload({"user_id": user_id, "keys": list(keys), "action": "mget"}, reply_to, correlation_id)
+
+def create_state_mset_payload(user_id, items, reply_to=None, correlation_id=None):
+    """キーと値の辞書をまとめて保存するためのリクエストを生成します。"""
+    return _create_base_payload({"user_id": user_id, "items": dict(items), "action": "mset"}, reply_to, correlation_id)
+
+def create_state_mdelete_payload(user_id, keys, reply_to=None, correlation_id=None):
+    """複数のキーをまとめて削除するためのリクエストを生成します。"""
+    return _create_base_payload({"user_id": user_id, "keys": list(keys), "action": "mdelete"}, reply_to, correlation_id)
+
+def create_state_mvalue_payload(user_id, data_dict, missing=None, correlation_id=None):
+    """mget に対する返信です。見つからなかったキーは missing に列挙します。"""
+    return _create_base_payload(
+        {"user_id": user_id, "data": data_dict, "missing": list(missing or [])},
+        correlation_id=correlation_id
+    )
+
+# 全件取得のストリーミング用ペイロード生成関数
+def create_state_all_stream_payload(user_id, chunk_size=100, reply_to=None, correlation_id=None):
+    """全データを chunk_size 件ずつのチャンクに分けて返信させるリクエストを生成します。"""
+    return _create_base_payload(
+        {"user_id": user_id, "chunk_size": chunk_size, "action": "get_all_stream"},
+        reply_to, correlation_id
+    )
+
+def create_state_all_chunk_payload(user_id, seq, data_dict, done=False, correlation_id=None):
+    """全件取得の 1 チャンク分の返信です。seq は 0 から始まる連番で、最後のチャンクは done が True になります。"""
+    return _create_base_payload(
+        {"user_id": user_id, "seq": seq, "data": data_dict, "done": done},
+        correlation_id=correlation_id
+    )
+
+def create_state_ack_payload(user_id, action, status, rowcount=0, correlation_id=None):
+    """
+    書き込みのコミット完了通知です。status はコミットに成功すれば "ok"、失敗すれば "error" です。
+    rowcount は書き込み（置き換え・削除）の対象となった行数です。
+    """
+    return _create_base_payload(
+        {"user_id": user_id, "action": action, "status": status, "rowcount": rowcount},
+        correlation_id=correlation_id
+    )
+
+def create_monitor_stats_payload(monitor_id, snapshot):
+    """monitor ユニットのトラフィック集計（流量・ペイロードサイズ・応答時間の分布）のスナップショットです。"""
+    return _create_base_payload({"monitor_id": monitor_id, **snapshot})
+
+def create_metrics_payload(snapshot):
+    """modt.Metrics の計測結果（トピックごとの受信数・送信数・処理時間の分布）のスナップショットです。"""
+    return _create_base_payload(snapshot)
@@ -0,0 +1,140 @@
+import json
+import uuid
+import queue
+import threading
+from .utils import logger, parse_payload
+from .streams import ChunkAssembler
+from .tracing import span, current_trace, trace_fields
+
+def get_reply_topic(client_id):
+    """
+    クライアント専用の返信トピックを返します。
+    リクエストの reply_to にこのトピックを指定すると、応答は要求元だけに配送されます。
+    """
+    return f"modt/{client_id}/reply"
+
+def new_correlation_id():
+    """リクエストと応答を対応付けるための一意な ID を生成します。"""
+    return uuid.uuid4().hex
+
+def get_response_topic(request_data, default_topic):
+    """
+    応答の送信先を決定します。
+    リクエストに reply_to があればそのトピックへ、なければ従来どおり共有トピックへ送信します。
+    """
+    return request_data.get("reply_to") or default_topic
+
+def attach_reply(payload, reply_to, correlation_id):
+    """
+    生成済みのペイロード（JSON 文字列）に reply_to と correlation_id を付与します。
+    request 系のヘルパーが、任意のペイロード生成関数の結果をそのまま受け取れるようにするためのものです。
+    スパンの中で呼ばれた場合は、トレース用のフィールドもそのスパンを親とするよう付け直します。
+    """
+    data = json.loads(payload)
+    if current_trace() is not None:
+        data.update(trace_fields())
+    data["reply_to"] = reply_to
+    data["correlation_id"] = correlation_id
+    return json.dumps(data)
+
+
+class Requester:
+    """
+    スレッドで動作するユニット（Flask など）向けの、ブロッキングなリクエスト・応答ヘルパーです。
+    返信トピックに届いた応答を相関IDで待機中のスレッドへ直接受け渡すため、
+    ポーリングの間隔に関係なく、応答が届いた時点で呼び出し元が再開します。
+
+    requester = modt.Requester(client, modt.get_reply_topic(CLIENT_ID))
+    # on_connect で requester.reply_topic を購読しておくこと
+    reply = requester.request(modt.TOPIC_SESSION_QUERY, modt.create_session_query_payload(sid))
+
+    max_pending を指定すると、応答待ちのリクエストがその数に達している間は新しいリクエストを送信せずに
+    None を返します（タイムアウトと同じ扱い）。登録は応答・タイムアウトのいずれでも必ず解除されます。
+    """
+
+    def __init__(self, client, reply_topic, max_pending=None):
+        self.client = client
+        self.reply_topic = reply_topic
+        self.max_pending = max_pending
+        self.pending_requests = {}
+        self.lock = threading.Lock()
+        # 返信トピック宛てのメッセージはユニット側の on_message を経由せずここで処理する
+        client.message_callback_add(reply_topic, self._on_reply)
+
+    def _on_reply(self, client, userdata, msg):
+        data, error = parse_payload(msg.payload.decode())
+        if error:
+            return
+        with self.lock:
+            entry = self.pending_requests.get(data.get("correlation_id"))
+        # 登録のない応答（タイムアウト後に遅れて届いたものなど）は破棄する
+        if entry is None:
+            return
+        if "chunks" in entry:
+            entry["chunks"].put(data)
+        else:
+            entry["result"] = data
+            entry["event"].set()
+
+    def _register(self, entry, topic):
+        """相関IDを発行して登録します。応答待ちが上限に達している場合は登録せずに None を返します。"""
+        correlation_id = new_correlation_id()
+        with self.lock:
+            if self.max_pending is not None and len(self.pending_requests) >= self.max_pending:
+                logger.warning(f"Request to {topic} rejected: {len(self.pending_requests)} requests pending")
+                return None
+            self.pending_requests[correlation_id] = entry
+        return correlation_id
+
+    def _unregister(self, correlation_id):
+        with self.lock:
+            self.pending_requests.pop(correlation_id, None)
+
+    def request(self, topic, payload, timeout=5.0):
+        """
+        reply_to と correlation_id を付与して送信し、応答（解析済みの辞書）が届くまで待機します。
+        timeout 秒以内に応答がなければ None を返します。
+        """
+        entry = {"event": threading.Event(), "result": None}
+        correlation_id = self._register(entry, topic)
+        if correlation_id is None:
+            return None
+        try:
+            # 送信から応答を受け取るまでを 1 つのスパンとして記録する
+            with span(f"request {topic}") as request_span:
+                self.client.publish(topic, attach_reply(payload, self.reply_topic, correlation_id))
+                if entry["event"].wait(timeout):
+                    return entry["result"]
+                request_span.set(timeout=True)
+            logger.warning(f"Request to {topic} timed out after {timeout}s")
+            return None
+        finally:
+            self._unregister(correlation_id)
+
+    def request_stream(self, topic, payload, timeout=5.0):
+        """
+        チャンク分割で応答するリクエストを送信し、チャンクを連番どおりに並べ直して順に返すジェネレーターです。
+        timeout はチャンク間の待機上限で、途中で途切れた場合は警告を出して終了します。
+        ジェネレーターを最後まで消費しなかった場合も、破棄された時点で登録は解除されます。
+        """
+        entry = {"chunks": queue.Queue()}
+        correlation_id = self._register(entry, topic)
+        if correlation_id is None:
+            return
+        try:
+            self.client.publish(topic, attach_reply(payload, self.reply_topic, correlation_id))
+            assembler = ChunkAssembler()
+            while not assembler.done:
+                try:
+                    chunk = entry["chunks"].get(timeout=timeout)
+                except queue.Empty:
+                    logger.warning(f"Stream from {topic} timed out after {timeout}s")
+                    return
+                yield from assembler.add(chunk)
+        finally:
+            self._unregister(correlation_id)
+
+    def in_flight(self):
+        """応答待ちのリクエストの数を返します。"""
+        with self.lock:
+            return len(self.pending_requests)
@@ -0,0 +1,116 @@
+import time
+import threading
+from collections import OrderedDict
+from .topics import TOPIC_SESSION_QUERY, TOPIC_SESSION_REVOKED
+from .payloads import create_session_query_payload
+from .utils import logger, parse_payload
+from .tokens import get_session_from_token
+from .singleflight import SingleFlight
+
+
+class SessionCache:
+    """
+    スレッドで動作するユニット向けの、セッション検証結果のキャッシュです。
+
+    - 署名付きトークンが正しければネットワークを介さずに認証します。
+    - トークンがない場合は Requester でセッション照会を行い、有効な結果を ttl 秒キャッシュします。
+      同じセッションへの同時の照会は SingleFlight で 1 回にまとめます。
+    - identify-unit が modt/session/revoked を発行すると該当セッションのキャッシュを破棄し、
+      以後はトークンが有効期限内でも拒否します。
+
+    sessions = modt.SessionCache(requester)
+    # on_connect で modt.TOPIC_SESSION_REVOKED を購読しておくこと
+    info = sessions.verify(session_id, token=request.cookies.get(modt.SESSION_TOKEN_COOKIE))
+    """
+
+    def __init__(self, requester, ttl=30.0, max_entries=10000, revoked_ttl=86400.0, max_revoked=100000, query_timeout=5.0):
+        self.requester = requester
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self.revoked_ttl = float(revoked_ttl)
+        self.max_revoked = int(max_revoked)
+        self.query_timeout = query_timeout
+        self._entries = OrderedDict()  # session_id -> (session/info の辞書, 期限の monotonic 時刻)
+        self._revoked = OrderedDict()  # session_id -> 記録を破棄する monotonic 時刻
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._stats = {"hits": 0, "misses": 0, "token_hits": 0, "revocations": 0}
+        requester.client.message_callback_add(TOPIC_SESSION_REVOKED, self._on_revoked)
+
+    def verify(self, session_id, token=None):
+        """
+        セッションが有効であれば session/info と同じ形の辞書（status は "valid"）を返します。
+        無効・失効済み・照会のタイムアウトの場合は None を返します。
+        """
+        if not session_id or self.is_revoked(session_id):
+            return None
+
+        info = get_session_from_token(token, session_id) if token else None
+        if info is not None:
+            with self._lock:
+                self._stats["token_hits"] += 1
+            return info
+
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(session_id)
+                    self._stats["hits"] += 1
+                    return entry[0]
+                del self._entries[session_id]
+            self._stats["misses"] += 1
+
+        return self._flight.do(session_id, self._query, session_id)
+
+    def _query(self, session_id):
+        reply = self.requester.request(
+            TOPIC_SESSION_QUERY,
+            create_session_query_payload(session_id),
+            timeout=self.query_timeout
+        )
+        if not (reply and reply.get("status") == "valid" and reply.get("user_id")):
+            return None
+        with self._lock:
+            # 照会中に失効通知が届いていれば結果を採用しない
+            if session_id in self._revoked:
+                return None
+            self._entries[session_id] = (reply, time.monotonic() + self.ttl)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return reply
+
+    def is_revoked(self, session_id):
+        with self._lock:
+            expires_at = self._revoked.get(session_id)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._revoked[session_id]
+                return False
+            return True
+
+    def revoke(self, session_id):
+        """セッションを失効済みとして記録し、キャッシュから削除します。"""
+        with self._lock:
+            self._entries.pop(session_id, None)
+            self._revoked[session_id] = time.monotonic() + self.revoked_ttl
+            self._revoked.move_to_end(session_id)
+            while len(self._revoked) > self.max_revoked:
+                self._revoked.popitem(last=False)
+            self._stats["revocations"] += 1
+
+    def _on_revoked(self, client, userdata, msg):
+        data, error = parse_payload(msg.payload.decode())
+        if error or not data.get("session_id"):
+            return
+        self.revoke(data["session_id"])
+        logger.info(f"Session revoked ({data.get('reason')}): {data['session_id']}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["revoked"] = len(self._revoked)
+        return stats
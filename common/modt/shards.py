@@ -0,0 +1,39 @@
+import os
+import hashlib
+
+# シャード化されたトピックの接頭辞（例: modt/shard/2/state/get）
+_SHARD_PREFIX = "modt/shard/"
+
+def get_shard_count():
+    """環境変数 MODT_STATE_SHARDS から状態管理のシャード数を取得します（既定は 1 = シャードなし）。"""
+    return max(1, int(os.getenv("MODT_STATE_SHARDS", "1")))
+
+def get_shard(user_id, shard_count=None):
+    """
+    user_id が属するシャード番号を返します。
+    全ユニットで同じ結果になるよう、プロセスごとに値が変わる hash() ではなく blake2b を使います。
+    """
+    shard_count = shard_count or get_shard_count()
+    digest = hashlib.blake2b(str(user_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+def get_shard_topic(base_topic, shard):
+    """modt/state/... のトピックを指定シャード用のトピックに変換します。"""
+    return _SHARD_PREFIX + str(shard) + "/" + base_topic[len("modt/"):]
+
+def get_state_topic(base_topic, user_id, shard_count=None):
+    """
+    状態管理リクエストの送信先トピックを返します。
+    シャード数が 1 の場合は base_topic をそのまま返すため、従来の構成と互換性があります。
+    """
+    shard_count = shard_count or get_shard_count()
+    if shard_count <= 1:
+        return base_topic
+    return get_shard_topic(base_topic, get_shard(user_id, shard_count))
+
+def get_base_topic(topic):
+    """シャード用のトピックを元の modt/state/... 形式に戻します。それ以外はそのまま返します。"""
+    if topic.startswith(_SHARD_PREFIX):
+        _, _, rest = topic[len(_SHARD_PREFIX):].partition("/")
+        return "modt/" + rest
+    return topic
@@ -0,0 +1,73 @@
+import threading
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class TooManyInFlight(Exception):
+    """実行中のキーの数が上限に達しているため、新しいキーの処理を開始できなかったことを示します。"""
+
+
+class SingleFlight:
+    """
+    同じキーに対する同時の処理を 1 回にまとめます（スレッド用）。
+    最初の呼び出し元だけが fn を実行し、実行中に同じキーで呼び出したスレッドはその結果を共有します。
+    結果は保持しないため、処理が終わった後の呼び出しでは改めて fn が実行されます。
+    max_in_flight を指定すると、実行中のキーがその数に達している間は新しいキーの呼び出しで TooManyInFlight を送出します
+    （実行中のキーへの合流は常に受け付けます）。
+    """
+
+    def __init__(self, max_in_flight=None):
+        self.max_in_flight = max_in_flight
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        """fn(*args) の結果を返します。fn が例外を送出した場合は、待機していた呼び出し元にも同じ例外を送出します。"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                if self.max_in_flight is not None and len(self._calls) >= self.max_in_flight:
+                    raise TooManyInFlight(f"{len(self._calls)} calls already in flight")
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                # forget で切り離された後に同じキーで新しい呼び出しが始まっていれば、そちらは残す
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.event.set()
+
+    def forget(self, predicate):
+        """
+        predicate(key) が真になる実行中の呼び出しを切り離します。
+        実行中の fn はそのまま完了して待機中の呼び出し元に結果を返しますが、以後の呼び出しは合流せずに fn を改めて実行します。
+        書き込みの後に、書き込み前に始まった読み込みの結果を共有させないために使います。
+        """
+        with self._lock:
+            for key in [key for key in self._calls if predicate(key)]:
+                del self._calls[key]
+
+    def in_flight(self):
+        """実行中のキーの数を返します。"""
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,56 @@
+from .topics import (
+    TOPIC_STATE_KEYS_QUERY, TOPIC_STATE_SET, TOPIC_STATE_DELETE, TOPIC_STATE_CLEAR, TOPIC_STATE_MSET, TOPIC_STATE_MDELETE
+)
+from .payloads import (
+    create_state_keys_query_payload, create_state_set_payload, create_state_delete_payload, create_state_clear_payload,
+    create_state_mset_payload, create_state_mdelete_payload
+)
+from .shards import get_state_topic
+
+
+class StateClient:
+    """
+    db-unit への書き込みを行い、コミット完了通知（ack）を待って返すクライアントです（スレッド用）。
+    各メソッドは ack（"status" が "ok" / "error"、"rowcount" が対象行数の辞書）を返し、
+    timeout 秒以内に ack が届かなければ None を返します。
+
+    state = modt.StateClient(requester)
+    ack = state.set(user_id, "theme", "dark")
+    if ack and ack["status"] == "ok": ...
+
+    キー一覧のページ単位の取得（keys）も同じ Requester で行います。
+    """
+
+    def __init__(self, requester, timeout=5.0):
+        self.requester = requester
+        self.timeout = timeout
+
+    def _request(self, topic, user_id, payload, timeout):
+        return self.requester.request(
+            get_state_topic(topic, user_id),
+            payload,
+            timeout=self.timeout if timeout is None else timeout
+        )
+
+    def set(self, user_id, key, value, timeout=None):
+        return self._request(TOPIC_STATE_SET, user_id, create_state_set_payload(user_id, key, value), timeout)
+
+    def delete(self, user_id, key, timeout=None):
+        return self._request(TOPIC_STATE_DELETE, user_id, create_state_delete_payload(user_id, key), timeout)
+
+    def clear(self, user_id, timeout=None):
+        return self._request(TOPIC_STATE_CLEAR, user_id, create_state_clear_payload(user_id), timeout)
+
+    def mset(self, user_id, items, timeout=None):
+        return self._request(TOPIC_STATE_MSET, user_id, create_state_mset_payload(user_id, items), timeout)
+
+    def mdelete(self, user_id, keys, timeout=None):
+        return self._request(TOPIC_STATE_MDELETE, user_id, create_state_mdelete_payload(user_id, keys), timeout)
+
+    def keys(self, user_id, prefix=None, start=None, end=None, cursor=None, limit=100, with_values=False, timeout=None):
+        """
+        キーの一覧を 1 ページ分取得し、keys/list の返信（"keys"、"next_cursor"、with_values が真なら "data"）を返します。
+        次のページは返信の next_cursor を cursor に指定して取得します。タイムアウトした場合は None を返します。
+        """
+        payload = create_state_keys_query_payload(user_id, prefix, start, end, cursor, limit, with_values)
+        return self._request(TOPIC_STATE_KEYS_QUERY, user_id, payload, timeout)
@@ -0,0 +1,32 @@
+class ChunkAssembler:
+    """
+    seq 付きで分割送信されたチャンクを受信順に関係なく連番どおりに並べ直します。
+    add() は新たに順番がそろったチャンクを返すため、先頭から逐次処理することも、
+    done になった後に data から全体をまとめて取り出すこともできます。
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.done = False
+        self._next_seq = 0
+        self._buffer = {}
+
+    def add(self, chunk):
+        """受信したチャンク（解析済みの辞書）を追加し、順番がそろったチャンクのリストを返します。"""
+        seq = chunk.get("seq")
+        if self.done or not isinstance(seq, int) or seq < self._next_seq:
+            # 終了後や重複したチャンクは無視する
+            return []
+        self._buffer[seq] = chunk
+
+        ready = []
+        while self._next_seq in self._buffer:
+            current = self._buffer.pop(self._next_seq)
+            self._next_seq += 1
+            self.data.update(current.get("data") or {})
+            ready.append(current)
+            if current.get("done"):
+                self.done = True
+                self._buffer.clear()
+                break
+        return ready
@@ -0,0 +1,79 @@
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+
+# セッショントークンを保存する Cookie の名前
+SESSION_TOKEN_COOKIE = "modt_session_token"
+
+
+def get_session_secret():
+    """トークンの署名鍵（環境変数 MODT_SESSION_SECRET）を返します。未設定の場合は None です。"""
+    secret = os.getenv("MODT_SESSION_SECRET")
+    return secret or None
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(body, secret):
+    return hmac.new(secret.encode("utf-8"), body.encode("ascii"), hashlib.sha256).digest()
+
+
+def create_session_token(session_id, user_id, role, ttl, secret=None):
+    """
+    セッションID・ユーザーID・ロール・有効期限を含む、HMAC-SHA256 で署名されたトークンを生成します。
+    形式は「base64url(JSON).base64url(署名)」です。
+    """
+    secret = secret or get_session_secret()
+    if not secret:
+        raise ValueError("MODT_SESSION_SECRET is not set")
+    claims = {"sid": session_id, "uid": user_id, "role": role, "exp": int(time.time() + ttl)}
+    body = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    return f"{body}.{_b64encode(_sign(body, secret))}"
+
+
+def verify_session_token(token, secret=None):
+    """
+    トークンの署名と有効期限を検証し、正しければ
+    {"session_id", "user_id", "role", "expires_at"} の辞書を、そうでなければ None を返します。
+    ネットワークを介さずに検証できるため、各ユニットはリクエストごとの身分照会を省略できます。
+    """
+    secret = secret or get_session_secret()
+    if not token or not secret:
+        return None
+    try:
+        body, signature = token.split(".", 1)
+        if not hmac.compare_digest(_b64decode(signature), _sign(body, secret)):
+            return None
+        claims = json.loads(_b64decode(body))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(claims, dict) or not isinstance(claims.get("exp"), int):
+        return None
+    if claims["exp"] <= time.time():
+        return None
+    return {
+        "session_id": claims.get("sid"),
+        "user_id": claims.get("uid"),
+        "role": claims.get("role"),
+        "expires_at": claims["exp"],
+    }
+
+
+def get_session_from_token(token, session_id, secret=None):
+    """
+    トークンが session_id のセッションに対して正しく発行されたものであれば、
+    session/info の応答と同じ形の辞書（status は "valid"）を返します。そうでなければ None を返します。
+    """
+    claims = verify_session_token(token, secret)
+    if claims is None or claims["session_id"] != session_id:
+        return None
+    return {"session_id": session_id, "user_id": claims["user_id"], "role": claims["role"], "status": "valid"}
@@ -3,6 +3,7 @@ TOPIC_AUTH_SUCCESS = "modt/auth/success"
 TOPIC_APP_READY = "modt/app/ready"
 TOPIC_SESSION_QUERY = "modt/session/query"
 TOPIC_SESSION_INFO = "modt/session/info"
+TOPIC_SESSION_REVOKED = "modt/session/revoked"
 
 # 状態管理（KVストア操作）用のトピック
 TOPIC_STATE_GET = "modt/state/get"
@@ -17,4 +18,19 @@ TOPIC_STATE_ALL_VAL = "modt/state/all/value"
 
 # 削除機能用の新設トピック
 TOPIC_STATE_DELETE = "modt/state/delete"
-TOPIC_STATE_CLEAR = "modt/state/clear"
\ No newline at end of file
+TOPIC_STATE_CLEAR = "modt/state/clear"
+
+# 複数キー一括操作用のトピック
+TOPIC_STATE_MGET = "modt/state/mget"
+TOPIC_STATE_MSET = "modt/state/mset"
+TOPIC_STATE_MDELETE = "modt/state/mdelete"
+TOPIC_STATE_MVAL = "modt/state/mvalue"
+
+# 全件取得を分割（チャンク）して受け取るためのトピック
+TOPIC_STATE_ALL_STREAM = "modt/state/all/stream"
+TOPIC_STATE_ALL_CHUNK = "modt/state/all/chunk"
+
+# 書き込み（set / delete / clear / mset / mdelete）のコミット完了通知
+TOPIC_STATE_ACK = "modt/state/ack"
+# monitor ユニットが定期的に発行するトラフィック集計のスナップショット
+TOPIC_MONITOR_STATS = "modt/monitor/stats"
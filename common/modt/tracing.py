@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import socket
+import atexit
+import threading
+import contextvars
+from collections import deque
+
+# 実行中のスパンの (trace_id, span_id)。スレッド・asyncio のタスクごとに独立して保持される
+_current = contextvars.ContextVar("modt_trace", default=None)
+# スパンの記録先を環境変数から決める前を表す値
+_UNSET = object()
+_sink = _UNSET
+_sink_lock = threading.Lock()
+# JsonlSink がファイルへ書き出す間隔（秒）
+_FLUSH_INTERVAL = 1.0
+_HOST = socket.gethostname()
+
+
+def new_trace_id():
+    """新しいトレース ID を生成します。"""
+    return os.urandom(8).hex()
+
+
+def _new_span_id():
+    return os.urandom(4).hex()
+
+
+def current_trace():
+    """実行中のスパンの {"trace_id", "span_id"} を返します。スパンの外では None です。"""
+    context = _current.get()
+    if context is None:
+        return None
+    return {"trace_id": context[0], "span_id": context[1]}
+
+
+def trace_fields():
+    """
+    ペイロードに含めるトレース用のフィールドを返します。
+    スパンの中では実行中のトレース ID と親にするスパン ID を、外では新しいトレース ID を返し、
+    いずれも送信時刻 sent_ns（time.monotonic_ns）を付けます。
+    """
+    context = _current.get()
+    if context is None:
+        fields = {"trace_id": new_trace_id()}
+    else:
+        fields = {"trace_id": context[0], "span_id": context[1]}
+    fields["sent_ns"] = time.monotonic_ns()
+    return fields
+
+
+class MemorySink:
+    """記録したスパンを直近の max_spans 件までメモリに保持します（テストやベンチマーク用）。"""
+
+    def __init__(self, max_spans=10000):
+        self._spans = deque(maxlen=max_spans)
+
+    def record(self, span_record):
+        self._spans.append(span_record)
+
+    def spans(self, trace_id=None):
+        """保持しているスパンを返します。trace_id を指定するとそのトレースのものだけを返します。"""
+        spans = list(self._spans)
+        if trace_id is None:
+            return spans
+        return [record for record in spans if record["trace_id"] == trace_id]
+
+    def clear(self):
+        self._spans.clear()
+
+
+class JsonlSink:
+    """
+    スパンを 1 件 1 行の JSON としてファイルへ追記します。
+    書き込みはバッファを介して行い、_FLUSH_INTERVAL 秒ごとと終了時にだけファイルへ書き出します。
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        atexit.register(self.close)
+
+    def record(self, span_record):
+        line = json.dumps(span_record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line)
+            now = time.monotonic()
+            if now - self._last_flush >= _FLUSH_INTERVAL:
+                self._file.flush()
+                self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def set_span_sink(sink):
+    """スパンの記録先（record(span_record) を持つオブジェクト）を設定します。None で記録を止めます。"""
+    global _sink
+    with _sink_lock:
+        _sink = sink
+
+
+def get_span_sink():
+    """
+    スパンの記録先を返します。set_span_sink で設定されていなければ、初回の呼び出し時に
+    環境変数 MODT_TRACE_DIR（未設定なら記録しない）の下に spans-<ホスト名>-<PID>.jsonl を作成します。
+    """
+    global _sink
+    if _sink is _UNSET:
+        with _sink_lock:
+            if _sink is _UNSET:
+                directory = os.getenv("MODT_TRACE_DIR")
+                _sink = JsonlSink(os.path.join(directory, f"spans-{_HOST}-{os.getpid()}.jsonl")) if directory else None
+    return _sink
+
+
+class Span:
+    """
+    処理の所要時間を 1 件のスパンとして記録するコンテキストマネージャーです。
+    with の中で生成したペイロードには、このスパンのトレース ID と（親としての）スパン ID が入ります。
+    記録先が設定されていない場合は、トレースの受け渡しだけを行い何も記録しません。
+    """
+
+    __slots__ = ("name", "trace_id", "parent_id", "span_id", "attrs", "_token", "_start_ns", "_start")
+
+    def __init__(self, name, trace_id=None, parent_id=None, **attrs):
+        self.name = name
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = None
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """スパンに記録する属性を追加します。"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        if self.trace_id is None:
+            context = _current.get()
+            if context is None:
+                self.trace_id = new_trace_id()
+            else:
+                self.trace_id, self.parent_id = context
+        self.span_id = _new_span_id()
+        self._token = _current.set((self.trace_id, self.span_id))
+        self._start_ns = time.time_ns()
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration_ns = time.perf_counter_ns() - self._start
+        _current.reset(self._token)
+        sink = get_span_sink()
+        if sink is not None:
+            record = {
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "name": self.name,
+                "start_ns": self._start_ns,
+                "duration_us": duration_ns / 1000,
+                "host": _HOST,
+                "pid": os.getpid(),
+            }
+            if exc_type is not None:
+                record["error"] = exc_type.__name__
+            if self.attrs:
+                record["attrs"] = self.attrs
+            try:
+                sink.record(record)
+            except Exception:
+                pass
+        return False
+
+
+def span(name, **attrs):
+    """実行中のトレースの子スパン（スパンの外では新しいトレース）を開始します。"""
+    return Span(name, **attrs)
+
+
+def continue_trace(data, name, **attrs):
+    """
+    受信したペイロード（解析済みの辞書）のトレースを引き継いでスパンを開始します。
+    送信側のスパンを親とし、sent_ns があれば送信から受信までの時間を transit_us として記録します。
+    トレース ID を持たない（従来形式の）メッセージでは新しいトレースを始めます。
+    """
+    trace_id = parent_id = None
+    if isinstance(data, dict):
+        trace_id = data.get("trace_id")
+        if trace_id is not None:
+            parent_id = data.get("span_id")
+        sent_ns = data.get("sent_ns")
+        # 送信時刻は同じホスト上でのみ比較できるため、負になる（別ホストからの）値は使わない
+        if isinstance(sent_ns, int):
+            transit_ns = time.monotonic_ns() - sent_ns
+            if transit_ns >= 0:
+                attrs["transit_us"] = transit_ns / 1000
+    return Span(name, trace_id, parent_id, **attrs)
+
+
+def bind_trace(fn):
+    """
+    呼び出し時点のトレースを引き継いで fn を実行する関数を返します。
+    コミット完了通知のように、別スレッドで後から呼ばれるコールバックを同じトレースに含めるためのものです。
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def load_spans(paths):
+    """JsonlSink が書き出したファイル（またはそれを含むディレクトリ）からスパンを読み込みます。"""
+    spans = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".jsonl"))
+        else:
+            files = [path]
+        for file_path in files:
+            with open(file_path, encoding="utf-8") as f:
+                for line in f:
+                    # 書き込み途中の末尾の行などは読み飛ばす
+                    try:
+                        spans.append(json.loads(line))
+                    except ValueError:
+                        continue
+    return spans
+
+
+def build_waterfall(spans, trace_id):
+    """
+    1 つのトレースのスパンを親子関係の順に並べ、行ごとに
+    {"depth", "name", "offset_ms"（トレース開始からの経過）, "duration_ms", "span"} を返します。
+    親が見つからないスパン（スパンの外から送信されたメッセージを受けたものなど）は最上位に置きます。
+    """
+    spans = sorted((s for s in spans if s.get("trace_id") == trace_id), key=lambda s: s["start_ns"])
+    if not spans:
+        return []
+    origin = spans[0]["start_ns"]
+    span_ids = {s["span_id"] for s in spans}
+    children = {}
+    roots = []
+    for s in spans:
+        if s.get("parent_id") in span_ids:
+            children.setdefault(s["parent_id"], []).append(s)
+        else:
+            roots.append(s)
+
+    rows = []
+    stack = [(s, 0) for s in reversed(roots)]
+    while stack:
+        s, depth = stack.pop()
+        rows.append({
+            "depth": depth,
+            "name": s["name"],
+            "offset_ms": (s["start_ns"] - origin) / 1_000_000,
+            "duration_ms": s["duration_us"] / 1000,
+            "span": s,
+        })
+        stack.extend((child, depth + 1) for child in reversed(children.get(s["span_id"], [])))
+    return rows
+
+
+def format_waterfall(rows, width=40):
+    """build_waterfall の結果を、開始位置と所要時間を棒で表したテキストにします。"""
+    if not rows:
+        return "(no spans)"
+    total = max(row["offset_ms"] + row["duration_ms"] for row in rows) or 1.0
+    label_width = max(len(row["name"]) + row["depth"] * 2 for row in rows)
+    lines = []
+    for row in rows:
+        start = int(row["offset_ms"] / total * width)
+        length = max(1, int(row["duration_ms"] / total * width))
+        bar = " " * start + "#" * min(length, width - start)
+        label = "  " * row["depth"] + row["name"]
+        extra = ""
+        transit = row["span"].get("attrs", {}).get("transit_us")
+        if transit is not None:
+            extra += f" transit={transit / 1000:.3f}ms"
+        if "error" in row["span"]:
+            extra += f" error={row['span']['error']}"
+        lines.append(f"{row['offset_ms']:9.3f}ms {row['duration_ms']:9.3f}ms  {label:<{label_width}}  |{bar:<{width}}|{extra}")
+    return "\n".join(lines)
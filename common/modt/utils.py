@@ -1,8 +1,12 @@
+import os
 import logging
 import json
 
-# ログの設定
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# ログの設定（MODT_LOG_LEVEL=WARNING などで、メッセージごとの INFO ログを止められる）
+logging.basicConfig(
+    level=os.getenv("MODT_LOG_LEVEL", "INFO").upper(),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
 logger = logging.getLogger("modt_lib")
 
 def parse_payload(payload_str):
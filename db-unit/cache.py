@@ -0,0 +1,189 @@
+import time
+import threading
+from collections import OrderedDict
+
+# 1 エントリあたりの辞書・キー文字列などの管理コストの概算（バイト）
+ENTRY_OVERHEAD = 64
+
+
+class _UserEntry:
+    """1 ユーザー分のキャッシュ。complete が True なら values がそのユーザーの全データです。"""
+
+    __slots__ = ("values", "sizes", "missing", "complete", "size", "expires_at")
+
+    def __init__(self, expires_at):
+        self.values = {}
+        self.sizes = {}
+        self.missing = set()
+        self.complete = False
+        self.size = ENTRY_OVERHEAD
+        self.expires_at = expires_at
+
+
+class StateCache:
+    """
+    デコード済みの値を保持する、ユーザー単位の LRU/TTL キャッシュです。
+    (user_id, key) 単位の値と、all/get 用のユーザー全データの両方をユーザーごとのエントリで管理し、
+    推定メモリ使用量が max_bytes を超えると最も古く参照されたユーザーから追い出します。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300.0):
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+        self._users = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    # --- 参照 ---
+
+    def get(self, user_id, key):
+        """(ヒットしたかどうか, 値が存在するかどうか, 値) を返します。"""
+        with self._lock:
+            entry = self._lookup(user_id)
+            if entry is not None:
+                if key in entry.values:
+                    self._stats["hits"] += 1
+                    return True, True, entry.values[key]
+                if entry.complete or key in entry.missing:
+                    self._stats["hits"] += 1
+                    return True, False, None
+            self._stats["misses"] += 1
+            return False, False, None
+
+    def get_all(self, user_id):
+        """ユーザーの全データがキャッシュされていればその複製を、なければ None を返します。"""
+        with self._lock:
+            entry = self._lookup(user_id)
+            if entry is not None and entry.complete:
+                self._stats["hits"] += 1
+                return dict(entry.values)
+            self._stats["misses"] += 1
+            return None
+
+    def _lookup(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(user_id)
+            self._stats["expirations"] += 1
+            return None
+        self._users.move_to_end(user_id)
+        return entry
+
+    # --- 読み込み結果の登録 ---
+
+    def put(self, user_id, key, value, size):
+        """SQLite から読み込んだ単一キーの値を登録します。"""
+        with self._lock:
+            entry = self._entry_for_update(user_id, create=True)
+            self._store_value(entry, key, value, size)
+            self._enforce_limit()
+
+    def put_missing(self, user_id, key):
+        """存在しないことが確認されたキーを記録します（ネガティブキャッシュ）。"""
+        with self._lock:
+            entry = self._entry_for_update(user_id, create=True)
+            if key not in entry.missing:
+                entry.missing.add(key)
+                self._resize(entry, len(key) + ENTRY_OVERHEAD)
+            self._enforce_limit()
+
+    def put_all(self, user_id, values, sizes):
+        """SQLite から読み込んだユーザーの全データを登録します。"""
+        with self._lock:
+            self._remove(user_id)
+            entry = self._entry_for_update(user_id, create=True)
+            for key, value in values.items():
+                self._store_value(entry, key, value, sizes[key])
+            entry.complete = True
+            if entry.size > self.max_bytes:
+                # 単独で上限を超えるユーザーのために他のエントリを追い出すことはしない
+                self._remove(user_id)
+                return
+            self._enforce_limit()
+
+    # --- 書き込みスルー ---
+
+    def on_set(self, user_id, key, value, size):
+        """書き込まれた値で既存のエントリを更新します（未キャッシュのユーザーは登録しません）。"""
+        with self._lock:
+            entry = self._entry_for_update(user_id)
+            if entry is not None:
+                self._store_value(entry, key, value, size)
+                self._enforce_limit()
+
+    def on_delete(self, user_id, key):
+        with self._lock:
+            entry = self._entry_for_update(user_id)
+            if entry is not None:
+                self._drop_value(entry, key)
+                if not entry.complete and key not in entry.missing:
+                    entry.missing.add(key)
+                    self._resize(entry, len(key) + ENTRY_OVERHEAD)
+
+    def on_clear(self, user_id):
+        """全削除後のユーザーは「全データが空」と確定しているため、空の完全なエントリに置き換えます。"""
+        with self._lock:
+            if self._remove(user_id):
+                entry = self._entry_for_update(user_id, create=True)
+                entry.complete = True
+
+    def invalidate_all(self):
+        """コミットの失敗などで SQLite との整合性が保証できなくなった場合に全エントリを破棄します。"""
+        with self._lock:
+            self._users.clear()
+            self._bytes = 0
+
+    # --- 内部処理（ロック取得済みで呼び出す） ---
+
+    def _entry_for_update(self, user_id, create=False):
+        entry = self._lookup(user_id)
+        if entry is None and create:
+            entry = _UserEntry(time.monotonic() + self.ttl)
+            self._users[user_id] = entry
+            self._bytes += entry.size
+        return entry
+
+    def _store_value(self, entry, key, value, size):
+        self._drop_value(entry, key)
+        if key in entry.missing:
+            entry.missing.discard(key)
+            self._resize(entry, -(len(key) + ENTRY_OVERHEAD))
+        size += len(key) + ENTRY_OVERHEAD
+        entry.values[key] = value
+        entry.sizes[key] = size
+        self._resize(entry, size)
+
+    def _drop_value(self, entry, key):
+        if key in entry.values:
+            del entry.values[key]
+            self._resize(entry, -entry.sizes.pop(key))
+
+    def _resize(self, entry, delta):
+        entry.size += delta
+        self._bytes += delta
+
+    def _remove(self, user_id):
+        entry = self._users.pop(user_id, None)
+        if entry is None:
+            return False
+        self._bytes -= entry.size
+        return True
+
+    def _enforce_limit(self):
+        while self._bytes > self.max_bytes and self._users:
+            _, entry = self._users.popitem(last=False)
+            self._bytes -= entry.size
+            self._stats["evictions"] += 1
+
+    def stats(self):
+        """ヒット・ミス・追い出し件数と現在の使用量を返します。"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["users"] = len(self._users)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,83 @@
+import json
+import math
+import zlib
+
+# 型タグ（states.vtype に保存される 1 文字）
+TAG_NULL = "n"
+TAG_BOOL = "b"
+TAG_INT = "i"
+TAG_FLOAT = "f"
+TAG_STR = "s"
+TAG_JSON = "j"       # コンパクトな JSON の UTF-8 バイト列
+TAG_JSON_ZLIB = "z"  # 上記を zlib で圧縮したバイト列
+
+# この長さ以上の構造化データは圧縮を試みる（小さなデータは圧縮の効果より伸長のコストが大きい）
+COMPRESS_THRESHOLD = 512
+
+# SQLite の INTEGER に格納できる範囲
+_INT_MIN = -(2 ** 63)
+_INT_MAX = 2 ** 63 - 1
+
+
+def _encode_json(value):
+    raw = json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    if len(raw) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(raw)
+        if len(compressed) < len(raw):
+            return TAG_JSON_ZLIB, compressed
+    return TAG_JSON, raw
+
+
+def encode(value):
+    """値を (型タグ, SQLite に保存する値) に変換します。"""
+    if value is None:
+        return TAG_NULL, None
+    # bool は int のサブクラスなので先に判定する
+    if isinstance(value, bool):
+        return TAG_BOOL, int(value)
+    if isinstance(value, int):
+        if _INT_MIN <= value <= _INT_MAX:
+            return TAG_INT, value
+        return _encode_json(value)
+    if isinstance(value, float):
+        # SQLite は NaN を NULL として保存してしまうため、有限でない値は JSON で保存する
+        if math.isfinite(value):
+            return TAG_FLOAT, value
+        return _encode_json(value)
+    if isinstance(value, str):
+        return TAG_STR, value
+    return _encode_json(value)
+
+
+_DECODERS = {
+    TAG_NULL: lambda stored: None,
+    TAG_BOOL: lambda stored: bool(stored),
+    TAG_INT: lambda stored: stored,
+    TAG_FLOAT: lambda stored: stored,
+    TAG_STR: lambda stored: stored,
+    TAG_JSON: lambda stored: json.loads(stored),
+    TAG_JSON_ZLIB: lambda stored: json.loads(zlib.decompress(stored)),
+}
+
+
+def decode(tag, stored):
+    """型タグに従って保存値を復元します。"""
+    return _DECODERS[tag](stored)
+
+
+def stored_size(stored):
+    """キャッシュのメモリ見積もりに使う、保存値のおおよそのバイト数を返します。"""
+    if isinstance(stored, (str, bytes)):
+        return len(stored)
+    return 8
+
+
+def decode_legacy(raw):
+    """
+    型タグ導入前の形式（TEXT 列に json.dumps または str() した値）を、
+    当時の読み込み処理と同じ規則で復元します。移行処理でのみ使用します。
+    """
+    try:
+        return json.loads(raw)
+    except (TypeError, ValueError):
+        return raw
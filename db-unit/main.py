@@ -1,113 +1,284 @@
-import sqlite3
-import json
 import os
-import time
+import uuid
+import signal
 from common import modt
+from store import StateStore, shard_db_path
+from cache import StateCache
+from workers import ShardedDispatcher
 
-def init_db(db_path="/app/data/modt_state.db"):
-    db_dir = os.path.dirname(db_path)
-    if db_dir and not os.path.exists(db_dir):
-        os.makedirs(db_dir, exist_ok=True)
-        
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS states (
-            user_id TEXT,
-            key TEXT,
-            value TEXT,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, key)
+# ストリーミング全件取得で 1 チャンクに含めるキー数の上限
+MAX_STREAM_CHUNK_SIZE = 1000
+# キー一覧の 1 ページに含めるキー数の上限
+MAX_KEYS_PAGE_SIZE = 1000
+
+# db-unit が受け付けるリクエストトピック
+REQUEST_TOPICS = [
+    modt.TOPIC_STATE_GET,
+    modt.TOPIC_STATE_SET,
+    modt.TOPIC_STATE_KEYS_QUERY,
+    modt.TOPIC_STATE_ALL_GET,
+    modt.TOPIC_STATE_DELETE,
+    modt.TOPIC_STATE_CLEAR,
+    modt.TOPIC_STATE_MGET,
+    modt.TOPIC_STATE_MSET,
+    modt.TOPIC_STATE_MDELETE,
+    modt.TOPIC_STATE_ALL_STREAM,
+]
+
+def get_shard_config():
+    """(シャード数, 自インスタンスのシャード番号) を環境変数から取得します。"""
+    shard_count = modt.get_shard_count()
+    shard_index = int(os.getenv("DB_SHARD_INDEX", "0"))
+    if not 0 <= shard_index < shard_count:
+        raise RuntimeError(f"DB_SHARD_INDEX={shard_index} は MODT_STATE_SHARDS={shard_count} の範囲外です。")
+    return shard_count, shard_index
+
+def get_subscriptions(shard_count, shard_index):
+    """
+    購読するトピックの一覧を返します。
+    シャード構成では、自シャード用トピックと従来トピックの両方を共有サブスクリプション（$share）で購読し、
+    同じシャードを担当する複数のレプリカのうち 1 つだけが各メッセージを処理するようにします。
+    """
+    if shard_count <= 1:
+        return [(topic, 0) for topic in REQUEST_TOPICS]
+    group = f"$share/modt-db-shard-{shard_index}/"
+    subscriptions = []
+    for topic in REQUEST_TOPICS:
+        subscriptions.append((group + modt.get_shard_topic(topic, shard_index), 0))
+        subscriptions.append((group + topic, 0))
+    return subscriptions
+
+def init_db(db_path=None, parallel_reads=False, shard_count=1, shard_index=0):
+    """環境変数の設定に従って StateStore を生成します。"""
+    cache_max_mb = float(os.getenv("DB_CACHE_MAX_MB", "64"))
+    cache = None
+    if cache_max_mb > 0:
+        cache = StateCache(
+            max_bytes=int(cache_max_mb * 1024 * 1024),
+            ttl=float(os.getenv("DB_CACHE_TTL_SECONDS", "300")),
         )
-    """)
-    conn.commit()
-    return conn
+    db_path = db_path or os.getenv("DATABASE_PATH", "/app/data/modt_state.db")
+    return StateStore(
+        shard_db_path(db_path, shard_index, shard_count),
+        batch_size=int(os.getenv("DB_COMMIT_BATCH_SIZE", "64")),
+        commit_interval=int(os.getenv("DB_COMMIT_INTERVAL_MS", "50")) / 1000.0,
+        synchronous=os.getenv("DB_SYNCHRONOUS", "NORMAL"),
+        journal_mode=os.getenv("DB_JOURNAL_MODE", "WAL"),
+        cache=cache,
+        parallel_reads=parallel_reads,
+    )
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         modt.logger.info("Successfully connected to MQTT Broker.")
-        client.subscribe([
-            (modt.TOPIC_STATE_GET, 0),
-            (modt.TOPIC_STATE_SET, 0),
-            (modt.TOPIC_STATE_KEYS_QUERY, 0),
-            (modt.TOPIC_STATE_ALL_GET, 0),
-            (modt.TOPIC_STATE_DELETE, 0), # 追加
-            (modt.TOPIC_STATE_CLEAR, 0)   # 追加
-        ])
+        client.subscribe(get_subscriptions(userdata["shard_count"], userdata["shard_index"]))
     else:
         modt.logger.error(f"Connection failed with return code {rc}")
 
 def on_message(client, userdata, msg):
+    """
+    ネットワークスレッドではペイロードの解析だけを行い、SQL を含む処理はワーカーへ渡します。
+    同じユーザーのリクエストは同じワーカーが受信順に処理します。
+    """
     data, error = modt.parse_payload(msg.payload.decode())
     if error or not data:
         return
 
-    conn = userdata["db_conn"]
-    cursor = conn.cursor()
+    user_id = data.get("user_id")
+    shard_count = userdata["shard_count"]
+    # 従来トピック経由のリクエストは全シャードに届くため、自シャードのユーザー分だけを処理する
+    if shard_count > 1 and modt.get_shard(user_id, shard_count) != userdata["shard_index"]:
+        return
+
+    topic = modt.get_base_topic(msg.topic)
+    userdata["dispatcher"].submit(user_id, client, userdata["store"], topic, data, label=topic)
+
+# 書き込み系トピックと ack の action 名の対応
+WRITE_ACTIONS = {
+    modt.TOPIC_STATE_SET: "set",
+    modt.TOPIC_STATE_DELETE: "delete",
+    modt.TOPIC_STATE_CLEAR: "clear",
+    modt.TOPIC_STATE_MSET: "mset",
+    modt.TOPIC_STATE_MDELETE: "mdelete",
+}
+
+def make_ack_callback(client, data, action):
+    """
+    reply_to または correlation_id 付きの書き込みに対して、コミット完了時に ack を送るコールバックを返します。
+    どちらもない従来の書き込みには ack を送りません（None を返します）。
+    """
+    if not (data.get("reply_to") or data.get("correlation_id")):
+        return None
+    user_id = data.get("user_id")
+    reply_topic = modt.get_response_topic(data, modt.TOPIC_STATE_ACK)
+    sent = []
+
+    def on_commit(ok, rowcount):
+        # 書き込み後の処理で例外が起きた場合などに、同じリクエストへ二重に ack を送らない
+        if sent:
+            return
+        sent.append(ok)
+        # コミットまでの待ち時間がトレース上で見えるよう、ack の送信もスパンとして記録する
+        with modt.span("db-unit ack", action=action, ok=ok):
+            client.publish(reply_topic, modt.create_state_ack_payload(
+                user_id, action, "ok" if ok else "error", rowcount, correlation_id=data.get("correlation_id")))
+    # コミットはライタースレッドで完了するため、リクエストのトレースを引き継いで呼び出す
+    return modt.bind_trace(on_commit)
+
+def handle_write(client, store, topic, data):
+    """書き込みを実行し、要求があればコミット完了後に ack を返します。"""
+    user_id = data.get("user_id")
+    key = data.get("key")
+    action = WRITE_ACTIONS[topic]
+    on_commit = make_ack_callback(client, data, action)
+    # 1 件ごとのログは DEBUG とし、引数の整形は出力する場合だけ行わせる
+    try:
+        if topic == modt.TOPIC_STATE_SET:
+            store.set(user_id, key, data.get("value"), on_commit)
+            modt.logger.debug("SET: %s/%s", user_id, key)
+        elif topic == modt.TOPIC_STATE_DELETE:
+            store.delete(user_id, key, on_commit)
+            modt.logger.debug("DELETE: %s/%s", user_id, key)
+        elif topic == modt.TOPIC_STATE_CLEAR:
+            store.clear(user_id, on_commit)
+            modt.logger.debug("CLEAR: All data for user %s", user_id)
+        elif topic == modt.TOPIC_STATE_MSET:
+            items = data.get("items") or {}
+            store.mset(user_id, items, on_commit)
+            modt.logger.debug("MSET: %s (%d keys)", user_id, len(items))
+        elif topic == modt.TOPIC_STATE_MDELETE:
+            keys = data.get("keys") or []
+            store.mdelete(user_id, keys, on_commit)
+            modt.logger.debug("MDELETE: %s (%d keys)", user_id, len(keys))
+    except Exception:
+        # 書き込み自体に失敗した場合はコミットを待たずに失敗を通知する
+        if on_commit is not None:
+            on_commit(False, 0)
+        raise
+
+def handle_request(client, store, topic, data):
+    """ワーカースレッド上で 1 件のリクエストを処理します。要求元のトレースを引き継ぎ、処理時間をスパンとして記録します。"""
+    with modt.continue_trace(data, f"db-unit {topic}"):
+        process_request(client, store, topic, data)
+
+def process_request(client, store, topic, data):
+    """トピックに応じてストアを操作し、応答を返します。"""
     user_id = data.get("user_id")
     key = data.get("key")
+    # reply_to 付きのリクエストには要求元の返信トピックへ、相関 ID を添えて応答する
+    correlation_id = data.get("correlation_id")
+
+    if topic in WRITE_ACTIONS:
+        handle_write(client, store, topic, data)
+
+    elif topic == modt.TOPIC_STATE_GET:
+        found, val = store.get(user_id, key)
+        status = "valid" if found else "not_found"
+        client.publish(
+            modt.get_response_topic(data, modt.TOPIC_STATE_VAL),
+            modt.create_state_value_payload(user_id, key, val, status, correlation_id=correlation_id)
+        )
+
+    elif topic == modt.TOPIC_STATE_ALL_GET:
+        all_data = store.get_all(user_id)
+        client.publish(
+            modt.get_response_topic(data, modt.TOPIC_STATE_ALL_VAL),
+            modt.create_state_all_value_payload(user_id, all_data, correlation_id=correlation_id)
+        )
+
+    elif topic == modt.TOPIC_STATE_ALL_STREAM:
+        try:
+            chunk_size = int(data.get("chunk_size") or 100)
+        except (TypeError, ValueError):
+            chunk_size = 100
+        chunk_size = min(max(chunk_size, 1), MAX_STREAM_CHUNK_SIZE)
+        reply_topic = modt.get_response_topic(data, modt.TOPIC_STATE_ALL_CHUNK)
+
+        # 1 ページ先読みし、最後のチャンクに終了マーカー（done=True）を付けて送る
+        seq = 0
+        current = None
+        for page in store.iter_all(user_id, chunk_size):
+            if current is not None:
+                client.publish(reply_topic, modt.create_state_all_chunk_payload(
+                    user_id, seq, current, done=False, correlation_id=correlation_id))
+                seq += 1
+            current = page
+        client.publish(reply_topic, modt.create_state_all_chunk_payload(
+            user_id, seq, current or {}, done=True, correlation_id=correlation_id))
 
-    if msg.topic == modt.TOPIC_STATE_SET:
-        value = data.get("value")
-        db_value = json.dumps(value) if isinstance(value, (dict, list)) else str(value)
-        cursor.execute(
-            "INSERT OR REPLACE INTO states (user_id, key, value, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
-            (user_id, key, db_value)
+    elif topic == modt.TOPIC_STATE_KEYS_QUERY:
+        try:
+            limit = int(data.get("limit") or 100)
+        except (TypeError, ValueError):
+            limit = 100
+        limit = min(max(limit, 1), MAX_KEYS_PAGE_SIZE)
+        with_values = bool(data.get("with_values"))
+        page, next_cursor = store.scan_keys(
+            user_id,
+            prefix=data.get("prefix"),
+            start=data.get("start"),
+            end=data.get("end"),
+            cursor=data.get("cursor"),
+            limit=limit,
+            with_values=with_values,
+        )
+        keys = list(page) if with_values else page
+        client.publish(
+            modt.get_response_topic(data, modt.TOPIC_STATE_KEYS_LIST),
+            modt.create_state_keys_list_payload(
+                user_id, keys, next_cursor, data=page if with_values else None, correlation_id=correlation_id)
+        )
+
+    # --- 複数キー一括操作 ---
+    elif topic == modt.TOPIC_STATE_MGET:
+        found, missing = store.mget(user_id, data.get("keys") or [])
+        client.publish(
+            modt.get_response_topic(data, modt.TOPIC_STATE_MVAL),
+            modt.create_state_mvalue_payload(user_id, found, missing, correlation_id=correlation_id)
         )
-        conn.commit()
-        modt.logger.info(f"SET: {user_id}/{key}")
-
-    elif msg.topic == modt.TOPIC_STATE_GET:
-        cursor.execute("SELECT value FROM states WHERE user_id = ? AND key = ?", (user_id, key))
-        result = cursor.fetchone()
-        status = "valid" if result else "not_found"
-        val = None
-        if result:
-            try:
-                val = json.loads(result[0])
-            except:
-                val = result[0]
-        client.publish(modt.TOPIC_STATE_VAL, modt.create_state_value_payload(user_id, key, val, status))
-
-    elif msg.topic == modt.TOPIC_STATE_ALL_GET:
-        cursor.execute("SELECT key, value FROM states WHERE user_id = ?", (user_id,))
-        rows = cursor.fetchall()
-        all_data = {}
-        for row in rows:
-            try:
-                all_data[row[0]] = json.loads(row[1])
-            except:
-                all_data[row[0]] = row[1]
-        client.publish(modt.TOPIC_STATE_ALL_VAL, modt.create_state_all_value_payload(user_id, all_data))
-
-    # --- 新設：削除ロジック ---
-    elif msg.topic == modt.TOPIC_STATE_DELETE:
-        cursor.execute("DELETE FROM states WHERE user_id = ? AND key = ?", (user_id, key))
-        conn.commit()
-        modt.logger.info(f"DELETE: {user_id}/{key}")
-
-    elif msg.topic == modt.TOPIC_STATE_CLEAR:
-        cursor.execute("DELETE FROM states WHERE user_id = ?", (user_id,))
-        conn.commit()
-        modt.logger.info(f"CLEAR: All data for user {user_id}")
 
 def main():
-    db_conn = init_db()
-    client = modt.get_mqtt_client(client_id="database-unit")
-    client.user_data_set({"db_conn": db_conn})
-    client.on_connect = on_connect
+    workers = int(os.getenv("DB_WORKERS", "4"))
+    shard_count, shard_index = get_shard_config()
+    store = init_db(parallel_reads=workers > 1, shard_count=shard_count, shard_index=shard_index)
+    client_id = "database-unit"
+    if shard_count > 1:
+        # 同じシャードを複数のレプリカで担当できるよう、クライアントIDは一意にする
+        client_id = f"database-unit-shard{shard_index}-{uuid.uuid4().hex[:8]}"
+        modt.logger.info(f"Running as shard {shard_index} of {shard_count}.")
+    client = modt.get_mqtt_client(client_id=client_id)
     client.on_message = on_message
-    
+    # 受信数・送信数とコールバックの処理時間を計測し、ワーカーではキューの待ち時間と処理時間を記録する
+    metrics = modt.setup_metrics(client, client_id)
+    dispatcher = ShardedDispatcher(
+        handle_request,
+        workers=workers,
+        queue_size=int(os.getenv("DB_WORKER_QUEUE_SIZE", "1000")),
+        metrics=metrics,
+    )
+    client.user_data_set({
+        "store": store,
+        "dispatcher": dispatcher,
+        "shard_count": shard_count,
+        "shard_index": shard_index,
+    })
+    client.on_connect = on_connect
+
+    # docker stop (SIGTERM) でもループを抜けて未コミットの書き込みをフラッシュする
+    signal.signal(signal.SIGTERM, lambda signum, frame: client.disconnect())
+
     modt.connect_broker(client)
-    
+
     try:
         # loop_start()を重複させず、ここでメインスレッドをブロックして待機する
         client.loop_forever()
     except KeyboardInterrupt:
         pass
     finally:
+        # 受け付け済みのリクエストを処理し終えてからストアを閉じる
+        dispatcher.stop()
         modt.disconnect_broker(client)
-        db_conn.close()
+        store.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,97 @@
+"""
+シャード数を変更するためのデータ移行ツールです。
+すべての db-unit を停止した状態で実行し、旧シャードのデータベースファイル群から
+新しいシャード数に従って振り分けたデータベースファイル群を生成します。
+
+例: 1 台構成から 4 シャード構成へ移行する
+> python reshard.py --source /app/data/modt_state.db --from-shards 1 \
+>     --target /app/data/next/modt_state.db --to-shards 4
+"""
+import os
+import sys
+import argparse
+import sqlite3
+from common import modt
+from store import StateStore, shard_db_path
+
+# 1 回の executemany で書き込む行数
+COPY_BATCH_SIZE = 1000
+
+
+def reshard(source, from_shards, target, to_shards):
+    """旧シャードの全行を新シャードへコピーし、シャードごとの行数を返します。"""
+    source_paths = [shard_db_path(source, i, from_shards) for i in range(from_shards)]
+    target_paths = [shard_db_path(target, i, to_shards) for i in range(to_shards)]
+
+    for path in source_paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"移行元のデータベースが見つかりません: {path}")
+    for path in target_paths:
+        if os.path.exists(path):
+            raise FileExistsError(f"移行先のデータベースが既に存在します: {path}")
+
+    # StateStore を一度開くことで、移行元のスキーマを最新化し、移行先のテーブルを作成する
+    for path in source_paths + target_paths:
+        StateStore(path).close()
+
+    targets = [sqlite3.connect(path) for path in target_paths]
+    counts = [0] * to_shards
+    try:
+        for path in source_paths:
+            src = sqlite3.connect(path)
+            try:
+                cursor = src.execute("SELECT * FROM states")
+                columns = [desc[0] for desc in cursor.description]
+                user_index = columns.index("user_id")
+                insert_sql = (
+                    f"INSERT INTO states ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))})"
+                )
+                while True:
+                    rows = cursor.fetchmany(COPY_BATCH_SIZE)
+                    if not rows:
+                        break
+                    buckets = [[] for _ in range(to_shards)]
+                    for row in rows:
+                        buckets[modt.get_shard(row[user_index], to_shards)].append(row)
+                    for shard, bucket in enumerate(buckets):
+                        if bucket:
+                            targets[shard].executemany(insert_sql, bucket)
+                            counts[shard] += len(bucket)
+            finally:
+                src.close()
+        for conn in targets:
+            conn.commit()
+    finally:
+        for conn in targets:
+            conn.close()
+    return dict(zip(target_paths, counts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="db-unit のシャード数を変更します。")
+    parser.add_argument("--source", required=True, help="移行元の DATABASE_PATH")
+    parser.add_argument("--from-shards", type=int, required=True, help="移行元のシャード数")
+    parser.add_argument("--target", required=True, help="移行先の DATABASE_PATH（移行元とは別の場所）")
+    parser.add_argument("--to-shards", type=int, required=True, help="移行先のシャード数")
+    args = parser.parse_args(argv)
+
+    if args.from_shards < 1 or args.to_shards < 1:
+        parser.error("シャード数は 1 以上を指定してください。")
+
+    try:
+        counts = reshard(args.source, args.from_shards, args.target, args.to_shards)
+    except (FileNotFoundError, FileExistsError) as e:
+        modt.logger.error(str(e))
+        return 1
+
+    for path, count in counts.items():
+        modt.logger.info(f"{path}: {count} rows")
+    modt.logger.info(
+        f"移行が完了しました。MODT_STATE_SHARDS={args.to_shards} と移行先の DATABASE_PATH を設定して db-unit を再起動してください。"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,508 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from common import modt
+import codec
+
+# PRAGMA には値をバインドできないため、許可する値を列挙して検証する
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+JOURNAL_MODES = ("WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "OFF")
+# IN (...) 句に並べるプレースホルダー数の上限（SQLite の変数上限より十分小さい値）
+MAX_IN_PARAMS = 500
+# states テーブルのスキーマバージョン（PRAGMA user_version）。1 = 型タグ付き
+SCHEMA_VERSION = 1
+# 移行時に一度に変換する行数
+MIGRATION_BATCH_SIZE = 1000
+
+# value 列は型宣言を持たない（BLOB アフィニティ）ため、INTEGER / REAL / TEXT / BLOB をそのまま保持する
+CREATE_STATES_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        user_id TEXT,
+        key TEXT,
+        vtype TEXT NOT NULL,
+        value BLOB,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, key)
+    )
+"""
+
+
+def shard_db_path(db_path, shard_index, shard_count):
+    """
+    シャードごとのデータベースファイルのパスを返します。
+    パスに {shard} が含まれていれば置換し、なければ拡張子の前に .shard<N> を挿入します。
+    シャード数が 1 の場合は db_path をそのまま返します。
+    """
+    if shard_count <= 1:
+        return db_path
+    if "{shard}" in db_path:
+        return db_path.replace("{shard}", str(shard_index))
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.shard{shard_index}{ext}"
+
+
+def _prefix_upper_bound(prefix):
+    """
+    prefix で始まるすべての文字列より大きい最小の文字列（範囲検索の上限）を返します。
+    SQLite の既定の照合順序（BINARY）では UTF-8 のバイト順、すなわちコードポイント順で比較されるため、
+    末尾の文字を 1 つ進めれば上限になります。上限が存在しない場合は None を返します。
+    """
+    chars = list(prefix)
+    while chars:
+        last = ord(chars.pop())
+        if last < 0x10FFFF:
+            # サロゲート領域は UTF-8 に変換できないため飛ばす
+            nxt = last + 1 if not 0xD7FF <= last < 0xDFFF else 0xE000
+            return "".join(chars) + chr(nxt)
+    return None
+
+
+def migrate_schema(conn):
+    """
+    states テーブルを最新のスキーマに移行します。
+    型タグ導入前（user_version = 0）のテーブルは、当時の読み込み規則で値を復元したうえで
+    型タグ付きの形式に変換した新しいテーブルへ一度だけ移し替えます。
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    legacy = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'states'"
+    ).fetchone() is not None
+
+    if not legacy:
+        conn.execute(CREATE_STATES_SQL.format(table="states"))
+    else:
+        modt.logger.info("Migrating states table to the typed storage format...")
+        conn.execute("DROP TABLE IF EXISTS states_typed")
+        conn.execute(CREATE_STATES_SQL.format(table="states_typed"))
+        cursor = conn.execute("SELECT user_id, key, value, updated_at FROM states")
+        migrated = 0
+        while True:
+            rows = cursor.fetchmany(MIGRATION_BATCH_SIZE)
+            if not rows:
+                break
+            converted = []
+            for user_id, key, raw, updated_at in rows:
+                tag, stored = codec.encode(codec.decode_legacy(raw))
+                converted.append((user_id, key, tag, stored, updated_at))
+            conn.executemany(
+                "INSERT INTO states_typed (user_id, key, vtype, value, updated_at) VALUES (?, ?, ?, ?, ?)",
+                converted
+            )
+            migrated += len(converted)
+        conn.execute("DROP TABLE states")
+        conn.execute("ALTER TABLE states_typed RENAME TO states")
+        modt.logger.info(f"Migrated {migrated} rows to the typed storage format.")
+
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+
+class StateStore:
+    """
+    states テーブルへのアクセスを一元化するストアです。
+    書き込みは開いたトランザクション上で即座に実行し、コミットだけを
+    件数（batch_size）または経過時間（commit_interval 秒）のしきい値に達するまで遅延させます。
+    同じ接続からの読み込みは未コミットの書き込みも参照するため、読み書きの整合性は保たれます。
+
+    書き込みメソッドに on_commit を渡すと、その書き込みを含むコミットの完了後に
+    on_commit(成功したかどうか, 影響行数) が呼び出されます。コールバックはストアのロック内で実行されるため、
+    MQTT の publish のような短い処理に留めてください。
+
+    parallel_reads を有効にすると、未コミットの書き込みがないユーザーの読み込みは
+    スレッドごとの読み込み専用接続（WAL のスナップショット）で行い、ロックを取らずに並行実行します。
+    この場合、同じユーザーに対する読み書きは呼び出し側で直列化されている必要があります
+    （ShardedDispatcher による user_id シャーディングがこれを保証します）。
+    """
+
+    def __init__(self, db_path, batch_size=64, commit_interval=0.05,
+                 synchronous="NORMAL", journal_mode="WAL", cache=None, parallel_reads=False):
+        synchronous = synchronous.upper()
+        journal_mode = journal_mode.upper()
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"不正な synchronous 設定です: {synchronous}")
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"不正な journal_mode 設定です: {journal_mode}")
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.db_path = db_path
+        self.batch_size = max(1, int(batch_size))
+        self.commit_interval = max(0.0, float(commit_interval))
+        # cache には StateCache を渡す。None の場合は常に SQLite から読み込む
+        self.cache = cache
+        # 読み込み専用接続が書き込みと並行できるのは WAL モードのときのみ
+        self.parallel_reads = parallel_reads and journal_mode == "WAL"
+        self._synchronous = synchronous
+        self._local = threading.local()
+        self._readers = []
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute(f"PRAGMA synchronous={synchronous}")
+        migrate_schema(self.conn)
+
+        # 接続・保留中の書き込み件数・統計値はすべてこの条件変数のロックで保護する
+        self._cond = threading.Condition(threading.RLock())
+        self._pending = 0
+        self._dirty_users = set()
+        self._commit_callbacks = []  # (on_commit, 影響行数) のリスト
+        self._first_pending_at = 0.0
+        self._closed = False
+        self._stats = {
+            "commits": 0,
+            "writes": 0,
+            "errors": 0,
+            "last_batch": 0,
+            "max_batch": 0,
+            "commit_seconds": 0.0,
+            "max_commit_seconds": 0.0,
+        }
+
+        self._flusher = threading.Thread(target=self._flush_loop, name="db-group-commit", daemon=True)
+        self._flusher.start()
+
+    # --- 書き込み ---
+
+    # キャッシュの更新は SQLite への書き込みと同じロック内で行い、読み込みミス時の登録と競合させない
+
+    def set(self, user_id, key, value, on_commit=None):
+        return self.mset(user_id, {key: value}, on_commit)
+
+    def delete(self, user_id, key, on_commit=None):
+        return self.mdelete(user_id, [key], on_commit)
+
+    def clear(self, user_id, on_commit=None):
+        with self._cond:
+            rowcount = self._write(user_id, "DELETE FROM states WHERE user_id = ?", (user_id,), on_commit)
+            if self.cache is not None:
+                self.cache.on_clear(user_id)
+        return rowcount
+
+    def mset(self, user_id, items, on_commit=None):
+        encoded = {key: codec.encode(value) for key, value in items.items()}
+        with self._cond:
+            rowcount = self._write_many(
+                user_id,
+                "INSERT OR REPLACE INTO states (user_id, key, vtype, value, updated_at) "
+                "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                [(user_id, key, tag, stored) for key, (tag, stored) in encoded.items()],
+                on_commit
+            )
+            if self.cache is not None:
+                # 型を保ったまま保存されるため、書き込んだ値をそのままキャッシュできる
+                for key, (tag, stored) in encoded.items():
+                    self.cache.on_set(user_id, key, items[key], codec.stored_size(stored))
+        return rowcount
+
+    def mdelete(self, user_id, keys, on_commit=None):
+        keys = list(dict.fromkeys(keys))
+        with self._cond:
+            rowcount = self._write_many(
+                user_id,
+                "DELETE FROM states WHERE user_id = ? AND key = ?",
+                [(user_id, key) for key in keys],
+                on_commit
+            )
+            if self.cache is not None:
+                for key in keys:
+                    self.cache.on_delete(user_id, key)
+        return rowcount
+
+    def _write(self, user_id, sql, params, on_commit=None):
+        """書き込みを実行し、しきい値に達していればコミットします。影響行数を返します。"""
+        return self._write_many(user_id, sql, [params], on_commit)
+
+    def _write_many(self, user_id, sql, seq_of_params, on_commit=None):
+        """executemany で同一トランザクションに書き込みます。影響行数の合計を返します。"""
+        if not seq_of_params:
+            # 書き込む行がなければコミットを待つ必要もない
+            if on_commit is not None:
+                on_commit(True, 0)
+            return 0
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("StateStore は既にクローズされています。")
+            rowcount = self.conn.executemany(sql, seq_of_params).rowcount
+            if on_commit is not None:
+                self._commit_callbacks.append((on_commit, rowcount))
+            was_idle = self._pending == 0
+            self._pending += len(seq_of_params)
+            self._dirty_users.add(user_id)
+            if was_idle:
+                self._first_pending_at = time.monotonic()
+                self._cond.notify()
+            if self._pending >= self.batch_size:
+                self._commit_locked()
+            return rowcount
+
+    # --- 読み込み ---
+
+    @contextmanager
+    def _read_conn(self, user_id):
+        """読み込みに使う接続を返します。未コミットの書き込みがあるユーザーは書き込み用接続で読みます。"""
+        if self.parallel_reads:
+            with self._cond:
+                dirty = user_id in self._dirty_users
+            if not dirty:
+                yield self._reader()
+                return
+        with self._cond:
+            yield self.conn
+
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute(f"PRAGMA synchronous={self._synchronous}")
+            conn.execute("PRAGMA query_only=ON")
+            self._local.conn = conn
+            with self._cond:
+                self._readers.append(conn)
+        return conn
+
+    def get(self, user_id, key):
+        """(見つかったかどうか, 値) を返します。"""
+        if self.cache is not None:
+            hit, found, value = self.cache.get(user_id, key)
+            if hit:
+                return found, value
+        with self._read_conn(user_id) as conn:
+            row = conn.execute(
+                "SELECT vtype, value FROM states WHERE user_id = ? AND key = ?", (user_id, key)
+            ).fetchone()
+            if row is None:
+                if self.cache is not None:
+                    self.cache.put_missing(user_id, key)
+                return False, None
+            value = codec.decode(*row)
+            if self.cache is not None:
+                self.cache.put(user_id, key, value, codec.stored_size(row[1]))
+        return True, value
+
+    def get_all(self, user_id):
+        if self.cache is not None:
+            cached = self.cache.get_all(user_id)
+            if cached is not None:
+                return cached
+        with self._read_conn(user_id) as conn:
+            rows = conn.execute("SELECT key, vtype, value FROM states WHERE user_id = ?", (user_id,)).fetchall()
+            all_data = {key: codec.decode(tag, stored) for key, tag, stored in rows}
+            if self.cache is not None:
+                self.cache.put_all(user_id, all_data, {key: codec.stored_size(stored) for key, _, stored in rows})
+        return all_data
+
+    def iter_all(self, user_id, chunk_size):
+        """
+        ユーザーの全データを key 順に chunk_size 件ずつの辞書として返すジェネレーターです。
+        主キーのインデックスを使ったカーソル（直前のページの最後のキー）でページングするため、
+        全件を一度にメモリへ展開しません。ページの間はロックを保持しません。
+        """
+        if self.cache is not None:
+            cached = self.cache.get_all(user_id)
+            if cached is not None:
+                keys = sorted(cached)
+                for i in range(0, len(keys), chunk_size):
+                    yield {key: cached[key] for key in keys[i:i + chunk_size]}
+                return
+
+        last_key = None
+        while True:
+            with self._read_conn(user_id) as conn:
+                if last_key is None:
+                    rows = conn.execute(
+                        "SELECT key, vtype, value FROM states WHERE user_id = ? ORDER BY key LIMIT ?",
+                        (user_id, chunk_size)
+                    ).fetchall()
+                else:
+                    rows = conn.execute(
+                        "SELECT key, vtype, value FROM states WHERE user_id = ? AND key > ? ORDER BY key LIMIT ?",
+                        (user_id, last_key, chunk_size)
+                    ).fetchall()
+            if not rows:
+                return
+            yield {key: codec.decode(tag, stored) for key, tag, stored in rows}
+            if len(rows) < chunk_size:
+                return
+            last_key = rows[-1][0]
+
+    def scan_keys(self, user_id, prefix=None, start=None, end=None, cursor=None, limit=100, with_values=False):
+        """
+        ユーザーのキーを key 順に最大 limit 件返します。戻り値は (キーのリスト, 次のページのカーソル) で、
+        with_values が真の場合はリストの代わりにキーと値の辞書を返します。続きがなければカーソルは None です。
+
+        - prefix: 指定した接頭辞で始まるキーだけを返します。
+        - start / end: start 以上 end 未満のキーだけを返します。
+        - cursor: 前のページが返したカーソル（そのページの最後のキー）より後のキーから返します。
+
+        条件はすべて主キー (user_id, key) の範囲検索になるため、1 ページの読み込みは全体のキー数に関係なく
+        limit 件分で済みます。キャッシュは key 順を保持していないため、常に SQLite から読み込みます。
+        """
+        lower, lower_inclusive = start, True
+        upper = end
+        if prefix:
+            if lower is None or prefix > lower:
+                lower = prefix
+            prefix_end = _prefix_upper_bound(prefix)
+            if prefix_end is not None and (upper is None or prefix_end < upper):
+                upper = prefix_end
+        if cursor is not None and (lower is None or cursor >= lower):
+            lower, lower_inclusive = cursor, False
+
+        conditions = ["user_id = ?"]
+        params = [user_id]
+        if lower is not None:
+            conditions.append("key >= ?" if lower_inclusive else "key > ?")
+            params.append(lower)
+        if upper is not None:
+            conditions.append("key < ?")
+            params.append(upper)
+        columns = "key, vtype, value" if with_values else "key"
+        # 1 件多く読み、続きがあるかどうかを判定する
+        params.append(limit + 1)
+        with self._read_conn(user_id) as conn:
+            rows = conn.execute(
+                f"SELECT {columns} FROM states WHERE {' AND '.join(conditions)} ORDER BY key LIMIT ?",
+                params
+            ).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        if with_values:
+            return {key: codec.decode(tag, stored) for key, tag, stored in rows}, next_cursor
+        return [row[0] for row in rows], next_cursor
+
+    def mget(self, user_id, keys):
+        """(見つかったキーと値の辞書, 見つからなかったキーのリスト) を返します。"""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        uncached = keys
+        if self.cache is not None:
+            uncached = []
+            for key in keys:
+                hit, exists, value = self.cache.get(user_id, key)
+                if not hit:
+                    uncached.append(key)
+                elif exists:
+                    found[key] = value
+
+        with self._read_conn(user_id) as conn:
+            for i in range(0, len(uncached), MAX_IN_PARAMS):
+                chunk = uncached[i:i + MAX_IN_PARAMS]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT key, vtype, value FROM states WHERE user_id = ? AND key IN ({placeholders})",
+                    (user_id, *chunk)
+                ).fetchall()
+                for key, tag, stored in rows:
+                    found[key] = value = codec.decode(tag, stored)
+                    if self.cache is not None:
+                        self.cache.put(user_id, key, value, codec.stored_size(stored))
+            if self.cache is not None:
+                for key in uncached:
+                    if key not in found:
+                        self.cache.put_missing(user_id, key)
+
+        missing = [key for key in keys if key not in found]
+        return found, missing
+
+    # --- グループコミット ---
+
+    def flush(self):
+        """保留中の書き込みを即座にコミットします。"""
+        with self._cond:
+            self._commit_locked()
+
+    def _commit_locked(self):
+        if self._pending == 0:
+            return
+        batch = self._pending
+        self._pending = 0
+        self._dirty_users.clear()
+        callbacks, self._commit_callbacks = self._commit_callbacks, []
+        started = time.perf_counter()
+        try:
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self._stats["errors"] += 1
+            modt.logger.error(f"グループコミットに失敗しました（{batch} 件を破棄）: {e}")
+            self.conn.rollback()
+            if self.cache is not None:
+                self.cache.invalidate_all()
+            self._run_callbacks(callbacks, False)
+            return
+        elapsed = time.perf_counter() - started
+        self._run_callbacks(callbacks, True)
+
+        stats = self._stats
+        stats["commits"] += 1
+        stats["writes"] += batch
+        stats["last_batch"] = batch
+        stats["max_batch"] = max(stats["max_batch"], batch)
+        stats["commit_seconds"] += elapsed
+        stats["max_commit_seconds"] = max(stats["max_commit_seconds"], elapsed)
+
+    def _run_callbacks(self, callbacks, ok):
+        for on_commit, rowcount in callbacks:
+            try:
+                on_commit(ok, rowcount)
+            except Exception as e:
+                modt.logger.error(f"コミット後の処理に失敗しました: {e}")
+
+    def _flush_loop(self):
+        """最初の未コミット書き込みから commit_interval 秒経過した時点でコミットします。"""
+        with self._cond:
+            while not self._closed:
+                if self._pending == 0:
+                    self._cond.wait()
+                    continue
+                remaining = self._first_pending_at + self.commit_interval - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._commit_locked()
+
+    def stats(self):
+        """バッチサイズとコミット所要時間の集計値を返します。"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending"] = self._pending
+        commits = stats["commits"]
+        stats["avg_batch"] = stats["writes"] / commits if commits else 0.0
+        stats["avg_commit_seconds"] = stats["commit_seconds"] / commits if commits else 0.0
+        return stats
+
+    def close(self):
+        """保留中の書き込みをすべてコミットしてから接続を閉じます。"""
+        with self._cond:
+            if self._closed:
+                return
+            self._commit_locked()
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join()
+        self.conn.close()
+        for reader in self._readers:
+            reader.close()
+
+        stats = self.stats()
+        modt.logger.info(
+            f"StateStore closed: commits={stats['commits']} writes={stats['writes']} "
+            f"avg_batch={stats['avg_batch']:.1f} max_batch={stats['max_batch']} "
+            f"avg_commit_ms={stats['avg_commit_seconds'] * 1000:.2f} "
+            f"max_commit_ms={stats['max_commit_seconds'] * 1000:.2f} errors={stats['errors']}"
+        )
+        if self.cache is not None:
+            cache_stats = self.cache.stats()
+            modt.logger.info(
+                f"StateCache: hits={cache_stats['hits']} misses={cache_stats['misses']} "
+                f"hit_ratio={cache_stats['hit_ratio']:.2f} evictions={cache_stats['evictions']} "
+                f"expirations={cache_stats['expirations']} bytes={cache_stats['bytes']}"
+            )
@@ -0,0 +1,74 @@
+import time
+import zlib
+import queue
+import threading
+from common import modt
+
+_STOP = object()
+
+
+class ShardedDispatcher:
+    """
+    受信したリクエストを user_id のハッシュで決まるワーカースレッドに振り分けます。
+    同じユーザーの処理は常に同じシャードの FIFO キューを通るため順序が保たれ、
+    異なるユーザーの処理は並行して進みます。
+    metrics（modt.Metrics）を渡すと、submit の label ごとにキューの待ち時間とワーカーでの処理時間を記録します。
+    """
+
+    def __init__(self, handler, workers=4, queue_size=1000, metrics=None):
+        self.handler = handler
+        self.metrics = metrics
+        self.workers = max(1, int(workers))
+        self._queues = [queue.Queue(maxsize=max(1, int(queue_size))) for _ in range(self.workers)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"db-worker-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def shard_of(self, shard_key):
+        # hash() はプロセスごとに値が変わるため、安定した crc32 を使う
+        return zlib.crc32(str(shard_key).encode("utf-8")) % self.workers
+
+    def submit(self, shard_key, *args, label=None):
+        """
+        シャードのキューに処理を積みます。
+        キューが満杯の場合は空きが出るまで待機し、受信側に背圧をかけます。
+        """
+        q = self._queues[self.shard_of(shard_key)]
+        # 計測の対象となった処理にだけ、キューへ積んだ時刻を添える
+        enqueued_at = None
+        if self.metrics is not None and label is not None and self.metrics.sampled():
+            enqueued_at = time.perf_counter()
+        item = (label, enqueued_at, args)
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            modt.logger.warning(f"Worker queue for shard {self.shard_of(shard_key)} is full; applying backpressure.")
+            q.put(item)
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            label, enqueued_at, args = item
+            if enqueued_at is not None:
+                start = time.perf_counter()
+                self.metrics.observe_queue(label, start - enqueued_at)
+            error = False
+            try:
+                self.handler(*args)
+            except Exception as e:
+                error = True
+                modt.logger.exception(f"Worker failed to handle request: {e}")
+            if enqueued_at is not None:
+                self.metrics.observe_worker(label, time.perf_counter() - start, error)
+
+    def stop(self):
+        """キューに積まれた処理をすべて実行し終えてからワーカーを停止します。"""
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
@@ -1,6 +1,6 @@
 import os
-import time
-from flask import Flask, render_template, request, make_response, redirect
+import uuid
+from flask import Flask, render_template, request, redirect
 from common import modt
 
 app = Flask(__name__)
@@ -17,8 +17,13 @@ IDENTIFY_PUBLIC_URL = get_env_or_raise("IDENTIFY_PUBLIC_URL")
 DUMMY_APP_PUBLIC_URL = get_env_or_raise("DUMMY_APP_PUBLIC_URL")
 VIEWER_PUBLIC_URL = get_env_or_raise("VIEWER_PUBLIC_URL")
 
-# セッション照会の結果を一時的に保持する辞書
-session_responses = {}
+# レプリカごとに一意なクライアントIDと、自分宛ての応答だけが届く返信トピック
+CLIENT_ID = f"dummy-app-unit-service-{uuid.uuid4().hex[:8]}"
+REPLY_TOPIC = modt.get_reply_topic(CLIENT_ID)
+
+# セッション照会の応答を待つ上限（秒）と、照会結果をキャッシュする秒数
+SESSION_QUERY_TIMEOUT = 2.0
+SESSION_CACHE_SECONDS = float(os.getenv("MODT_SESSION_CACHE_SECONDS", "30"))
 
 def on_connect(client, userdata, flags, rc):
     """ブローカー接続成功時に呼ばれるコールバック。"""
@@ -27,7 +32,8 @@ def on_connect(client, userdata, flags, rc):
         # SDKの定数を使用して購読リストを定義
         client.subscribe([
             (modt.TOPIC_AUTH_SUCCESS, 0),
-            (modt.TOPIC_SESSION_INFO, 0)
+            (modt.TOPIC_SESSION_REVOKED, 0),
+            (REPLY_TOPIC, 0)
         ])
     else:
         modt.logger.error(f"Dummy App Unit connection failed with code {rc}")
@@ -41,50 +47,40 @@ def on_message(client, userdata, msg):
     # 1. ログイン直後のリダイレクト準備処理
     if msg.topic == modt.TOPIC_AUTH_SUCCESS:
         session_id = data.get("session_id")
-        payload = modt.create_app_ready_payload(
-            app_name="dummy-app",
-            redirect_url=DUMMY_APP_PUBLIC_URL,
-            session_id=session_id
-        )
-        client.publish(modt.TOPIC_APP_READY, payload)
+        # ログインのトレースを引き継ぎ、準備完了通知にも同じトレース ID を載せる
+        with modt.continue_trace(data, "dummy-app auth_success"):
+            payload = modt.create_app_ready_payload(
+                app_name="dummy-app",
+                redirect_url=DUMMY_APP_PUBLIC_URL,
+                session_id=session_id
+            )
+            client.publish(modt.TOPIC_APP_READY, payload)
         modt.logger.info(f"Published app-ready for session: {session_id}")
 
-    # 2. セッション照会結果の受信処理
-    elif msg.topic == modt.TOPIC_SESSION_INFO:
-        s_id = data.get("session_id")
-        if s_id:
-            session_responses[s_id] = data
-            modt.logger.info(f"Received session info for: {s_id}")
-
 # SDKを利用したMQTTセットアップ
-mqtt_client = modt.get_mqtt_client(client_id="dummy-app-unit-service")
+mqtt_client = modt.get_mqtt_client(client_id=CLIENT_ID)
 mqtt_client.on_connect = on_connect
 mqtt_client.on_message = on_message
+# 受信数・送信数と処理時間の計測（Requester がコールバックを登録する前に設定する）
+metrics = modt.setup_metrics(mqtt_client, CLIENT_ID)
+# 返信トピックに届いたセッション照会の結果は Requester が待機中の呼び出し元へ受け渡す
+requester = modt.Requester(mqtt_client, REPLY_TOPIC)
+# セッションの検証結果のキャッシュ（トークンの検証、照会のまとめ、失効通知の反映を行う）
+sessions = modt.SessionCache(requester, ttl=SESSION_CACHE_SECONDS, query_timeout=SESSION_QUERY_TIMEOUT)
 
 # ブローカー接続とバックグラウンドループの開始
 modt.connect_broker(mqtt_client)
 mqtt_client.loop_start()
 
-def verify_session_via_mqtt(session_id):
-    """identify-unitにセッションの妥当性を問い合わせます。"""
-    query_payload = modt.create_session_query_payload(session_id)
-    mqtt_client.publish(modt.TOPIC_SESSION_QUERY, query_payload)
-    
-    start_time = time.time()
-    while time.time() - start_time < 2.0:
-        if session_id in session_responses:
-            return session_responses.pop(session_id)
-        time.sleep(0.1)
-    return None
-
 @app.route("/")
 def index():
     session_id = request.cookies.get("modt_session_id")
     user_info = None
     
     if session_id:
-        result = verify_session_via_mqtt(session_id)
-        if result and result.get("status") == "valid":
+        # トークンかキャッシュで検証できればブローカーへの照会は行わない
+        result = sessions.verify(session_id, token=request.cookies.get(modt.SESSION_TOKEN_COOKIE))
+        if result:
             user_info = {
                 "user_id": result.get("user_id"),
                 "role": result.get("role")
@@ -99,11 +95,11 @@ def index():
 
 @app.route("/logout")
 def logout():
-    """クッキーを削除し、ログイン画面へ戻ります。"""
-    login_url = f"{IDENTIFY_PUBLIC_URL}/login"
-    response = make_response(redirect(login_url))
-    response.set_cookie("modt_session_id", "", expires=0)
-    return response
+    """
+    identify-unit のログアウトへ移動します。
+    セッションの削除・失効通知・Cookie の消去は identify-unit が行うため、ここでは Cookie に触れません。
+    """
+    return redirect(f"{IDENTIFY_PUBLIC_URL}/logout")
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -11,4 +11,13 @@ CREATE TABLE IF NOT EXISTS users (
 -- 動作確認用のテストユーザー（パスワードは 'password' を想定したダミー）
 INSERT INTO users (username, password_hash, role)
 VALUES ('admin', '$2b$12$ExampleHashValue...', 'admin')
-ON CONFLICT (username) DO NOTHING;
\ No newline at end of file
+ON CONFLICT (username) DO NOTHING;
+
+-- ログイン済みセッションを全ワーカーで共有するテーブル（期限切れの行は identify-unit が定期的に削除します）
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id VARCHAR(64) PRIMARY KEY,
+    user_id VARCHAR(64) NOT NULL,
+    role VARCHAR(20) NOT NULL,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at);
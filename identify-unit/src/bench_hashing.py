@@ -0,0 +1,76 @@
+"""
+PasswordHasher のプロセス数ごとの処理性能（1 秒あたりのログイン検証数）を計測します。
+
+例: 0（スレッドプール）, 1, 2, 4 プロセスで、同時 32 件ずつ 128 件の検証を実行する
+> python bench_hashing.py --workers 0 1 2 4 --logins 128 --concurrency 32
+"""
+import time
+import asyncio
+import argparse
+from passlib.hash import bcrypt
+from hashing import PasswordHasher, HasherBusy
+
+
+async def run_logins(hasher, password_hash, logins, concurrency):
+    """concurrency 件ずつ同時に検証し、(成功件数, 混雑で拒否された件数, 経過秒) を返します。"""
+    semaphore = asyncio.Semaphore(concurrency)
+    rejected = 0
+
+    async def login():
+        nonlocal rejected
+        async with semaphore:
+            try:
+                return await hasher.verify("password", password_hash)
+            except HasherBusy:
+                rejected += 1
+                return False
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(login() for _ in range(logins)))
+    return sum(results), rejected, time.perf_counter() - start
+
+
+async def measure_loop_lag(stop_event, interval=0.01):
+    """検証中のイベントループの遅延（最大値、秒）を計測します。"""
+    worst = 0.0
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def bench(workers, logins, concurrency, max_pending, password_hash):
+    hasher = PasswordHasher(workers=workers, max_pending=max_pending)
+    try:
+        # プロセスの起動時間を計測に含めないよう、先にワーカー数分の検証を実行しておく
+        await asyncio.gather(*(hasher.verify("password", password_hash) for _ in range(max(1, workers))))
+        stop_event = asyncio.Event()
+        lag_task = asyncio.create_task(measure_loop_lag(stop_event))
+        ok, rejected, elapsed = await run_logins(hasher, password_hash, logins, concurrency)
+        stop_event.set()
+        lag = await lag_task
+    finally:
+        hasher.shutdown()
+    print(
+        f"workers={workers:>2}  logins/s={ok / elapsed:8.1f}  ok={ok}  rejected={rejected}  "
+        f"elapsed={elapsed:.2f}s  max_loop_lag={lag * 1000:.1f}ms"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="bcrypt 検証のプロセスプールの性能を計測します。")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4], help="計測するプロセス数（0 はスレッドプール）")
+    parser.add_argument("--logins", type=int, default=128, help="1 回の計測で実行する検証の件数")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時に要求する件数")
+    parser.add_argument("--max-pending", type=int, default=64, help="PasswordHasher の受付上限")
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt のコスト（passlib の既定は 12）")
+    args = parser.parse_args(argv)
+
+    password_hash = bcrypt.using(rounds=args.rounds).hash("password")
+    for workers in args.workers:
+        asyncio.run(bench(workers, args.logins, args.concurrency, args.max_pending, password_hash))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from passlib.context import CryptContext
+
+# ワーカープロセス側でも同じ設定で生成される（モジュールの読み込み時に作成）
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _hash(password):
+    return pwd_context.hash(password)
+
+
+def _verify(password, password_hash):
+    return pwd_context.verify(password, password_hash)
+
+
+class HasherBusy(Exception):
+    """ハッシュ処理の待ち行列が上限に達していることを表します。"""
+
+
+class PasswordHasher:
+    """
+    bcrypt のハッシュ生成・検証をプロセスプールで実行するサービスです。
+    CPU を占有する bcrypt を別プロセスで動かすことで、イベントループや MQTT の処理が GIL 待ちで止まるのを防ぎます。
+    実行中と待機中を合わせた件数が max_pending に達すると、新しい要求は待たせずに HasherBusy を送出します。
+    workers に 0 を指定するとプロセスプールを使わず、既定のスレッドプールで実行します。
+    """
+
+    def __init__(self, workers=2, max_pending=64):
+        self.workers = int(workers)
+        self.max_pending = max(1, int(max_pending))
+        self._executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 0 else None
+        self._pending = 0
+
+    async def _run(self, func, *args):
+        if self._pending >= self.max_pending:
+            raise HasherBusy(f"password hashing queue is full ({self.max_pending})")
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password):
+        """パスワードの bcrypt ハッシュを生成します。"""
+        return await self._run(_hash, password)
+
+    async def verify(self, password, password_hash):
+        """パスワードがハッシュと一致するかを検証します。"""
+        return await self._run(_verify, password, password_hash)
+
+    def stats(self):
+        return {"workers": self.workers, "pending": self._pending, "max_pending": self.max_pending}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
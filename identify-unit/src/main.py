@@ -1,105 +1,188 @@
 import os
+import time
 import uuid
 import asyncio
 from datetime import datetime
 from fastapi import FastAPI, Form, Request, WebSocket, WebSocketDisconnect, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
-from passlib.context import CryptContext
 
 # 分割された新SDKパッケージのインポート
 from common import modt
+from redirects import RedirectBoard, TooManyWaiters
+from session_store import create_session_store, run_sweeper
+from hashing import PasswordHasher, HasherBusy
+from users import UserRepository, create_engine_from_url
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # .env から設定を読み込み
 DATABASE_URL = os.getenv("DATABASE_URL")
 SECRET_KEY = os.getenv("SECRET_KEY", "default-secret-key")
 IDENTIFY_PUBLIC_URL = os.getenv("IDENTIFY_PUBLIC_URL", "http://localhost:5000")
+# 各ユニットが共有するセッショントークンの署名鍵（未設定の場合はトークンを発行せず、MQTT での照会のみとなる）
+SESSION_SECRET = modt.get_session_secret()
+# 未受け取りのリダイレクト先を保持する秒数、同時に待機できる WebSocket 数、1 接続あたりの待機上限（秒）
+REDIRECT_TTL_SECONDS = float(os.getenv("IDENTIFY_REDIRECT_TTL_SECONDS", "60"))
+MAX_REDIRECT_WAITERS = int(os.getenv("IDENTIFY_MAX_REDIRECT_WAITERS", "1000"))
+REDIRECT_WAIT_SECONDS = float(os.getenv("IDENTIFY_REDIRECT_WAIT_SECONDS", "300"))
+# セッションの保存先（sql / memory）、有効期間、プロセス内キャッシュの保持秒数、期限切れセッションの掃除間隔（秒）
+SESSION_BACKEND = os.getenv("IDENTIFY_SESSION_BACKEND", "sql")
+SESSION_TTL_SECONDS = float(os.getenv("IDENTIFY_SESSION_TTL_SECONDS", "86400"))
+SESSION_CACHE_SECONDS = float(os.getenv("IDENTIFY_SESSION_CACHE_SECONDS", "5"))
+SESSION_SWEEP_SECONDS = float(os.getenv("IDENTIFY_SESSION_SWEEP_SECONDS", "300"))
+# bcrypt を実行するプロセス数（0 でスレッドプール）と、実行中・待機中を合わせた受付上限
+HASH_WORKERS = int(os.getenv("IDENTIFY_HASH_WORKERS", str(os.cpu_count() or 1)))
+HASH_MAX_PENDING = int(os.getenv("IDENTIFY_HASH_MAX_PENDING", "64"))
+# データベース接続プールの大きさ、プリペアドステートメントのキャッシュ件数、ユーザー行のキャッシュ秒数
+DB_POOL_SIZE = int(os.getenv("IDENTIFY_DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("IDENTIFY_DB_MAX_OVERFLOW", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("IDENTIFY_DB_STATEMENT_CACHE_SIZE", "500"))
+USER_CACHE_SECONDS = float(os.getenv("IDENTIFY_USER_CACHE_SECONDS", "30"))
+BUSY_MESSAGE = "ただいま混雑しています。しばらくしてから再度お試しください"
 
-# データベース接続設定
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# データベース接続設定（asyncpg による非同期の接続プール）
+engine = create_engine_from_url(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    statement_cache_size=DB_STATEMENT_CACHE_SIZE
+)
+users = UserRepository(engine, cache_ttl=USER_CACHE_SECONDS)
 
-# 状態管理用の辞書
-ready_apps = {}      # リダイレクト待ちのセッション (session_id -> redirect_url)
-active_sessions = {} # ログイン済みの有効なセッション情報 (session_id -> {user_id, role})
+# パスワードのハッシュ処理（ワーカープロセスは起動時に生成し、終了時に停止する）
+password_hasher = None
 
-def on_connect(client, userdata, flags, rc):
-    """
-    ブローカー接続成功時に呼ばれるコールバック。
-    SDKの定数を使用して、必要なトピックを一括購読します。
-    """
-    if rc == 0:
-        modt.logger.info("Identify Unit connected to MQTT broker.")
-        client.subscribe([
-            (modt.TOPIC_APP_READY, 0),
-            (modt.TOPIC_SESSION_QUERY, 0)
-        ])
+# 状態管理
+# リダイレクト待ちのセッション。app/ready は全ワーカーに届くため、各プロセスが自分のブラウザ分だけ受け渡す
+ready_apps = RedirectBoard(ttl=REDIRECT_TTL_SECONDS, max_waiters=MAX_REDIRECT_WAITERS)
+# ログイン済みの有効なセッション情報 (session_id -> {user_id, role})。全ワーカーで共有される
+active_sessions = create_session_store(
+    SESSION_BACKEND, engine, ttl=SESSION_TTL_SECONDS, cache_ttl=SESSION_CACHE_SECONDS
+)
+
+def handle_app_ready(data):
+    """アプリ準備完了通知の処理 (リダイレクトフロー)"""
+    s_id = data.get("session_id")
+    redirect_url = data.get("redirect_url")
+    if s_id and redirect_url:
+        ready_apps.publish(s_id, redirect_url, modt.current_trace())
+        modt.logger.info(f"Session {s_id} ready to redirect to {redirect_url}")
+
+async def handle_session_query(data):
+    """セッション照会リクエストの処理 (他ユニットからの身分確認)"""
+    query_sid = data.get("session_id")
+    modt.logger.debug("Session query received for: %s", query_sid)
+
+    session_info = await active_sessions.get(query_sid) if query_sid else None
+    if session_info:
+        res_payload = modt.create_session_info_payload(
+            session_id=query_sid,
+            user_id=session_info["user_id"],
+            role=session_info["role"],
+            status="valid",
+            correlation_id=data.get("correlation_id")
+        )
     else:
-        modt.logger.error(f"Identify Unit connection failed with code {rc}")
+        res_payload = modt.create_session_info_payload(
+            session_id=query_sid,
+            status="invalid",
+            correlation_id=data.get("correlation_id")
+        )
 
-def on_message(client, userdata, msg):
-    """MQTTメッセージ受信時の処理。"""
-    data, error = modt.parse_payload(msg.payload.decode())
-    if error:
-        modt.logger.error(f"Payload Error: {error}")
-        return
+    # reply_to が指定されていれば要求元だけに返信する
+    await mqtt_client.publish(modt.get_response_topic(data, modt.TOPIC_SESSION_INFO), res_payload)
 
-    # 1. アプリ準備完了通知の処理 (リダイレクトフロー)
-    if msg.topic == modt.TOPIC_APP_READY:
-        s_id = data.get("session_id")
-        redirect_url = data.get("redirect_url")
-        if s_id and redirect_url:
-            ready_apps[s_id] = redirect_url
-            modt.logger.info(f"Session {s_id} ready to redirect to {redirect_url}")
-
-    # 2. セッション照会リクエストの処理 (他ユニットからの身分確認)
-    elif msg.topic == modt.TOPIC_SESSION_QUERY:
-        query_sid = data.get("session_id")
-        modt.logger.info(f"Session query received for: {query_sid}")
-        
-        session_info = active_sessions.get(query_sid)
-        if session_info:
-            res_payload = modt.create_session_info_payload(
-                session_id=query_sid,
-                user_id=session_info["user_id"],
-                role=session_info["role"],
-                status="valid"
-            )
-        else:
-            res_payload = modt.create_session_info_payload(
-                session_id=query_sid,
-                status="invalid"
-            )
-        
-        client.publish(modt.TOPIC_SESSION_INFO, res_payload)
+def handle_session_revoked(data):
+    """他のワーカーで失効したセッションを、このワーカーのキャッシュからも破棄する"""
+    if data.get("session_id"):
+        active_sessions.forget(data["session_id"])
+
+async def publish_revoked(session_id, reason):
+    """セッションの失効を通知し、各ユニットのセッションキャッシュから破棄させます。"""
+    await mqtt_client.publish(modt.TOPIC_SESSION_REVOKED, modt.create_session_revoked_payload(session_id, reason))
+
+async def publish_expired_sessions(session_ids):
+    for session_id in session_ids:
+        await publish_revoked(session_id, "expired")
+
+async def dispatch(topic, handler, data):
+    # 計測が有効な場合は、ハンドラーの処理時間（応答の送信まで）を記録する
+    start = time.perf_counter() if metrics is not None and metrics.sampled() else None
+    error = False
+    try:
+        # 送信元のトレースを引き継ぎ、応答にも同じトレース ID を載せる
+        with modt.continue_trace(data, f"identify {topic}"):
+            result = handler(data)
+            if asyncio.iscoroutine(result):
+                await result
+    except Exception as e:
+        error = True
+        modt.logger.exception(f"Failed to handle message on {topic}: {e}")
+    if start is not None:
+        metrics.observe_worker(topic, time.perf_counter() - start, error)
+
+async def consume(topic, handler, concurrent=False):
+    """
+    topic を購読し、受信したメッセージを handler へ渡します。
+    concurrent が True の場合は 1 件ごとにタスクを作成し、ストアの応答待ちの間も次の照会を処理します。
+    1 件の処理で例外が起きても購読は継続します。
+    """
+    running = set()
+    async with mqtt_client.subscribe(topic) as subscription:
+        async for msg in subscription:
+            data, error = modt.parse_payload(msg.payload.decode())
+            if error:
+                modt.logger.error(f"Payload Error: {error}")
+                continue
+            if concurrent:
+                task = asyncio.create_task(dispatch(msg.topic, handler, data))
+                running.add(task)
+                task.add_done_callback(running.discard)
+            else:
+                await dispatch(msg.topic, handler, data)
 
-# MQTTクライアントの初期化
-mqtt_client = modt.get_mqtt_client(client_id="identify-unit-service")
-mqtt_client.on_connect = on_connect
-mqtt_client.on_message = on_message
+# MQTTクライアントの初期化（FastAPI のイベントループ上で送受信する非同期クライアント）
+# uvicorn のワーカーやレプリカごとに別の接続となるよう、クライアントIDは一意にする
+mqtt_client = modt.AsyncClient(client_id=f"identify-unit-service-{uuid.uuid4().hex[:8]}")
+# 受信数・送信数の計測（発行はイベントループ外のスレッドから行うため publish_threadsafe を使う）
+metrics = modt.setup_metrics(mqtt_client.client, mqtt_client.client_id, publish=mqtt_client.publish_threadsafe)
+# セッション照会は共有サブスクリプションで受け、ワーカーのうち 1 つだけが応答する
+SESSION_QUERY_SUBSCRIPTION = f"$share/identify/{modt.TOPIC_SESSION_QUERY}"
+consumer_tasks = []
 
 @app.on_event("startup")
-def startup_event():
-    """FastAPI起動時にMQTT接続を開始し、バックグラウンドループを起動します。"""
+async def startup_event():
+    """FastAPI起動時にセッションストアとハッシュ処理を準備してMQTT接続を開始し、購読タスクを起動します。"""
+    global password_hasher
+    password_hasher = PasswordHasher(workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING)
+    await active_sessions.setup()
+    consumer_tasks.append(asyncio.create_task(
+        run_sweeper(active_sessions, SESSION_SWEEP_SECONDS, on_expired=publish_expired_sessions)
+    ))
     try:
-        modt.connect_broker(mqtt_client)
-        # Webサーバーの裏でMQTTパケット処理を継続させるために必須
-        mqtt_client.loop_start()
-        modt.logger.info("MQTT background loop started in Identify Unit.")
+        await mqtt_client.connect()
     except Exception as e:
         modt.logger.error(f"MQTT Startup Error: {e}")
+        return
+    consumer_tasks.append(asyncio.create_task(consume(modt.TOPIC_APP_READY, handle_app_ready)))
+    consumer_tasks.append(asyncio.create_task(consume(SESSION_QUERY_SUBSCRIPTION, handle_session_query, concurrent=True)))
+    consumer_tasks.append(asyncio.create_task(consume(modt.TOPIC_SESSION_REVOKED, handle_session_revoked)))
+    consumer_tasks.append(asyncio.create_task(ready_apps.run_sweeper()))
+    modt.logger.info("MQTT consumers started in Identify Unit.")
 
 @app.on_event("shutdown")
-def shutdown_event():
-    """シャットダウン時にMQTT接続を安全に終了します。"""
-    mqtt_client.loop_stop()
-    modt.disconnect_broker(mqtt_client)
+async def shutdown_event():
+    """シャットダウン時に購読タスクとハッシュ処理を停止し、MQTT接続を安全に終了します。"""
+    for task in consumer_tasks:
+        task.cancel()
+    await asyncio.gather(*consumer_tasks, return_exceptions=True)
+    consumer_tasks.clear()
+    await mqtt_client.disconnect()
+    if password_hasher is not None:
+        password_hasher.shutdown()
+    await engine.dispose()
 
 @app.get("/", response_class=HTMLResponse)
 @app.get("/login", response_class=HTMLResponse)
@@ -111,41 +194,51 @@ def get_register(request: Request):
     return templates.TemplateResponse("register.html", {"request": request, "username": "", "error": None})
 
 @app.post("/register")
-def post_register(request: Request, username: str = Form(...), password: str = Form(...)):
+async def post_register(request: Request, username: str = Form(...), password: str = Form(...)):
     if len(password) < 8:
         return templates.TemplateResponse("register.html", {"request": request, "username": username, "error": "パスワードは8文字以上で入力してください"})
     
-    db = SessionLocal()
-    hashed_password = pwd_context.hash(password)
     try:
-        db.execute(text("INSERT INTO users (username, password_hash) VALUES (:u, :p)"), {"u": username, "p": hashed_password})
-        db.commit()
+        hashed_password = await password_hasher.hash(password)
+    except HasherBusy:
+        return templates.TemplateResponse("register.html", {"request": request, "username": username, "error": BUSY_MESSAGE}, status_code=503)
+    try:
+        await users.create(username, hashed_password)
         return RedirectResponse(url="/login", status_code=303)
     except Exception as e:
-        db.rollback()
         return templates.TemplateResponse("register.html", {"request": request, "username": username, "error": "そのユーザー名は使用できません"})
-    finally:
-        db.close()
 
 @app.post("/login")
-def post_login(request: Request, username: str = Form(...), password: str = Form(...)):
-    db = SessionLocal()
-    user = db.execute(text("SELECT id, username, password_hash, role FROM users WHERE username = :u"), {"u": username}).fetchone()
-    db.close()
-    
-    if user and pwd_context.verify(password, user.password_hash):
-        session_id = str(uuid.uuid4())
-        user_id_str = str(user.id)
-        
-        active_sessions[session_id] = {
-            "user_id": user_id_str,
-            "role": user.role
-        }
-        
-        # 認証成功イベントを発行 (SDKの定数を利用)
-        payload = modt.create_auth_success_payload(user_id_str, session_id, user.role)
-        mqtt_client.publish(modt.TOPIC_AUTH_SUCCESS, payload)
-        
+async def post_login(request: Request, username: str = Form(...), password: str = Form(...)):
+    # ログインの各段階をスパンとして記録し、認証成功の通知から先のリダイレクトまでを 1 つのトレースにまとめる
+    with modt.span("identify login") as login_span:
+        # DB 参照は非同期の接続プールで、CPU を占有する bcrypt の検証はプロセスプールで実行する
+        with modt.span("identify find_user"):
+            user = await users.find_by_username(username)
+
+        try:
+            with modt.span("identify verify_password"):
+                verified = bool(user) and await password_hasher.verify(password, user.password_hash)
+        except HasherBusy:
+            login_span.set(busy=True)
+            return templates.TemplateResponse("login.html", {"request": request, "username": username, "error": BUSY_MESSAGE}, status_code=503)
+        login_span.set(verified=verified)
+
+        if verified:
+            session_id = str(uuid.uuid4())
+            user_id_str = str(user.id)
+
+            with modt.span("identify session_put"):
+                await active_sessions.put(session_id, {
+                    "user_id": user_id_str,
+                    "role": user.role
+                })
+
+            # 認証成功イベントを発行 (SDKの定数を利用)
+            payload = modt.create_auth_success_payload(user_id_str, session_id, user.role)
+            await mqtt_client.publish(modt.TOPIC_AUTH_SUCCESS, payload)
+
+    if verified:
         response = RedirectResponse(url=f"/waiting?session_id={session_id}", status_code=303)
         response.set_cookie(
             key="modt_session_id", 
@@ -154,10 +247,35 @@ def post_login(request: Request, username: str = Form(...), password: str = Form
             samesite="lax",
             path="/"
         )
+        if SESSION_SECRET:
+            # 各ユニットがネットワークを介さずに検証できる署名付きトークン（有効期限はセッションと同じ）
+            token = modt.create_session_token(session_id, user_id_str, user.role, SESSION_TTL_SECONDS, SESSION_SECRET)
+            response.set_cookie(
+                key=modt.SESSION_TOKEN_COOKIE,
+                value=token,
+                max_age=int(SESSION_TTL_SECONDS),
+                httponly=True,
+                samesite="lax",
+                path="/"
+            )
         return response
     
     return templates.TemplateResponse("login.html", {"request": request, "username": username, "error": "認証に失敗しました"})
 
+@app.get("/logout")
+async def logout(request: Request):
+    """セッションを削除して失効を通知し、Cookie を消去してログイン画面へ戻します。"""
+    session_id = request.cookies.get("modt_session_id")
+    if session_id:
+        await active_sessions.delete(session_id)
+        await publish_revoked(session_id, "logout")
+        modt.logger.info(f"Session logged out: {session_id}")
+
+    response = RedirectResponse(url="/login", status_code=303)
+    response.delete_cookie("modt_session_id", path="/")
+    response.delete_cookie(modt.SESSION_TOKEN_COOKIE, path="/")
+    return response
+
 @app.get("/waiting", response_class=HTMLResponse)
 def get_waiting(request: Request, session_id: str):
     return templates.TemplateResponse("waiting.html", {"request": request, "session_id": session_id})
@@ -166,13 +284,33 @@ def get_waiting(request: Request, session_id: str):
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
     await websocket.accept()
     modt.logger.info(f"WebSocket connected: session_id = {session_id}")
+
+    # アプリ準備完了の通知と、ブラウザ側の切断のどちらか早い方を待つ
+    wait_task = asyncio.create_task(ready_apps.wait(session_id, timeout=REDIRECT_WAIT_SECONDS))
+    receive_task = asyncio.create_task(websocket.receive())
     try:
-        while True:
-            if session_id in ready_apps:
-                redirect_url = ready_apps.pop(session_id)
-                modt.logger.info(f"Match found for session {session_id}. Sending URL: {redirect_url}")
-                await websocket.send_json({"ready": True, "url": redirect_url})
-                break
-            await asyncio.sleep(0.5)
+        await asyncio.wait({wait_task, receive_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not wait_task.done():
+            modt.logger.info(f"WebSocket disconnected for session: {session_id}")
+            return
+        try:
+            result = wait_task.result()
+        except TooManyWaiters as e:
+            modt.logger.warning(f"Rejecting WebSocket for session {session_id}: {e}")
+            # 1013 (Try Again Later): 待機数の上限に達しているため後で再接続してもらう
+            await websocket.close(code=1013)
+            return
+        if result is None:
+            modt.logger.warning(f"Redirect wait timed out for session: {session_id}")
+            await websocket.close()
+            return
+        redirect_url, trace = result
+        modt.logger.info(f"Match found for session {session_id}. Sending URL: {redirect_url}")
+        # modt/app/ready を受けたときのトレースに、ブラウザへの送信を加える
+        with modt.continue_trace(trace, "identify redirect_push"):
+            await websocket.send_json({"ready": True, "url": redirect_url})
     except WebSocketDisconnect:
-        modt.logger.info(f"WebSocket disconnected for session: {session_id}")
\ No newline at end of file
+        modt.logger.info(f"WebSocket disconnected for session: {session_id}")
+    finally:
+        for task in (wait_task, receive_task):
+            task.cancel()
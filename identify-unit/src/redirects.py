@@ -0,0 +1,93 @@
+import time
+import asyncio
+from common import modt
+
+
+class TooManyWaiters(Exception):
+    """同時に待機できるリダイレクト待ちの上限に達したことを表します。"""
+
+
+class RedirectBoard:
+    """
+    セッションごとのリダイレクト先 URL を受け渡す掲示板です。
+    modt/app/ready の受信時に publish() し、待機画面の WebSocket は wait() で通知を待ちます。
+    URL には通知を受けたときのトレース（modt.current_trace()）を添え、WebSocket での送信を同じトレースに記録できるようにします。
+    待機中のセッションには Future 経由で即座に URL を届け、まだ誰も待っていないセッションの URL は
+    ttl 秒だけ保持して後から接続したブラウザに渡します。
+    すべてのメソッドはイベントループのスレッドから呼び出してください。
+    """
+
+    def __init__(self, ttl=60.0, max_waiters=1000):
+        self.ttl = float(ttl)
+        self.max_waiters = int(max_waiters)
+        self._ready = {}    # session_id -> ((redirect_url, trace), 期限の monotonic 時刻)
+        self._waiters = {}  # session_id -> 待機中の Future の集合
+        self._waiter_count = 0
+
+    def publish(self, session_id, redirect_url, trace=None):
+        """リダイレクト先を登録し、待機中のブラウザがあれば即座に通知します。"""
+        entry = (redirect_url, trace)
+        futures = self._waiters.get(session_id)
+        delivered = False
+        if futures:
+            for future in futures:
+                if not future.done():
+                    future.set_result(entry)
+                    delivered = True
+        if not delivered:
+            self._ready[session_id] = (entry, time.monotonic() + self.ttl)
+
+    def _take_ready(self, session_id):
+        ready = self._ready.pop(session_id, None)
+        if ready is None:
+            return None
+        entry, expires_at = ready
+        if expires_at <= time.monotonic():
+            return None
+        return entry
+
+    async def wait(self, session_id, timeout=None):
+        """
+        リダイレクト先が届くまで待機し、(redirect_url, trace) を返します。timeout 秒以内に届かなければ None を返します。
+        待機数が上限に達している場合は TooManyWaiters を送出します。
+        """
+        entry = self._take_ready(session_id)
+        if entry is not None:
+            return entry
+        if self._waiter_count >= self.max_waiters:
+            raise TooManyWaiters(f"redirect waiters limit ({self.max_waiters}) reached")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(session_id, set()).add(future)
+        self._waiter_count += 1
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._waiter_count -= 1
+            futures = self._waiters.get(session_id)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self._waiters[session_id]
+
+    def sweep(self):
+        """期限切れの未受け取りエントリを削除し、削除件数を返します。"""
+        now = time.monotonic()
+        expired = [sid for sid, (_, expires_at) in self._ready.items() if expires_at <= now]
+        for sid in expired:
+            del self._ready[sid]
+        return len(expired)
+
+    async def run_sweeper(self, interval=None):
+        """sweep() を定期的に実行するバックグラウンドタスクです。"""
+        interval = interval or max(1.0, self.ttl / 2)
+        while True:
+            await asyncio.sleep(interval)
+            removed = self.sweep()
+            if removed:
+                modt.logger.info(f"Evicted {removed} unclaimed redirect entries.")
+
+    def stats(self):
+        return {"ready": len(self._ready), "waiters": self._waiter_count}
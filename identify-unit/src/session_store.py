@@ -0,0 +1,194 @@
+import time
+import asyncio
+from datetime import datetime, timezone
+from sqlalchemy import text
+from common import modt
+
+# sessions テーブルの定義（db/init/01_init.sql と同じ内容。既存のデータベースには起動時に作成する）
+CREATE_SESSIONS_SQL = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id VARCHAR(64) PRIMARY KEY,
+    user_id VARCHAR(64) NOT NULL,
+    role VARCHAR(20) NOT NULL,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+)
+"""
+CREATE_SESSIONS_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)"
+
+
+class MemorySessionStore:
+    """
+    プロセス内の辞書にセッションを保持するストアです。
+    ワーカー間で共有されないため、単一プロセスで動かす場合や開発用に使用します。
+    """
+
+    def __init__(self, ttl=86400.0):
+        self.ttl = float(ttl)
+        self._sessions = {}  # session_id -> (セッション情報, 期限の monotonic 時刻)
+
+    async def setup(self):
+        pass
+
+    async def get(self, session_id):
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        info, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._sessions.pop(session_id, None)
+            return None
+        return info
+
+    async def put(self, session_id, info):
+        self._sessions[session_id] = (info, time.monotonic() + self.ttl)
+
+    async def delete(self, session_id):
+        self._sessions.pop(session_id, None)
+
+    def forget(self, session_id):
+        pass
+
+    async def sweep(self):
+        now = time.monotonic()
+        expired = [sid for sid, (_, expires_at) in self._sessions.items() if expires_at <= now]
+        for sid in expired:
+            del self._sessions[sid]
+        return expired
+
+
+class SqlSessionStore:
+    """
+    SQLAlchemy の非同期エンジン上の sessions テーブルにセッションを保持するストアです。
+    すべてのワーカー・レプリカが同じテーブルを参照するため、どのプロセスでもセッションを照会できます。
+    """
+
+    def __init__(self, engine, ttl=86400.0):
+        self.engine = engine
+        self.ttl = float(ttl)
+
+    async def setup(self):
+        """sessions テーブルが存在しなければ作成します。"""
+        async with self.engine.begin() as conn:
+            await conn.execute(text(CREATE_SESSIONS_SQL))
+            await conn.execute(text(CREATE_SESSIONS_INDEX_SQL))
+
+    async def get(self, session_id):
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(
+                text("SELECT user_id, role FROM sessions WHERE session_id = :s AND expires_at > :now"),
+                {"s": session_id, "now": datetime.now(timezone.utc)}
+            )).fetchone()
+        if row is None:
+            return None
+        return {"user_id": row.user_id, "role": row.role}
+
+    async def put(self, session_id, info):
+        expires_at = datetime.fromtimestamp(time.time() + self.ttl, timezone.utc)
+        async with self.engine.begin() as conn:
+            # セッションIDは UUID で衝突しないため、ログインごとに新しい行を挿入するだけでよい
+            await conn.execute(
+                text("INSERT INTO sessions (session_id, user_id, role, expires_at) VALUES (:s, :u, :r, :e)"),
+                {"s": session_id, "u": info["user_id"], "r": info["role"], "e": expires_at}
+            )
+
+    async def delete(self, session_id):
+        async with self.engine.begin() as conn:
+            await conn.execute(text("DELETE FROM sessions WHERE session_id = :s"), {"s": session_id})
+
+    def forget(self, session_id):
+        pass
+
+    async def sweep(self):
+        # RETURNING で削除した行だけを受け取るため、複数のワーカーが同時に掃除しても同じセッションが重複して返ることはない
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                text("DELETE FROM sessions WHERE expires_at <= :now RETURNING session_id"),
+                {"now": datetime.now(timezone.utc)}
+            )
+            return [row.session_id for row in result]
+
+
+class CachedSessionStore:
+    """
+    共有ストアの前段に置く、プロセス内の短命なキャッシュです。
+    同じセッションへの照会が続く場合に共有ストアへの問い合わせを省きます。
+    見つからなかった結果はキャッシュしないため、他のワーカーで作成された直後のセッションも必ず参照できます。
+    """
+
+    def __init__(self, backend, ttl=5.0, max_entries=10000):
+        self.backend = backend
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self._cache = {}  # session_id -> (セッション情報, 期限の monotonic 時刻)
+
+    async def setup(self):
+        await self.backend.setup()
+
+    async def get(self, session_id):
+        entry = self._cache.get(session_id)
+        if entry is not None:
+            info, expires_at = entry
+            if expires_at > time.monotonic():
+                return info
+            del self._cache[session_id]
+        info = await self.backend.get(session_id)
+        if info is not None:
+            self._remember(session_id, info)
+        return info
+
+    async def put(self, session_id, info):
+        await self.backend.put(session_id, info)
+        self._remember(session_id, info)
+
+    async def delete(self, session_id):
+        self._cache.pop(session_id, None)
+        await self.backend.delete(session_id)
+
+    def forget(self, session_id):
+        """他のワーカーで失効したセッションをキャッシュからのみ破棄します。"""
+        self._cache.pop(session_id, None)
+
+    async def sweep(self):
+        now = time.monotonic()
+        for sid in [sid for sid, (_, expires_at) in self._cache.items() if expires_at <= now]:
+            del self._cache[sid]
+        return await self.backend.sweep()
+
+    def _remember(self, session_id, info):
+        if len(self._cache) >= self.max_entries:
+            # 挿入順で最も古いエントリを捨てる
+            self._cache.pop(next(iter(self._cache)))
+        # キャッシュの期限は共有ストアより短く、期限切れのセッションを長く返し続けることはない
+        self._cache[session_id] = (info, time.monotonic() + self.ttl)
+
+
+def create_session_store(backend, engine=None, ttl=86400.0, cache_ttl=5.0):
+    """
+    backend に応じたセッションストアを生成します。使用前に await store.setup() を呼び出してください。
+    "sql"（既定）は共有テーブルの前段にプロセス内キャッシュを置いた構成、"memory" はプロセス内のみの構成です。
+    """
+    if backend == "memory":
+        return MemorySessionStore(ttl)
+    if backend == "sql":
+        store = SqlSessionStore(engine, ttl)
+        if cache_ttl > 0:
+            return CachedSessionStore(store, cache_ttl)
+        return store
+    raise ValueError(f"Unknown session backend: {backend}")
+
+
+async def run_sweeper(store, interval=300.0, on_expired=None):
+    """
+    期限切れのセッションを定期的に削除するバックグラウンドタスクです。
+    on_expired を指定すると、削除したセッションIDのリストを渡して呼び出します（コルーチン関数）。
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            expired = await store.sweep()
+            if expired:
+                modt.logger.info(f"Removed {len(expired)} expired sessions.")
+                if on_expired is not None:
+                    await on_expired(expired)
+        except Exception as e:
+            modt.logger.error(f"Session sweep failed: {e}")
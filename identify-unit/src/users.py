@@ -0,0 +1,90 @@
+import time
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+# 文字列から毎回組み立てず、モジュールで一度だけ生成して SQLAlchemy のコンパイル済みキャッシュを効かせる
+FIND_USER_SQL = text("SELECT id, username, password_hash, role FROM users WHERE username = :u")
+INSERT_USER_SQL = text("INSERT INTO users (username, password_hash) VALUES (:u, :p)")
+
+# 同期ドライバーの URL を非同期ドライバーの URL に置き換えるための対応表
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def create_engine_from_url(database_url, pool_size=10, max_overflow=10, pool_recycle=1800, statement_cache_size=500):
+    """
+    DATABASE_URL から非同期エンジンを生成します。
+    postgresql:// は asyncpg、sqlite:/// は aiosqlite（テスト・開発用）に読み替えます。
+    asyncpg では接続ごとにプリペアドステートメントを statement_cache_size 件までキャッシュし、
+    同じクエリの再実行では解析・計画を省略します。
+    """
+    url = make_url(database_url)
+    url = url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+    if url.drivername.startswith("sqlite"):
+        return create_async_engine(url)
+    if url.drivername == "postgresql+asyncpg":
+        url = url.update_query_dict({"prepared_statement_cache_size": str(statement_cache_size)})
+    return create_async_engine(
+        url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=True,
+        pool_recycle=pool_recycle,
+    )
+
+
+class UserRecord:
+    """ログイン処理に必要な users テーブルの 1 行です。"""
+
+    __slots__ = ("id", "username", "password_hash", "role")
+
+    def __init__(self, id, username, password_hash, role):
+        self.id = id
+        self.username = username
+        self.password_hash = password_hash
+        self.role = role
+
+
+class UserRepository:
+    """
+    非同期エンジン上で users テーブルを参照・登録します。
+    ユーザー名で引いた行は cache_ttl 秒だけプロセス内に保持し、ログインの再試行が続いても毎回 DB へ問い合わせません。
+    存在しなかった結果は保持しないため、他のワーカーで登録された直後のユーザーもすぐにログインできます。
+    """
+
+    def __init__(self, engine, cache_ttl=30.0, max_entries=10000):
+        self.engine = engine
+        self.cache_ttl = float(cache_ttl)
+        self.max_entries = int(max_entries)
+        self._cache = {}  # username -> (UserRecord, 期限の monotonic 時刻)
+
+    async def find_by_username(self, username):
+        """ユーザー名に一致する UserRecord を返します。存在しなければ None を返します。"""
+        entry = self._cache.get(username)
+        if entry is not None:
+            record, expires_at = entry
+            if expires_at > time.monotonic():
+                return record
+            del self._cache[username]
+
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(FIND_USER_SQL, {"u": username})).fetchone()
+        if row is None:
+            return None
+        record = UserRecord(row.id, row.username, row.password_hash, row.role)
+        if self.cache_ttl > 0:
+            if len(self._cache) >= self.max_entries:
+                # 挿入順で最も古いエントリを捨てる
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[username] = (record, time.monotonic() + self.cache_ttl)
+        return record
+
+    async def create(self, username, password_hash):
+        """ユーザーを登録します。ユーザー名が重複している場合はデータベースの例外がそのまま送出されます。"""
+        async with self.engine.begin() as conn:
+            await conn.execute(INSERT_USER_SQL, {"u": username, "p": password_hash})
+        self._cache.pop(username, None)
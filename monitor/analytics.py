@@ -0,0 +1,188 @@
+import time
+import threading
+from collections import OrderedDict
+from common import modt
+
+# 応答時間を計測するリクエストと応答の組: リクエストトピック -> (名前, 既定の応答トピック, 対応付けに使うフィールド)
+# reply_to 付きのリクエストは correlation_id で、従来のリクエストは共有トピック上のフィールドの値で応答と対応付ける
+LATENCY_PAIRS = {
+    modt.TOPIC_SESSION_QUERY: ("session", modt.TOPIC_SESSION_INFO, ("session_id",)),
+    modt.TOPIC_STATE_GET: ("state_get", modt.TOPIC_STATE_VAL, ("user_id", "key")),
+    modt.TOPIC_STATE_ALL_GET: ("state_all", modt.TOPIC_STATE_ALL_VAL, ("user_id",)),
+}
+RESPONSE_TOPICS = {response: fields for _, response, fields in LATENCY_PAIRS.values()}
+# 集計対象のトピック数の上限を超えた分をまとめる名前
+OTHER_TOPICS = modt.OTHER_TOPICS
+
+
+class RollingWindow:
+    """
+    直近 window 秒の件数・合計値・値の分布を、slots 個の区間に分けて保持します。
+    古い区間は参照時に再利用されるため、メモリ使用量は観測した件数に関係なく一定です。
+    """
+
+    def __init__(self, window=60.0, slots=6):
+        self.slot_seconds = float(window) / slots
+        self._slots = [[-1, 0, 0, modt.LogHistogram()] for _ in range(slots)]  # [区間番号, 件数, 合計値, 分布]
+
+    def add(self, value, now):
+        slot_id = int(now / self.slot_seconds)
+        slot = self._slots[slot_id % len(self._slots)]
+        if slot[0] != slot_id:
+            slot[0], slot[1], slot[2], slot[3] = slot_id, 0, 0, modt.LogHistogram()
+        slot[1] += 1
+        slot[2] += value
+        slot[3].add(value)
+
+    def summary(self, now):
+        """(件数, 合計値, 分布) を直近 window 秒分まとめて返します。"""
+        current = int(now / self.slot_seconds)
+        count = total = 0
+        histogram = modt.LogHistogram()
+        for slot_id, slot_count, slot_total, slot_histogram in self._slots:
+            if current - len(self._slots) < slot_id <= current:
+                count += slot_count
+                total += slot_total
+                histogram.merge(slot_histogram)
+        return count, total, histogram
+
+
+class TrafficStats:
+    """
+    監視しているメッセージから、トピックごとの流量（件数・バイト数・ペイロードサイズの分布）と、
+    リクエストから応答までの時間の分布を直近 window 秒の範囲で集計します。
+
+    - 集計するトピックは max_topics 種類まで（超えた分は "(other)" にまとめる）です。
+    - 応答待ちのリクエストは max_pending 件まで、pending_timeout 秒を過ぎたものは「応答なし」として破棄します。
+    いずれもメモリ使用量はトラフィック量に関係なく一定です。MQTT のスレッドと集計の出力スレッドから呼べるよう、ロックで保護します。
+    """
+
+    def __init__(self, window=60.0, slots=6, max_topics=200, max_pending=10000, pending_timeout=30.0):
+        self.window = float(window)
+        self.slots = slots
+        self.max_topics = max_topics
+        self.max_pending = max_pending
+        self.pending_timeout = float(pending_timeout)
+        self.started_at = time.monotonic()
+        self._topics = {}  # 正規化したトピック -> RollingWindow（ペイロードのバイト数）
+        self._latency = {name: RollingWindow(window, slots) for name, _, _ in LATENCY_PAIRS.values()}  # 名前 -> RollingWindow（マイクロ秒）
+        self._pending = OrderedDict()  # 対応付けのキー -> (名前, 受信時刻)
+        self._unanswered = {name: 0 for name in self._latency}
+        self._lock = threading.Lock()
+
+    def observe(self, topic, payload, now=None):
+        """受信した 1 件のメッセージを集計に加えます。payload はバイト列です。"""
+        now = time.monotonic() if now is None else now
+        name = modt.normalize_topic(topic)
+        base = modt.get_base_topic(topic)
+        # 応答時間の対応付けに関係するメッセージだけを解析する
+        data = None
+        if base in LATENCY_PAIRS or base in RESPONSE_TOPICS or name == "modt/+/reply":
+            data = self._parse(payload)
+
+        with self._lock:
+            window = self._topics.get(name)
+            if window is None:
+                if len(self._topics) >= self.max_topics:
+                    name = OTHER_TOPICS
+                window = self._topics.get(name)
+                if window is None:
+                    window = self._topics[name] = RollingWindow(self.window, self.slots)
+            window.add(len(payload), now)
+
+            if data is not None:
+                if base in LATENCY_PAIRS:
+                    self._on_request(base, data, now)
+                else:
+                    self._on_response(base, data, now)
+
+    @staticmethod
+    def _parse(payload):
+        try:
+            data, error = modt.parse_payload(payload.decode("utf-8"))
+        except UnicodeDecodeError:
+            return None
+        return data if not error and isinstance(data, dict) else None
+
+    def _on_request(self, topic, data, now):
+        name, response_topic, fields = LATENCY_PAIRS[topic]
+        correlation_id = data.get("correlation_id")
+        if correlation_id:
+            key = ("cid", correlation_id)
+        else:
+            key = (response_topic,) + tuple(data.get(field) for field in fields)
+        self._pending.pop(key, None)
+        self._pending[key] = (name, now)
+        # 古い順に並んでいるため、先頭から期限切れ・上限超過の分を破棄する
+        while self._pending:
+            oldest_name, sent_at = next(iter(self._pending.values()))
+            if len(self._pending) <= self.max_pending and now - sent_at <= self.pending_timeout:
+                break
+            self._pending.popitem(last=False)
+            self._unanswered[oldest_name] += 1
+
+    def _on_response(self, topic, data, now):
+        correlation_id = data.get("correlation_id")
+        if correlation_id:
+            entry = self._pending.pop(("cid", correlation_id), None)
+        elif topic in RESPONSE_TOPICS:
+            entry = self._pending.pop((topic,) + tuple(data.get(field) for field in RESPONSE_TOPICS[topic]), None)
+        else:
+            entry = None
+        if entry is not None:
+            name, sent_at = entry
+            self._latency[name].add((now - sent_at) * 1_000_000, now)
+
+    def snapshot(self, now=None):
+        """直近 window 秒の集計結果を、JSON に変換できる辞書で返します。"""
+        now = time.monotonic() if now is None else now
+        # 起動直後は経過時間で割り、流量を過小評価しない
+        seconds = max(min(self.window, now - self.started_at), 1e-9)
+        with self._lock:
+            topics = {}
+            for name, window in self._topics.items():
+                count, total, sizes = window.summary(now)
+                if count == 0:
+                    continue
+                topics[name] = {
+                    "rate": round(count / seconds, 2),
+                    "bytes_per_sec": round(total / seconds, 1),
+                    "size_p50": round(sizes.percentile(50)),
+                    "size_p90": round(sizes.percentile(90)),
+                    "size_p99": round(sizes.percentile(99)),
+                }
+            latency = {}
+            for name, window in self._latency.items():
+                count, _, latencies = window.summary(now)
+                latency[name] = {
+                    "count": count,
+                    "p50_ms": round(latencies.percentile(50) / 1000, 3),
+                    "p90_ms": round(latencies.percentile(90) / 1000, 3),
+                    "p99_ms": round(latencies.percentile(99) / 1000, 3),
+                    "max_ms": round(latencies.max / 1000, 3),
+                    "unanswered": self._unanswered[name],
+                }
+            pending = len(self._pending)
+        return {
+            "window_seconds": round(seconds, 1),
+            "rate": round(sum(t["rate"] for t in topics.values()), 2),
+            "bytes_per_sec": round(sum(t["bytes_per_sec"] for t in topics.values()), 1),
+            "topics": topics,
+            "latency": latency,
+            "pending": pending,
+        }
+
+
+def format_summary(snapshot, top=5):
+    """スナップショットを 1 行の要約にします（流量の多い順に top 件のトピックと、各応答時間）。"""
+    parts = [f"{snapshot['rate']:.1f} msg/s {snapshot['bytes_per_sec'] / 1024:.1f} KB/s"]
+    busiest = sorted(snapshot["topics"].items(), key=lambda item: item[1]["rate"], reverse=True)[:top]
+    parts.append(", ".join(
+        f"{name} {stats['rate']:.1f}/s p50={stats['size_p50']}B p99={stats['size_p99']}B"
+        for name, stats in busiest
+    ) or "no traffic")
+    parts.append(", ".join(
+        f"{name} p50={stats['p50_ms']}ms p99={stats['p99_ms']}ms n={stats['count']}"
+        for name, stats in snapshot["latency"].items() if stats["count"]
+    ) or "no replies")
+    return " | ".join(parts)
@@ -0,0 +1,233 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+
+# キャプチャファイル（.cap）とインデックスファイル（.idx）の先頭に置く識別子
+CAPTURE_MAGIC = b"MODTCAP1"
+INDEX_MAGIC = b"MODTIDX1"
+# レコードのヘッダー: 受信時刻（ns）、トピックのバイト数、ペイロードのバイト数
+RECORD_HEADER = struct.Struct("<QHI")
+# インデックスの 1 件: 受信時刻（ns）、.cap 内のオフセット、トピックの CRC32
+INDEX_ENTRY = struct.Struct("<QQI")
+
+
+def topic_hash(topic):
+    """インデックスに記録するトピックのハッシュ（CRC32）を返します。"""
+    return zlib.crc32(topic.encode("utf-8"))
+
+
+def list_capture_files(path, prefix="capture"):
+    """
+    path がファイルならそれだけを、ディレクトリなら中の prefix-*.cap を古い順に返します。
+    ファイル名に作成時刻（ns）が入っているため、名前順が時刻順になります。
+    """
+    if os.path.isfile(path):
+        return [path]
+    names = sorted(
+        name for name in os.listdir(path)
+        if name.startswith(prefix + "-") and name.endswith(".cap")
+    )
+    return [os.path.join(path, name) for name in names]
+
+
+class CaptureWriter:
+    """
+    受信したメッセージを (受信時刻, トピック, ペイロード) のバイナリレコードとして追記します。
+
+    - 書き込みは buffer_size バイトのバッファを介して行い、flush_interval 秒ごと（または close 時）にだけ
+      OS へ書き出すため、1 件ごとのシステムコールやフラッシュは発生しません。
+    - ファイルが max_bytes を超えると新しいファイルへ切り替えます（ローテーション）。
+    - 各レコードの受信時刻・オフセット・トピックのハッシュを固定長のインデックス（.idx）にも書き、
+      CaptureReader が mmap で時刻やトピックから位置を引けるようにします。
+
+    MQTT のネットワークスレッドから 1 スレッドで呼び出す前提で、ロックは取りません。
+    """
+
+    def __init__(self, directory, prefix="capture", max_bytes=256 * 1024 * 1024, buffer_size=1024 * 1024, flush_interval=1.0):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = int(max_bytes)
+        self.buffer_size = int(buffer_size)
+        self.flush_interval = float(flush_interval)
+        self.records = 0
+        self.bytes_written = 0
+        self.files = 0
+        self.path = None
+        self._data = None
+        self._index = None
+        self._size = 0
+        self._last_flush = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self, timestamp_ns):
+        self._close_files()
+        path = os.path.join(self.directory, f"{self.prefix}-{timestamp_ns:020d}.cap")
+        self._data = open(path, "wb", buffering=self.buffer_size)
+        self._index = open(path[:-len(".cap")] + ".idx", "wb", buffering=self.buffer_size)
+        self._data.write(CAPTURE_MAGIC)
+        self._index.write(INDEX_MAGIC)
+        self._size = len(CAPTURE_MAGIC)
+        self.files += 1
+        self.path = path
+
+    def write(self, topic, payload, timestamp_ns=None):
+        """1 件のメッセージを追記します。payload はバイト列、timestamp_ns を省略した場合は現在時刻です。"""
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        topic_bytes = topic.encode("utf-8")
+        if self._data is None or self._size >= self.max_bytes:
+            self._open(timestamp_ns)
+
+        offset = self._size
+        self._data.write(RECORD_HEADER.pack(timestamp_ns, len(topic_bytes), len(payload)))
+        self._data.write(topic_bytes)
+        self._data.write(payload)
+        self._index.write(INDEX_ENTRY.pack(timestamp_ns, offset, zlib.crc32(topic_bytes)))
+        size = RECORD_HEADER.size + len(topic_bytes) + len(payload)
+        self._size += size
+        self.records += 1
+        self.bytes_written += size
+
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            self.flush()
+            self._last_flush = now
+
+    def flush(self):
+        # インデックスが指すレコードが必ずファイル上に存在するよう、データを先に書き出す
+        if self._data is not None:
+            self._data.flush()
+            self._index.flush()
+
+    def _close_files(self):
+        if self._data is not None:
+            self.flush()
+            self._data.close()
+            self._index.close()
+            self._data = self._index = None
+
+    def close(self):
+        self._close_files()
+
+
+class CaptureReader:
+    """
+    1 つのキャプチャファイルを mmap で読み込みます。
+
+    インデックス（.idx）があればそれも mmap し、受信時刻の二分探索とトピックのハッシュ比較で
+    読み込むレコードを絞り込みます。インデックスがない・途中までしかない場合（異常終了時など）は、
+    残りをキャプチャファイルの先頭から順に読み進めて補います。末尾の書きかけのレコードは無視します。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        if self._data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a MoDT capture file")
+        self._index = self._index_file = None
+        self._count = 0
+        self._load_index(path[:-len(".cap")] + ".idx" if path.endswith(".cap") else path + ".idx")
+
+    def _load_index(self, index_path):
+        if not os.path.exists(index_path) or os.path.getsize(index_path) <= len(INDEX_MAGIC):
+            return
+        self._index_file = open(index_path, "rb")
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._index[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            self._index.close()
+            self._index_file.close()
+            self._index = self._index_file = None
+            return
+        self._count = (len(self._index) - len(INDEX_MAGIC)) // INDEX_ENTRY.size
+
+    def _entry(self, i):
+        return INDEX_ENTRY.unpack_from(self._index, len(INDEX_MAGIC) + i * INDEX_ENTRY.size)
+
+    def _find_time(self, start_ns):
+        """受信時刻が start_ns 以上になる最初のインデックスの番号を、mmap 上で直接二分探索して返します。"""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < start_ns:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _read_record(self, offset):
+        """offset のレコードを (受信時刻, トピック, ペイロード, 次のレコードのオフセット) で返します。書きかけなら None です。"""
+        end = offset + RECORD_HEADER.size
+        if end > len(self._data):
+            return None
+        timestamp_ns, topic_len, payload_len = RECORD_HEADER.unpack_from(self._data, offset)
+        payload_start = end + topic_len
+        next_offset = payload_start + payload_len
+        if next_offset > len(self._data):
+            return None
+        topic = self._data[end:payload_start].decode("utf-8")
+        return timestamp_ns, topic, self._data[payload_start:next_offset], next_offset
+
+    def records(self, start_ns=None, end_ns=None, topic=None):
+        """
+        (受信時刻 ns, トピック, ペイロードのバイト列) を記録順に返すジェネレーターです。
+        start_ns 以上 end_ns 未満の受信時刻、topic に一致するトピックのレコードだけを返します。
+        """
+        wanted = topic_hash(topic) if topic is not None else None
+        first = self._find_time(start_ns) if start_ns is not None else 0
+        offset = len(CAPTURE_MAGIC)
+        for i in range(first, self._count):
+            timestamp_ns, offset, crc = self._entry(i)
+            if end_ns is not None and timestamp_ns >= end_ns:
+                return
+            if wanted is not None and crc != wanted:
+                continue
+            record = self._read_record(offset)
+            if record is None:
+                return
+            if topic is None or record[1] == topic:
+                yield record[:3]
+
+        # インデックスに載っていない末尾のレコードは順に読む
+        if self._count:
+            record = self._read_record(self._entry(self._count - 1)[1])
+            if record is None:
+                return
+            offset = record[3]
+        while True:
+            record = self._read_record(offset)
+            if record is None:
+                return
+            timestamp_ns, record_topic, payload, offset = record
+            if start_ns is not None and timestamp_ns < start_ns:
+                continue
+            if end_ns is not None and timestamp_ns >= end_ns:
+                return
+            if topic is None or record_topic == topic:
+                yield timestamp_ns, record_topic, payload
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+            self._index_file.close()
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_capture(path, prefix="capture", start_ns=None, end_ns=None, topic=None):
+    """path（ファイルまたはディレクトリ）内のキャプチャを古い順にまとめて読み込みます。"""
+    for file_path in list_capture_files(path, prefix):
+        with CaptureReader(file_path) as reader:
+            # mmap のスライスはバイト列のコピーになるため、ファイルを閉じた後も値は有効
+            yield from reader.records(start_ns, end_ns, topic)
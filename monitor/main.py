@@ -1,6 +1,32 @@
+import os
 import time
 import json
+import uuid
+import signal
+import threading
 from common import modt
+from capture import CaptureWriter
+from analytics import TrafficStats, format_summary
+
+# 動作モード: pretty（整形して表示）/ capture（バイナリ形式でファイルに記録）/ analytics（流量と応答時間の集計）
+# カンマ区切りで複数指定できる（例: capture,analytics）
+MONITOR_MODES = {mode.strip() for mode in os.getenv("MONITOR_MODE", "pretty").split(",") if mode.strip()}
+# キャプチャの保存先、1 ファイルの上限サイズ、書き込みバッファの大きさ、ディスクへ書き出す間隔
+CAPTURE_DIR = os.getenv("MONITOR_CAPTURE_DIR", "/app/captures")
+CAPTURE_MAX_MB = float(os.getenv("MONITOR_CAPTURE_MAX_MB", "256"))
+CAPTURE_BUFFER_KB = int(os.getenv("MONITOR_CAPTURE_BUFFER_KB", "1024"))
+CAPTURE_FLUSH_SECONDS = float(os.getenv("MONITOR_CAPTURE_FLUSH_SECONDS", "1"))
+# キャプチャモードで記録状況をログに出す間隔（秒）
+CAPTURE_REPORT_SECONDS = 60.0
+# 集計の出力間隔（秒）、集計の対象とする直近の秒数、集計するトピックの種類の上限
+STATS_INTERVAL_SECONDS = float(os.getenv("MONITOR_STATS_INTERVAL_SECONDS", "10"))
+STATS_WINDOW_SECONDS = float(os.getenv("MONITOR_STATS_WINDOW_SECONDS", "60"))
+STATS_MAX_TOPICS = int(os.getenv("MONITOR_STATS_MAX_TOPICS", "200"))
+
+MONITOR_ID = f"monitor-{uuid.uuid4().hex[:8]}"
+
+SEPARATOR = "=" * 70
+RULE = "-" * 70
 
 def on_message(client, userdata, msg):
     """
@@ -10,51 +36,128 @@ def on_message(client, userdata, msg):
     try:
         topic = msg.topic
         payload_raw = msg.payload.decode('utf-8')
-        
+
         # 受信時刻を取得
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-        
+
         # JSONとして解析を試み、成功すれば整形して表示
         payload_data, error = modt.parse_payload(payload_raw)
-        
-        print("\n" + "="*70, flush=True)
-        print(f"[{timestamp}] Topic: {topic}", flush=True)
-        print("-" * 70, flush=True)
-        
+
         if error:
             # JSONでない、あるいは破損している場合はそのまま表示
-            print(f"Raw Payload: {payload_raw}", flush=True)
-            print(f"Parse Error: {error}", flush=True)
+            body = f"Raw Payload: {payload_raw}\nParse Error: {error}"
         else:
             # 整形されたJSONを出力
-            pretty_payload = json.dumps(payload_data, indent=4, ensure_ascii=False)
-            print(pretty_payload, flush=True)
-            
-        print("="*70 + "\n", flush=True)
-        
+            body = json.dumps(payload_data, indent=4, ensure_ascii=False)
+
+        # 1 メッセージ分をまとめて 1 回で出力し、フラッシュの回数を抑える
+        print(f"\n{SEPARATOR}\n[{timestamp}] Topic: {topic}\n{RULE}\n{body}\n{SEPARATOR}\n", flush=True)
+
     except Exception as e:
         print(f"Error logging message: {e}", flush=True)
 
-# SDKを使用してMQTTクライアントを生成
-mqtt_client = modt.get_mqtt_client()
-mqtt_client.on_message = on_message
-
-print("Monitor Unit starting via MoDT SDK...", flush=True)
-
-try:
-    # SDKの厳格な接続関数を利用
-    # MODT_BROKER_HOST と MODT_BROKER_PORT が未設定ならここで例外が発生します
-    modt.connect_broker(mqtt_client)
-    
-    # MoDTシステム内のすべてのトピックをワイルドカードで購読
-    mqtt_client.subscribe("#")
-    print("Subscribed to all topics. Waiting for messages...", flush=True)
-    
-    # メインスレッドを維持して待機状態を継続
-    while True:
-        time.sleep(1)
-        
-except KeyboardInterrupt:
-    print("\nMonitor Unit stopping...", flush=True)
-except Exception as e:
-    print(f"Monitor failed to start: {e}", flush=True)
\ No newline at end of file
+def on_capture(client, userdata, msg):
+    """
+    キャプチャモードのメッセージ受信処理。
+    解析や整形は行わず、受信時刻・トピック・生のペイロードをバッファへ追記するだけに留めます。
+    """
+    writer = userdata["writer"]
+    try:
+        writer.write(msg.topic, msg.payload)
+    except Exception as e:
+        modt.logger.error(f"Failed to capture message on {msg.topic}: {e}")
+        return
+
+    now = time.monotonic()
+    if now - userdata["last_report"] >= CAPTURE_REPORT_SECONDS:
+        userdata["last_report"] = now
+        modt.logger.info(
+            f"Captured {writer.records} messages ({writer.bytes_written / 1024 / 1024:.1f} MB, "
+            f"{writer.files} files) -> {writer.path}"
+        )
+
+def on_analytics(client, userdata, msg):
+    """集計モードのメッセージ受信処理。自分が発行したスナップショットは集計に含めません。"""
+    if msg.topic == modt.TOPIC_MONITOR_STATS:
+        return
+    try:
+        userdata["stats"].observe(msg.topic, msg.payload)
+    except Exception as e:
+        modt.logger.error(f"Failed to analyze message on {msg.topic}: {e}")
+
+def run_reporter(client, stats, stop_event):
+    """一定間隔で集計の要約をログに出力し、スナップショットを modt/monitor/stats に発行します。"""
+    while not stop_event.wait(STATS_INTERVAL_SECONDS):
+        snapshot = stats.snapshot()
+        modt.logger.info(f"Traffic: {format_summary(snapshot)}")
+        client.publish(modt.TOPIC_MONITOR_STATS, modt.create_monitor_stats_payload(MONITOR_ID, snapshot))
+
+def dispatch(client, userdata, msg):
+    """複数のモードを指定した場合に、各モードの受信処理を順に呼び出します。"""
+    for handler in userdata["handlers"]:
+        handler(client, userdata, msg)
+
+def on_connect(client, userdata, flags, rc):
+    if rc == 0:
+        # MoDTシステム内のすべてのトピックをワイルドカードで購読
+        client.subscribe("#")
+        print("Subscribed to all topics. Waiting for messages...", flush=True)
+    else:
+        print(f"Monitor connection failed with code {rc}", flush=True)
+
+def main():
+    # SDKを使用してMQTTクライアントを生成
+    mqtt_client = modt.get_mqtt_client(client_id=MONITOR_ID)
+    mqtt_client.on_connect = on_connect
+    userdata = {"handlers": []}
+    writer = None
+    stop_event = threading.Event()
+
+    if "pretty" in MONITOR_MODES:
+        userdata["handlers"].append(on_message)
+    if "capture" in MONITOR_MODES:
+        writer = CaptureWriter(
+            CAPTURE_DIR,
+            max_bytes=int(CAPTURE_MAX_MB * 1024 * 1024),
+            buffer_size=CAPTURE_BUFFER_KB * 1024,
+            flush_interval=CAPTURE_FLUSH_SECONDS,
+        )
+        userdata.update(writer=writer, last_report=time.monotonic())
+        userdata["handlers"].append(on_capture)
+    if "analytics" in MONITOR_MODES:
+        stats = TrafficStats(window=STATS_WINDOW_SECONDS, max_topics=STATS_MAX_TOPICS)
+        userdata["stats"] = stats
+        userdata["handlers"].append(on_analytics)
+        threading.Thread(target=run_reporter, args=(mqtt_client, stats, stop_event), daemon=True).start()
+    if not userdata["handlers"]:
+        raise RuntimeError(f"MONITOR_MODE に有効なモードがありません: {os.getenv('MONITOR_MODE')}")
+
+    mqtt_client.user_data_set(userdata)
+    # モードが 1 つなら受信処理を直接登録し、振り分けの呼び出しを省く
+    handlers = userdata["handlers"]
+    mqtt_client.on_message = handlers[0] if len(handlers) == 1 else dispatch
+    print(f"Monitor Unit starting via MoDT SDK ({', '.join(sorted(MONITOR_MODES))})...", flush=True)
+
+    # docker stop (SIGTERM) でもループを抜け、バッファに残ったキャプチャを書き出す
+    signal.signal(signal.SIGTERM, lambda signum, frame: mqtt_client.disconnect())
+
+    try:
+        # SDKの厳格な接続関数を利用
+        # MODT_BROKER_HOST と MODT_BROKER_PORT が未設定ならここで例外が発生します
+        modt.connect_broker(mqtt_client)
+
+        # 受信処理をメインスレッドで実行して待機状態を継続
+        mqtt_client.loop_forever()
+
+    except KeyboardInterrupt:
+        print("\nMonitor Unit stopping...", flush=True)
+    except Exception as e:
+        print(f"Monitor failed to start: {e}", flush=True)
+    finally:
+        stop_event.set()
+        if writer is not None:
+            writer.close()
+            modt.logger.info(f"Capture closed: {writer.records} messages, {writer.files} files")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+monitor のキャプチャ（MONITOR_MODE=capture で記録したファイル）をブローカーへ再送信します。
+記録時の送信間隔を保ったまま再生できるため、本番で記録したトラフィックを負荷試験に使えます。
+
+例: 記録時の 10 倍速で、指定した時間帯の modt/session/query だけを再送信する
+> python replay.py /app/captures --speed 10 --start 2025-12-31T08:00:00 --end 2025-12-31T09:00:00 \
+>     --topic modt/session/query
+
+--speed 0 は待機せずに最大速度で送信します。
+"""
+import time
+import uuid
+import argparse
+from datetime import datetime
+from common import modt
+from capture import iter_capture
+
+# 最大速度での送信時に、この件数ごとに送信済みになるまで待って paho の送信キューの増大を防ぐ
+PUBLISH_WINDOW = 1000
+
+
+def parse_time(text):
+    """ISO 8601 形式（ローカル時刻）の日時を ns 単位の UNIX 時刻に変換します。"""
+    if text is None:
+        return None
+    return int(datetime.fromisoformat(text).timestamp() * 1_000_000_000)
+
+
+def replay(client, records, speed=1.0):
+    """records を speed 倍速で送信し、(送信件数, 経過秒) を返します。speed が 0 以下なら待機しません。"""
+    sent = 0
+    first_ns = None
+    start = time.perf_counter()
+    info = None
+    for timestamp_ns, topic, payload in records:
+        if speed > 0:
+            if first_ns is None:
+                first_ns = timestamp_ns
+            # 記録上の経過時間を基準に送信時刻を決めるため、送信の遅れが累積しない
+            delay = (timestamp_ns - first_ns) / 1e9 / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        info = client.publish(topic, payload)
+        sent += 1
+        if sent % PUBLISH_WINDOW == 0:
+            info.wait_for_publish()
+    if info is not None:
+        info.wait_for_publish()
+    return sent, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="monitor のキャプチャをブローカーへ再送信します。")
+    parser.add_argument("path", help="キャプチャファイル（.cap）またはキャプチャのディレクトリ")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度の倍率（1 = 記録時と同じ、0 = 最大速度）")
+    parser.add_argument("--start", help="この日時以降のレコードから再生（例: 2025-12-31T08:00:00）")
+    parser.add_argument("--end", help="この日時より前のレコードまで再生")
+    parser.add_argument("--topic", help="このトピックのレコードだけを再生")
+    parser.add_argument("--prefix", default="capture", help="キャプチャファイル名の接頭辞")
+    args = parser.parse_args(argv)
+
+    records = iter_capture(args.path, args.prefix, parse_time(args.start), parse_time(args.end), args.topic)
+
+    client = modt.get_mqtt_client(client_id=f"monitor-replay-{uuid.uuid4().hex[:8]}")
+    modt.connect_broker(client)
+    client.loop_start()
+    try:
+        sent, elapsed = replay(client, records, args.speed)
+    finally:
+        modt.disconnect_broker(client)
+        client.loop_stop()
+    rate = sent / elapsed if elapsed > 0 else 0.0
+    modt.logger.info(f"Replayed {sent} messages in {elapsed:.2f}s ({rate:.1f} msg/s)")
+
+
+if __name__ == "__main__":
+    main()
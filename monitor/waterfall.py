@@ -0,0 +1,51 @@
+"""
+各ユニットが MODT_TRACE_DIR に記録したスパンを読み込み、トレースの一覧やウォーターフォールを表示します。
+
+例: 直近 20 件のトレースを一覧し、そのうち 1 件の処理の流れを表示する
+> python waterfall.py /app/traces
+> python waterfall.py /app/traces --trace 3f2a9c0d4b1e7a65
+"""
+import argparse
+from datetime import datetime
+from common import modt
+
+
+def summarize_traces(spans):
+    """トレースごとに (開始時刻 ns, trace_id, 最初のスパン名, 全体の所要時間 ms, スパン数) を開始順に返します。"""
+    traces = {}
+    for s in spans:
+        start, end = s["start_ns"], s["start_ns"] + s["duration_us"] * 1000
+        entry = traces.get(s["trace_id"])
+        if entry is None:
+            traces[s["trace_id"]] = [start, end, s["name"], 1]
+            continue
+        if start < entry[0]:
+            entry[0], entry[2] = start, s["name"]
+        entry[1] = max(entry[1], end)
+        entry[3] += 1
+    rows = [(start, trace_id, name, (end - start) / 1_000_000, count) for trace_id, (start, end, name, count) in traces.items()]
+    return sorted(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="記録したスパンからトレースのウォーターフォールを表示します。")
+    parser.add_argument("paths", nargs="+", help="スパンのファイル（.jsonl）またはそのディレクトリ")
+    parser.add_argument("--trace", help="ウォーターフォールを表示するトレース ID")
+    parser.add_argument("--name", help="一覧で、最初のスパン名にこの文字列を含むトレースだけを表示する（例: login）")
+    parser.add_argument("--last", type=int, default=20, help="一覧に表示する直近のトレース数")
+    parser.add_argument("--width", type=int, default=40, help="ウォーターフォールの棒の幅")
+    args = parser.parse_args(argv)
+
+    spans = modt.load_spans(args.paths)
+    if args.trace:
+        print(modt.format_waterfall(modt.build_waterfall(spans, args.trace), args.width))
+        return
+
+    rows = [row for row in summarize_traces(spans) if not args.name or args.name in row[2]]
+    for start, trace_id, name, duration_ms, count in rows[-args.last:]:
+        started = datetime.fromtimestamp(start / 1e9).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        print(f"{started}  {trace_id}  {duration_ms:9.3f}ms  {count:3d} spans  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,48 @@
-import time
 import os
+import uuid
 from flask import Flask, request, jsonify, render_template, redirect
 from common import modt
 
 app = Flask(__name__)
 
-# リクエストごとの状態を保持する一時的なバッファ
-request_context = {}
+# 一覧の 1 ページに表示するキー数と、ページの応答を待つ上限（秒）
+PAGE_SIZE = int(os.getenv("VIEWER_PAGE_SIZE", "100"))
+PAGE_TIMEOUT = 5.0
+# セッション照会の応答を待つ上限（秒）と、照会結果をキャッシュする秒数
+SESSION_QUERY_TIMEOUT = 5.0
+SESSION_CACHE_SECONDS = float(os.getenv("MODT_SESSION_CACHE_SECONDS", "30"))
+# 書き込みのコミット完了通知を待つ上限（秒）
+WRITE_ACK_TIMEOUT = 5.0
+# 応答待ちのリクエスト数の上限と、同時に取得中のページ（ユーザー・検索条件・カーソルの組）の数の上限
+MAX_PENDING_REQUESTS = int(os.getenv("VIEWER_MAX_PENDING_REQUESTS", "1000"))
+MAX_PAGES_IN_FLIGHT = int(os.getenv("VIEWER_MAX_PAGES_IN_FLIGHT", "256"))
+
+# レプリカごとに一意なクライアントIDと、自分宛ての応答だけが届く返信トピック
+CLIENT_ID = f"viewer-unit-service-{uuid.uuid4().hex[:8]}"
+REPLY_TOPIC = modt.get_reply_topic(CLIENT_ID)
 
 def on_connect(client, userdata, flags, rc):
     """ブローカー接続成功時に呼ばれるコールバック"""
     if rc == 0:
         modt.logger.info("Viewer Unit connected to broker successfully.")
         # 接続後に必要なトピックを購読する
-        client.subscribe([
-            (modt.TOPIC_SESSION_INFO, 0),
-            (modt.TOPIC_STATE_ALL_VAL, 0)
-        ])
+        client.subscribe([(REPLY_TOPIC, 0), (modt.TOPIC_SESSION_REVOKED, 0)])
     else:
         modt.logger.error(f"Viewer Unit connection failed with code {rc}")
 
-def on_message(client, userdata, msg):
-    """MQTTからの返信を待ち受けるコールバック"""
-    payload, error = modt.parse_payload(msg.payload.decode())
-    if error:
-        return
-
-    # 1. セッション照会の結果（identify-unitからの返答）
-    if msg.topic == modt.TOPIC_SESSION_INFO:
-        sid = payload.get("session_id")
-        if sid in request_context:
-            request_context[sid]["user_id"] = payload.get("user_id")
-            request_context[sid]["auth_status"] = payload.get("status")
-            modt.logger.info(f"Identify response received: {sid} -> {payload.get('user_id')}")
-
-    # 2. 全データ取得の結果（db-unitからの返答）
-    elif msg.topic == modt.TOPIC_STATE_ALL_VAL:
-        uid = payload.get("user_id")
-        for sid, ctx in request_context.items():
-            if ctx.get("user_id") == uid:
-                ctx["all_data"] = payload.get("data", {})
-                ctx["completed"] = True
-                modt.logger.info(f"All data received for user: {uid}")
-
 # MQTTクライアントのセットアップ
-client = modt.get_mqtt_client(client_id="viewer-unit-service")
+client = modt.get_mqtt_client(client_id=CLIENT_ID)
 client.on_connect = on_connect
-client.on_message = on_message
+# 受信数・送信数と処理時間の計測（Requester がコールバックを登録する前に設定する）
+metrics = modt.setup_metrics(client, CLIENT_ID)
+# 返信トピックに届いた応答は Requester が相関IDで待機中のリクエストへ受け渡す
+requester = modt.Requester(client, REPLY_TOPIC, max_pending=MAX_PENDING_REQUESTS)
+# セッションの検証結果のキャッシュ（トークンの検証、照会のまとめ、失効通知の反映を行う）
+sessions = modt.SessionCache(requester, ttl=SESSION_CACHE_SECONDS, query_timeout=SESSION_QUERY_TIMEOUT)
+# 書き込みは db-unit のコミット完了通知（ack）を待ってから画面を戻す。一覧のページ取得にも使う
+state = modt.StateClient(requester, timeout=WRITE_ACK_TIMEOUT)
+# 同じページを同時に表示するリクエスト（自動更新する複数のタブなど）は 1 回の取得を共有する
+pages = modt.SingleFlight(max_in_flight=MAX_PAGES_IN_FLIGHT)
 
 # ブローカーに接続
 modt.connect_broker(client)
@@ -54,47 +50,59 @@ modt.connect_broker(client)
 # 重要：Flaskを実行しながらバックグラウンドでMQTT処理を動かすためにloop_startを開始する
 client.loop_start()
 
+def fetch_page(user_id, prefix, cursor):
+    """db-unit から 1 ページ分のキーと値を取得する（タイムアウト時は None）"""
+    return state.keys(user_id, prefix=prefix, cursor=cursor, limit=PAGE_SIZE, with_values=True, timeout=PAGE_TIMEOUT)
+
 @app.route('/view-data', methods=['GET'])
 def view_data():
-    """セッションIDを元にユーザーの全データを取得してテーブル表示する"""
+    """
+    セッションIDを元にユーザーのデータを 1 ページ分取得し、テーブル表示する。
+    prefix を指定するとその接頭辞で始まるキーだけを検索し、cursor で次のページを表示する。
+    """
     session_id = request.args.get('session_id')
     if not session_id:
         return jsonify({"error": "session_id is required"}), 400
-
-    request_context[session_id] = {
-        "user_id": None,
-        "auth_status": "pending",
-        "all_data": {},
-        "completed": False,
-        "query_sent": False
-    }
-
-    client.publish(modt.TOPIC_SESSION_QUERY, modt.create_session_query_payload(session_id))
-
-    timeout = 5.0
-    start_time = time.time()
-    
-    while time.time() - start_time < timeout:
-        ctx = request_context[session_id]
-        if ctx["user_id"] and ctx["auth_status"] == "valid" and not ctx["query_sent"]:
-            client.publish(modt.TOPIC_STATE_ALL_GET, modt.create_state_all_get_payload(ctx["user_id"]))
-            ctx["query_sent"] = True
-
-        if ctx["completed"]:
-            html_content = render_template(
-                "index.html",
-                session_id=session_id,
-                user_id=ctx["user_id"],
-                states=ctx["all_data"]
-            )
-            del request_context[session_id]
-            return html_content
-        
-        time.sleep(0.1)
-
-    if session_id in request_context:
-        del request_context[session_id]
-    return "Unauthorized or data fetch timeout", 403
+    prefix = request.args.get('prefix') or None
+    cursor = request.args.get('cursor') or None
+
+    # セッションの照会とページの取得（db-unit での処理を含む）を 1 つのトレースとして記録する
+    with modt.span("viewer view_data"):
+        # トークンかキャッシュで検証できればブローカーへの照会は行わない
+        session = sessions.verify(session_id, token=request.cookies.get(modt.SESSION_TOKEN_COOKIE))
+        if not session:
+            return "Unauthorized or data fetch timeout", 403
+
+        user_id = session["user_id"]
+        modt.logger.debug("Session verified: %s -> %s", session_id, user_id)
+
+        # キー数に関係なく、主キーの範囲検索で 1 ページ分だけを読み込ませる
+        try:
+            page = pages.do((user_id, prefix, cursor), fetch_page, user_id, prefix, cursor)
+        except modt.TooManyInFlight:
+            return "混雑しています。しばらくしてから再度お試しください", 503
+        if page is None:
+            return "データの取得がタイムアウトしました", 504
+
+    return render_template(
+        "index.html",
+        session_id=session_id,
+        user_id=user_id,
+        states=(page.get("data") or {}).items(),
+        prefix=prefix or "",
+        cursor=cursor,
+        next_cursor=page.get("next_cursor")
+    )
+
+def redirect_after_write(ack, session_id, user_id):
+    """書き込みのコミットが確認できれば一覧へ戻り、失敗・タイムアウトの場合はエラーを返す"""
+    # 書き込み前に始まったページの取得には合流させず、リダイレクト後の表示で読み直させる
+    pages.forget(lambda key: key[0] == user_id)
+    if ack is None:
+        return "書き込みの完了を確認できませんでした（タイムアウト）", 504
+    if ack.get("status") != "ok":
+        return "書き込みに失敗しました", 500
+    return redirect(f"/view-data?session_id={session_id}")
 
 @app.route('/update-data', methods=['POST'])
 def update_data():
@@ -107,11 +115,8 @@ def update_data():
     if not all([session_id, user_id, new_key, new_value]):
         return "必須パラメータが不足しています", 400
 
-    payload = modt.create_state_set_payload(user_id, new_key, new_value)
-    client.publish(modt.TOPIC_STATE_SET, payload)
-    
-    time.sleep(0.5)
-    return redirect(f"/view-data?session_id={session_id}")
+    ack = state.set(user_id, new_key, new_value)
+    return redirect_after_write(ack, session_id, user_id)
 
 @app.route('/delete-data', methods=['POST'])
 def delete_data():
@@ -123,13 +128,9 @@ def delete_data():
     if not all([session_id, user_id, target_key]):
         return "削除パラメータが不足しています", 400
 
-    payload = modt.create_state_delete_payload(user_id, target_key)
-    client.publish(modt.TOPIC_STATE_DELETE, payload)
-    
+    ack = state.delete(user_id, target_key)
     modt.logger.info(f"Delete request sent for {user_id}: {target_key}")
-    
-    time.sleep(0.5)
-    return redirect(f"/view-data?session_id={session_id}")
+    return redirect_after_write(ack, session_id, user_id)
 
 @app.route('/clear-data', methods=['POST'])
 def clear_data():
@@ -140,13 +141,9 @@ def clear_data():
     if not all([session_id, user_id]):
         return "パラメータが不足しています", 400
 
-    payload = modt.create_state_clear_payload(user_id)
-    client.publish(modt.TOPIC_STATE_CLEAR, payload)
-    
+    ack = state.clear(user_id)
     modt.logger.info(f"Clear all data request sent for {user_id}")
-    
-    time.sleep(0.5)
-    return redirect(f"/view-data?session_id={session_id}")
+    return redirect_after_write(ack, session_id, user_id)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file